@@ -1,5 +1,3 @@
-
 from .proto import *
+from .aproto import *
 from .exceptions import *
-
-
@@ -0,0 +1,405 @@
+"""Asyncio client for the step controller.
+
+AsyncProto uses the same framing, message classes and state handling as
+SyncProto, but reads the serial ports from tasks on the event loop, so
+one loop can drive the step controller, the encoders and other I/O
+without blocking.
+
+    p = await AsyncProto.open('/dev/ttyACM0')
+    await p.config(axes=axes)
+    m = await p.rmove((1000,))
+    await p.wait_done(m.seq)
+
+The serial transport comes from the pyserial-asyncio package.
+"""
+
+import asyncio
+from collections import OrderedDict
+from time import time
+from typing import Union, Tuple, List, Any, Dict
+
+from .messages import *
+from .proto import ProtoBase, TimeoutException, ProtocolException, TERMINATOR, logger
+
+__all__ = ['AsyncProto']
+
+
+class AsyncProto(ProtoBase):
+
+    def __init__(self, step_reader, step_writer, enc_reader=None, enc_writer=None,
+                 message_callback=None, window=1, queue_size=None, ack_timeout=2,
+                 max_queue=1000, sparse_moves=False):
+        """ Use AsyncProto.open() to create a client from port names.
+
+        :param max_queue: Number of incoming messages held for async iteration. When
+            the queue is full, the oldest messages are dropped.
+        :type max_queue: int
+        """
+
+        super().__init__(message_callback, window, queue_size, ack_timeout, sparse_moves)
+
+        self.step_reader = step_reader
+        self.step_writer = step_writer
+        self.enc_reader = enc_reader
+        self.enc_writer = enc_writer
+
+        self.ack_futures = {}  # seq -> Future, resolved on ACK, failed on NACK
+        self.done_futures = OrderedDict()  # seq -> Future, resolved on DONE
+
+        self.messages = asyncio.Queue(max_queue)
+        self.state_changed = asyncio.Condition()
+        self.reader_error = None  # Exception that stopped a reader task
+
+        self.tasks = [asyncio.ensure_future(self._read_loop(step_reader, CommandHeader.decode))]
+
+        if enc_reader is not None:
+            self.tasks.append(asyncio.ensure_future(self._read_loop(enc_reader, EncoderReport.decode)))
+
+    @classmethod
+    async def open(cls, stepper_port, encoder_port=None, stepper_baud=115200, encoder_baud=115200,
+                   **kwargs):
+        """Open the serial ports and return a running AsyncProto"""
+        import serial_asyncio
+
+        step_reader, step_writer = await serial_asyncio.open_serial_connection(
+            url=stepper_port, baudrate=stepper_baud)
+
+        if encoder_port is not None:
+            enc_reader, enc_writer = await serial_asyncio.open_serial_connection(
+                url=encoder_port, baudrate=encoder_baud)
+        else:
+            enc_reader, enc_writer = None, None
+
+        return cls(step_reader, step_writer, enc_reader, enc_writer, **kwargs)
+
+    async def close(self):
+
+        for t in self.tasks:
+            t.cancel()
+
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+        for w in (self.step_writer, self.enc_writer):
+            if w is not None:
+                w.close()
+
+        self._fail_pending(ProtocolException("Connection closed"))
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    # Receiving messages
+    #
+
+    async def _read_loop(self, reader, decode):
+        """Read and handle messages until the port closes or something fails, then
+        fail the pending futures and wake the waiters, which raise the error"""
+
+        try:
+            await self._read_messages(reader, decode)
+        except asyncio.IncompleteReadError:
+            e = ProtocolException("Serial port closed")
+        except Exception as ex:
+            logger.error(f"Reader task stopped: {ex!r}")
+            e = ex
+
+        self.reader_error = e
+        self._fail_pending(e)
+
+        async with self.state_changed:
+            self.state_changed.notify_all()
+
+    async def _read_messages(self, reader, decode):
+
+        while True:
+            data = await reader.readuntil(TERMINATOR)
+
+            stats = self.transport_stats
+            stats.bytes_in += len(data)
+
+            if len(data) == 1:
+                continue  # Empty frame
+
+            stats.frames_in += 1
+
+            try:
+                m = decode(data[:-1])
+            except CRCError as e:
+                stats.crc_errors += 1
+                logger.warning(f"{e} {data}")
+                continue
+            except Exception as e:
+                stats.decode_errors += 1
+                logger.warning(f"Failed to decode frame: {e} {data}")
+                continue
+
+            self.last_message_time = time()
+            r = self.handle_message(m)
+            self._dispatch(m, r)
+
+            if self.messages.full():
+                self.messages.get_nowait()
+            self.messages.put_nowait((m, r))
+
+            async with self.state_changed:
+                self.state_changed.notify_all()
+
+    def handle_message(self, m):
+
+        r = super().handle_message(m)
+
+        if m.code == CommandCode.DONE:
+            # DONEs arrive in order, so this one also finishes any earlier moves
+            while self.done_futures:
+                seq, f = self.done_futures.popitem(last=False)
+                if not f.done():
+                    f.set_result(m)
+                if seq == m.seq:
+                    break
+
+        return r
+
+    def _on_ack(self, seq, sent, m):
+        f = self.ack_futures.pop(seq, None)
+        if f is not None and not f.done():
+            f.set_result(m)
+
+    def _on_nack(self, seq, sent, m):
+        f = self.ack_futures.pop(seq, None)
+        if f is not None and not f.done():
+            f.set_exception(ProtocolException(f"Got NACK for {sent}"))
+
+        for s in (sent.seqs if isinstance(sent, MoveBatch) else (seq,)):
+            f = self.done_futures.pop(s, None)
+            if f is not None and not f.done():
+                f.set_exception(ProtocolException(f"Got NACK for {sent}"))
+
+    def _fail_pending(self, e):
+
+        for f in list(self.ack_futures.values()) + list(self.done_futures.values()):
+            if not f.done():
+                f.set_exception(e)
+
+        self.ack_futures.clear()
+        self.done_futures.clear()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        m, r = await self.messages.get()
+        return m
+
+    async def _wait_for(self, f, timeout=None, msg=None):
+        """Wait until f() is true, re-checking after every message is handled. Raises
+        the reader's error if it stops first. msg may be a callable, so the message is
+        only built if the timeout expires. """
+
+        async with self.state_changed:
+            try:
+                await asyncio.wait_for(self.state_changed.wait_for(lambda: f() or self.reader_error), timeout)
+            except asyncio.TimeoutError:
+                msg = msg() if callable(msg) else msg
+                raise TimeoutException(msg or f"Condition not met in {timeout}s") from None
+
+            if self.reader_error is not None and not f():
+                raise self.reader_error
+
+        return True
+
+    async def wait_until(self, f, timeout=None):
+        """Wait until f(current_state) is true, for instance
+
+            await p.wait_until(lambda s: s.queue_length <= 6, timeout=5)
+
+        Raises TimeoutException if the timeout expires first. """
+
+        return await self._wait_for(lambda: f(self.current_state), timeout)
+
+    # Waiting for responses
+    #
+
+    @staticmethod
+    def _future():
+        f = asyncio.get_running_loop().create_future()
+        # Don't complain about NACKs on futures that nobody awaited
+        f.add_done_callback(lambda f: f.cancelled() or f.exception())
+        return f
+
+    def ack_future(self, seq):
+        """Return the future for the ACK of a sent message, or None if it is
+        no longer in flight."""
+        return self.ack_futures.get(seq)
+
+    def done_future(self, seq):
+        """Return the future for the DONE of a sent move, or None if it is
+        already done."""
+        return self.done_futures.get(seq)
+
+    async def wait_acked(self, seq, timeout=None):
+        """Wait for the ACK of message seq. Raises ProtocolException if it was NACKed"""
+
+        f = self.ack_futures.get(seq)
+
+        if f is None:
+            if seq in self.nacked:
+                raise ProtocolException(f"Got NACK for {self.nacked.pop(seq)}")
+            return True
+
+        try:
+            return await asyncio.wait_for(asyncio.shield(f), timeout or self.ack_timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutException(f"Did not get ACK for seq_id {seq}") from None
+        finally:
+            self.nacked.pop(seq, None)
+
+    async def wait_done(self, seq, timeout=None):
+        """Wait for the DONE for move seq"""
+
+        f = self.done_futures.get(seq)
+
+        if f is None:
+            return True
+
+        try:
+            return await asyncio.wait_for(asyncio.shield(f), timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutException(f"Did not get DONE for seq_id {seq}") from None
+
+    async def flush(self, timeout=None):
+        """Wait until all sent messages are ACKed. Raises
+        ProtocolException if any were NACKed"""
+
+        await self._wait_for(lambda: not self.in_flight, timeout or self.ack_timeout,
+                             lambda: f"Did not get ACK for seq_ids {list(self.in_flight)}")
+
+        if self.nacked:
+            nacked, self.nacked = list({id(e): e for e in self.nacked.values()}.values()), OrderedDict()
+            raise ProtocolException(f"Got NACK for {nacked}")
+
+        return True
+
+    async def wait_empty(self, timeout=None):
+        """Wait until the step controller reports an empty queue"""
+        return await self._wait_for(lambda: self.empty, timeout,
+                                    f"Queue not empty after {timeout}s")
+
+    async def wait_queue_length(self, l, timeout=None):
+        """Wait until the queue length is at most l"""
+        return await self.wait_until(lambda s: s.queue_length <= l, timeout)
+
+    # Sending messages to the stepper controller
+    #
+
+    async def send(self, m, timeout=None):
+        """Send a message once there is space in the send window, and return it
+        without waiting for the ACK. Await ack_future(m.seq) or wait_acked(m.seq)
+        for the response. """
+
+        if self.reader_error is not None:
+            raise self.reader_error
+
+        if not self._window_open(m):
+            await self._wait_for(lambda: self._window_open(m), timeout or self.ack_timeout,
+                                 lambda: f"Send window did not open for {m}; in flight: {list(self.in_flight)}")
+
+        seq = self._next_seq(m)
+
+        self.ack_futures[seq] = self._future()
+
+        if isinstance(m, MoveCommand):
+            self.done_futures[seq] = self._future()
+        elif isinstance(m, MoveBatch):
+            for s in m.seqs:
+                self.done_futures[s] = self._future()
+
+        b = m.encode()
+        self.step_writer.write(b)
+        self._record_write(1, len(b))
+        await self.step_writer.drain()
+
+        return m
+
+    async def send_command(self, c, payload=None, timeout=None):
+        return await self.send(CommandHeader(seq=self.seq, code=c, payload=payload), timeout=timeout)
+
+    async def config(self, itr_delay: int = 4, segment_complete_pin=0, limit_hit_pin=0,
+                     debug_print: bool = False, debug_tick: bool = False,
+                     axes: List[AxisConfig] = []):
+
+        await self.send(ConfigCommand(len(axes), itr_delay, segment_complete_pin, limit_hit_pin,
+                                      debug_print, debug_tick))
+
+        self.axes = axes
+
+        for ac in axes:
+            await self.send(ac)
+
+        await self.flush()
+
+    async def _move(self, code: int, x: Union[List[Any], Tuple[Any], Dict], t=0):
+
+        m = self._move_command(code, x, t)
+
+        await self.send(m)
+        self.empty = False;
+
+        return m
+
+    async def amove(self, x: Union[List[Any], Tuple[Any], Dict]):
+        """Absolute position move"""
+        return await self._move(CommandCode.AMOVE, x, t=0)
+
+    async def rmove(self, x: Union[List[Any], Tuple[Any], Dict]):
+        "Relative position move"
+        return await self._move(CommandCode.RMOVE, x, t=0)
+
+    async def hmove(self, x: Union[List[Any], Tuple[Any], Dict]):
+        "A homing move, which will stop when it gets to a limit. "
+        return await self._move(CommandCode.HMOVE, x, t=0)
+
+    async def vmove(self, t: float, x: Union[List[Any], Tuple[Any], Dict]):
+        "A velocity move "
+        return await self._move(CommandCode.VMOVE, x, t=t)
+
+    async def jog(self, t: float, x: Union[List[Any], Tuple[Any], Dict]):
+        """Jog move. A jog move replaces the last move on the (step generator side)
+        planner, then becomes a regular relative move. """
+        return await self._move(CommandCode.JMOVE, x, t=t)
+
+    async def echo(self, payload='Echo'):
+        return await self.send_command(CommandCode.ECHO, payload=payload)
+
+    async def noop(self):
+        return await self.send_command(CommandCode.NOOP)
+
+    async def run(self):
+        return await self.send_command(CommandCode.RUN)
+
+    async def stop(self):
+        return await self.send_command(CommandCode.STOP)
+
+    async def info(self):
+        return await self.send_command(CommandCode.INFO)
+
+    async def reset(self):
+        self._reset_states()
+        self.pending_done.clear()
+        return await self.send_command(CommandCode.RESET)
+
+    async def zero(self):
+        self._reset_states()
+        if self.enc_writer is not None:
+            self.enc_writer.write(b'z')
+        return await self.send_command(CommandCode.ZERO)
+
+    async def runempty(self, timeout=None):
+        """Start the step controller if needed, and wait for its queue to empty"""
+
+        if not self.running:
+            await self.run()
+
+        return await self.wait_empty(timeout)
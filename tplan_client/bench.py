@@ -0,0 +1,394 @@
+"""Codec micro-benchmarks.
+
+    python -m tplan_client.bench [--json] [--output results.json]
+
+Measures, for every message type, encode and decode frames per second
+and allocations per frame, plus whole-stream deframing and the CRC8
+implementations, and compares the planner's exact cruise velocity solve
+for fixed segment times with the bisection it replaced. The frames come from a golden corpus, checked in at
+test/data/golden_frames.json, so runs on different versions of the
+codecs decode the same bytes, and test_messages checks that the
+encoders still produce them. After a deliberate change to the wire
+format, regenerate the corpus with
+
+    python -m tplan_client.bench --write-corpus
+
+Results are nested dicts of group -> benchmark -> measurements, which
+--json prints, and --output writes with the run's metadata, for
+tracking across releases.
+"""
+
+import gc
+import json
+import os
+import platform
+import random
+import sys
+from hashlib import sha256
+from time import perf_counter, strftime
+
+import numpy as np
+from cobs import cobs
+
+from .crc8 import Crc8, crc8, crc8_many
+from .messages import *
+from .proto import Deframer
+from .schema import CURRENT_STATE, ENCODER_REPORT
+
+CORPUS_PATH = os.path.join(os.path.dirname(__file__), 'test', 'data', 'golden_frames.json')
+
+CORPUS_SEED = 20
+
+
+def rate(f, min_time=.2):
+    """Call f repeatedly for at least min_time seconds, and return calls per second"""
+
+    n = 1
+    while True:
+        t = perf_counter()
+        for _ in range(n):
+            f()
+        dt = perf_counter() - t
+
+        if dt >= min_time:
+            return n / dt
+
+        n *= 2
+
+
+def allocations(f, items):
+    """Average number of memory blocks that f(item) allocates and leaves alive,
+    keeping the results, over items. This counts the objects a call hands back,
+    and anything they hold; temporaries freed inside the call are not counted. """
+
+    f(items[0])  # Warm up caches, like the frame buffers
+
+    keep = [None] * len(items)
+
+    gc.collect()
+    gc.disable()
+    try:
+        before = sys.getallocatedblocks()
+        for i, x in enumerate(items):
+            keep[i] = f(x)
+        after = sys.getallocatedblocks()
+    finally:
+        gc.enable()
+
+    return (after - before - 1) / len(items)  # Less one for the int in after
+
+
+def measure(f, items, min_time=.2):
+    """Frames per second and allocations per frame for calling f on each of items"""
+
+    def run():
+        for x in items:
+            f(x)
+
+    return {
+        'frames_per_s': rate(run, min_time) * len(items),
+        'allocs_per_frame': allocations(f, items)
+    }
+
+
+def sample_messages():
+    """One of each kind of message the client sends, by name"""
+
+    ms = {
+        'move': MoveCommand(CommandCode.RMOVE, [1000, -2000, 300], t=.1),
+        'text': CommandHeader(1, CommandCode.ECHO, payload='This is the payload'),
+        'command': CommandHeader(1, CommandCode.RUN),
+        'config': ConfigCommand(3, 4),
+        'axis': AxisConfig(0, 2, 3, 4, OutVal.HIGH, OutMode.OUTPUT, 5_000, 50_000)
+    }
+
+    ms['sparse_move'] = MoveCommand(CommandCode.RMOVE, [1000], t=.1)
+    ms['sparse_move'].compact = True
+
+    for i, m in enumerate(ms.values()):
+        m.seq = 100 + i
+
+    return ms
+
+
+def corpus_messages(n=16, seed=CORPUS_SEED):
+    """Build n messages of each kind, from a seeded random generator, so the
+    same messages come out every time. Returns a dict of kind -> messages.
+    Encoder reports, which only the encoder firmware sends, are frames. """
+
+    rng = random.Random(seed)
+
+    def seq():
+        return rng.randint(0, 0xffff)
+
+    def move(axes, lim):
+        m = MoveCommand(rng.choice(MOVE_CODES), [rng.randint(-lim, lim) for _ in range(axes)],
+                        t=rng.choice([0, rng.randint(1, 100_000) / TIMEBASE]))
+        m.seq = seq()
+        return m
+
+    def text():
+        words = ['queue', 'axis', 'limit', 'step', 'segment', 'velocity', 'done', 'error']
+        return ' '.join(rng.choice(words) for _ in range(rng.randint(1, 12)))
+
+    def encoder_frame():
+        v = list(ENCODER_REPORT.random_values(rng))
+        v[1] = rng.choice(list(CauseCode))
+        v[2] = rng.randint(0, 6)
+        return cobs.encode(ENCODER_REPORT.struct.pack(*v)) + TERMINATOR
+
+    kinds = {
+        'text': lambda: CommandHeader(seq(), rng.choice([CommandCode.ECHO, CommandCode.MESSAGE,
+                                                         CommandCode.ERROR, CommandCode.DEBUG]),
+                                      payload=text()),
+        'command': lambda: CommandHeader(seq(), rng.choice([CommandCode.RUN, CommandCode.STOP,
+                                                            CommandCode.NOOP, CommandCode.INFO])),
+        'move': lambda: move(rng.randint(1, 6), 100_000),
+        'sparse_move': lambda: move(rng.randint(1, 2), 2_000),
+        'move_batch': lambda: MoveBatch([move(3, 10_000) for _ in range(rng.randint(1, MAX_BATCH))],
+                                        seq=seq()),
+        'axis': lambda: AxisConfig(rng.randint(0, 5), rng.randint(0, 40), rng.randint(0, 40),
+                                   rng.randint(0, 40), rng.choice(list(OutVal)),
+                                   rng.choice(list(OutMode)), rng.randint(1, 20_000),
+                                   rng.randint(1, 200_000)),
+        'config': lambda: ConfigCommand(rng.randint(1, 6), rng.randint(1, 10), rng.randint(0, 40),
+                                        rng.randint(0, 40), rng.random() < .5, rng.random() < .5),
+        'current_state': lambda: CommandHeader(seq(), rng.choice(STATE_CODES),
+                                               payload=CURRENT_STATE.random_payload(rng)),
+        'encoder': encoder_frame
+    }
+
+    corpus = {}
+    for kind, f in kinds.items():
+        corpus[kind] = ms = [f() for _ in range(n)]
+        if kind == 'sparse_move':
+            for m in ms:
+                m.compact = True
+
+    return corpus
+
+
+def encode_corpus(messages):
+    """Encode the corpus messages, returning a dict of kind -> terminated frames"""
+
+    return {kind: [m if isinstance(m, bytes) else m.encode() for m in ms]
+            for kind, ms in messages.items()}
+
+
+def write_corpus(path=CORPUS_PATH):
+    frames = encode_corpus(corpus_messages())
+
+    with open(path, 'w') as f:
+        json.dump({kind: [fr.hex() for fr in frs] for kind, frs in frames.items()}, f, indent=1)
+        f.write('\n')
+
+
+def read_corpus(path=CORPUS_PATH):
+    """Read the golden corpus, returning a dict of kind -> terminated frames"""
+
+    with open(path) as f:
+        return {kind: [bytes.fromhex(h) for h in frs] for kind, frs in json.load(f).items()}
+
+
+def _decode_state(d):
+    h = CommandHeader.decode(d)
+    return decode_payload(h.code, h.payload).positions
+
+
+def bench_encode(min_time=.2):
+
+    r = {kind: measure(lambda m: m.encode(), ms, min_time)
+         for kind, ms in corpus_messages().items() if kind != 'encoder'}
+
+    moves = np.tile([100_000, 1000, -2000, 300, 0, 0, 0], (10_000, 1))
+    r['move_array'] = {
+        'frames_per_s': rate(lambda: encode_move_array(CommandCode.RMOVE, moves), min_time) * len(moves)
+    }
+
+    return r
+
+
+def bench_decode(min_time=.2, corpus=None):
+    """Decode the frames of each kind in the corpus. Stepper frames decode to a
+    CommandHeader; current_state also decodes the CurrentState payload and reads
+    the positions. """
+
+    corpus = corpus or read_corpus()
+    frames = {kind: [f[:-1] for f in frs] for kind, frs in corpus.items()}
+
+    r = {}
+    for kind, frs in frames.items():
+        if kind == 'encoder':
+            r[kind] = measure(EncoderReport.decode, frs, min_time)
+        elif kind == 'current_state':
+            r[kind] = measure(_decode_state, frs, min_time)
+        else:
+            r[kind] = measure(CommandHeader.decode, frs, min_time)
+
+    enc = frames['encoder']
+    r['encoder_many'] = {'frames_per_s': rate(lambda: EncoderReport.decode_many(enc), min_time) * len(enc)}
+
+    return r
+
+
+def bench_deframe(min_time=.2, corpus=None, chunk_size=256, min_bytes=64_000):
+    """Split and decode whole streams, fed to a Deframer in chunk_size reads, as
+    from the serial port. The stepper stream interleaves every stepper kind. """
+
+    corpus = corpus or read_corpus()
+
+    stepper = [f for kind, frs in corpus.items() if kind != 'encoder' for f in frs]
+    streams = {
+        'stepper': (CommandHeader.decode, stepper),
+        'encoder': (EncoderReport.decode, corpus['encoder'])
+    }
+
+    r = {}
+    for name, (decode, frs) in streams.items():
+        data = b''.join(frs)
+        reps = max(1, min_bytes // len(data))
+        data *= reps
+        n_frames = len(frs) * reps
+        chunks = [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+
+        def run():
+            d = Deframer(decode)
+            for c in chunks:
+                d.feed(c)
+
+        fps = rate(run, min_time) * n_frames
+        r[name] = {'frames_per_s': fps, 'bytes_per_s': fps * len(data) / n_frames}
+
+    return r
+
+
+def bench_crc(min_time=.2, frame_size=32):
+
+    d = os.urandom(frame_size)
+    mv = memoryview(bytearray(d))
+    frames = [os.urandom(frame_size) for _ in range(1000)]
+
+    return {
+        'Crc8.update': {'frames_per_s': rate(lambda: Crc8().update(d), min_time)},
+        'crc8': {'frames_per_s': rate(lambda: crc8(d), min_time)},
+        'crc8_memoryview': {'frames_per_s': rate(lambda: crc8(mv), min_time)},
+        'crc8_many': {'frames_per_s': rate(lambda: crc8_many(frames), min_time) * len(frames)}
+    }
+
+
+def v_c_cases(n=200, seed=CORPUS_SEED):
+    """(x, v_0, v_1, t_a, t_c, t_d, v_max) blocks with fixed segment times, as
+    segments.JointSegment solves them"""
+
+    rng = random.Random(seed)
+    v_max = 5_000
+
+    cases = []
+    for i in range(n):
+        v_0, v_1, v_c = rng.uniform(0, v_max), rng.choice([0, rng.uniform(0, v_max)]), rng.uniform(0, v_max)
+        t_a, t_c, t_d = rng.uniform(0, .1), rng.choice([0, rng.uniform(0, .5)]), rng.uniform(0, .1)
+        x = (v_0 + v_c) * t_a / 2 + v_c * t_c + (v_1 + v_c) * t_d / 2
+        cases.append((x, v_0, v_1, t_a, t_c, t_d, v_max))
+
+    return cases
+
+
+def _bisect_v_c(x, v_0, v_1, t_a, t_c, t_d, v_max):
+    """The search JointSegment.search_v_c used before v_c_for_times: bisect on
+    the error of calc_x(v_c), starting from the mean velocity"""
+
+    def f(v_c):
+        return x - ((v_0 + v_c) * t_a / 2. + t_c * v_c + (v_1 + v_c) * t_d / 2.)
+
+    v_min, v_guess = 0, x / (t_a + t_c + t_d)
+
+    for i in range(20):
+        e = f(v_guess)
+
+        if round(e) > 0:
+            v_guess, v_min = (v_max + v_guess) / 2, v_guess
+        elif round(e) < 0:
+            v_guess, v_max = (v_min + v_guess) / 2, v_guess
+        else:
+            break
+
+        if abs(v_min - v_max) < .05:
+            break
+
+    return v_guess
+
+
+def bench_planner(min_time=.2):
+    from .old_code.trapmath import v_c_for_times
+
+    cases = v_c_cases()
+
+    return {
+        'v_c_for_times': {'solves_per_s': rate(lambda: [v_c_for_times(*c) for c in cases], min_time) * len(cases)},
+        'bisect_v_c': {'solves_per_s': rate(lambda: [_bisect_v_c(*c) for c in cases], min_time) * len(cases)}
+    }
+
+
+def run_all(min_time=.2):
+    """Run every benchmark and return the results, with metadata about the run"""
+
+    corpus = read_corpus()
+
+    with open(CORPUS_PATH, 'rb') as f:
+        corpus_hash = sha256(f.read()).hexdigest()
+
+    return {
+        'meta': {
+            'time': strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'machine': platform.machine(),
+            'numpy': np.__version__,
+            'corpus_sha256': corpus_hash,
+            'min_time': min_time
+        },
+        'encode': bench_encode(min_time),
+        'decode': bench_decode(min_time, corpus),
+        'deframe': bench_deframe(min_time, corpus),
+        'crc': bench_crc(min_time),
+        'planner': bench_planner(min_time)
+    }
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Benchmark the message codecs')
+    parser.add_argument('-j', '--json', action='store_true', help='Print results as JSON')
+    parser.add_argument('-o', '--output', help='Write the results, as JSON, to a file')
+    parser.add_argument('-t', '--time', type=float, default=.2, help='Minimum seconds per benchmark')
+    parser.add_argument('--write-corpus', action='store_true',
+                        help='Regenerate the golden frame corpus from the current encoders, and exit')
+    args = parser.parse_args()
+
+    if args.write_corpus:
+        write_corpus()
+        print(f"Wrote {CORPUS_PATH}")
+        return
+
+    results = run_all(args.time)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for group, r in results.items():
+            if group == 'meta':
+                continue
+            for name, v in r.items():
+                unit, value = next(iter(v.items()))  # The rate comes first
+                allocs = v.get('allocs_per_frame')
+                allocs = f"{allocs:6.1f} allocs/frame" if allocs is not None else ''
+                print(f"{group:8s} {name:16s} {value:12,.0f} {unit.replace('_per_s', '/s'):9s} {allocs}")
+
+
+if __name__ == '__main__':
+    main()
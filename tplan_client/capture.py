@@ -0,0 +1,200 @@
+"""Wire capture and offline replay of serial sessions.
+
+A capture file is a short header followed by one record per frame, in
+both directions, as it appeared on the wire, without the zero terminator:
+
+    <d  monotonic timestamp, seconds
+    B   port: PORT_STEPPER or PORT_ENCODER
+    B   direction: DIR_IN (from the controller) or DIR_OUT (to it)
+    H   frame length
+        frame bytes
+
+Record a session with
+
+    p = SyncProto(port, capture='run.tpcap')
+
+or p.start_capture(), and play it back through the decoders and the
+protocol state handling with replay(), or from the command line:
+
+    python -m tplan_client.capture run.tpcap --realtime
+"""
+
+import json
+import struct
+import threading
+from time import monotonic, sleep
+
+from .messages import *
+
+MAGIC = b'TPCAP\x01'
+
+PORT_STEPPER = 0
+PORT_ENCODER = 1
+
+DIR_IN = 0
+DIR_OUT = 1
+
+record_header = struct.Struct('<dBBH')
+
+
+class CaptureWriter(object):
+    """Append timestamped frames to a capture file. Safe to call from the
+    reader thread and the sending thread at the same time. """
+
+    def __init__(self, path):
+        self.path = path
+        self.f = open(path, 'wb')
+        self.f.write(MAGIC)
+        self.lock = threading.Lock()
+        self.n_records = 0
+
+    def write(self, port, direction, frame, t=None):
+        """Record one frame, without its zero terminator"""
+
+        with self.lock:
+            if t is None:
+                t = monotonic()  # Under the lock, so the records stay in time order
+            self.f.write(record_header.pack(t, port, direction, len(frame)))
+            self.f.write(frame)
+            self.n_records += 1
+
+    def write_frames(self, port, direction, data, t=None):
+        """Record every zero-terminated frame in data"""
+
+        for frame in bytes(data).split(b'\0'):
+            if frame:
+                self.write(port, direction, frame, t)
+
+    def close(self):
+        with self.lock:
+            self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def read_capture(path):
+    """Yield (t, port, direction, frame) for each record in a capture file"""
+
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ProtoError(f"{path} is not a capture file")
+
+        while True:
+            h = f.read(record_header.size)
+            if len(h) < record_header.size:
+                return  # End of file, or a record cut short by a crash
+
+            t, port, direction, n = record_header.unpack(h)
+            frame = f.read(n)
+            if len(frame) < n:
+                return
+
+            yield t, port, direction, frame
+
+
+def replay(path, proto=None, realtime=False, cb=None):
+    """Feed a capture back through the frame decoders and the protocol state
+    handling. Sent frames are entered as in flight, as if the proto had sent
+    them, so ACK and DONE tracking and the latency statistics behave as they
+    did in the session.
+
+    :param proto: A ProtoBase to apply the messages to. If None, a new one is made
+    :param realtime: If true, wait between frames to reproduce the original timing.
+        Otherwise replay at full speed.
+    :param cb: Called as cb(proto, m, handled) for each received message
+    :return: the proto
+    """
+    from .proto import ProtoBase, _adapt_callback
+
+    if proto is None:
+        proto = ProtoBase(message_callback=lambda p, m: m.payload)
+
+    f = _adapt_callback(cb) if cb else None
+
+    decoders = {PORT_STEPPER: CommandHeader.decode, PORT_ENCODER: EncoderReport.decode}
+
+    stats = proto.transport_stats
+    clock = proto.clock
+    start_t = start_wall = None
+
+    try:
+        for t, port, direction, frame in read_capture(path):
+
+            if realtime:
+                if start_t is None:
+                    start_t, start_wall = t, monotonic()
+                delay = (t - start_t) - (monotonic() - start_wall)
+                if delay > 0:
+                    sleep(delay)
+
+            proto.clock = lambda: t
+
+            if direction == DIR_OUT:
+                stats.frames_out += 1
+                stats.bytes_out += len(frame) + 1
+                try:
+                    h = CommandHeader.decode(frame)
+                except ProtoError:
+                    continue
+                h.send_time = t
+                proto.seq = h.seq
+                proto.in_flight[h.seq] = h
+                if h.code in MOVE_CODES:
+                    proto.pending_done[h.seq] = (h.code, t)
+                elif h.code == CommandCode.SPARSE_MOVE:
+                    proto.pending_done[h.seq] = (CommandCode(MoveCommand.unpack_sparse(h.payload)['code']), t)
+                elif h.code == CommandCode.MOVE_BATCH:
+                    moves = MoveBatch.unpack_moves(h.payload)
+                    for i, mv in enumerate(moves):
+                        seq = (h.seq - len(moves) + 1 + i) & 0xffff
+                        proto.pending_done[seq] = (CommandCode(mv['code']), t)
+                continue
+
+            stats.frames_in += 1
+            stats.bytes_in += len(frame) + 1
+
+            try:
+                m = decoders[port](frame)
+            except CRCError:
+                stats.crc_errors += 1
+                continue
+            except Exception:
+                stats.decode_errors += 1
+                continue
+
+            proto.last_message_time = t
+            r = proto.handle_message(m)
+            proto._dispatch(m, r)
+
+            if f:
+                f(proto, m, r)
+    finally:
+        proto.clock = clock
+
+    return proto
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Replay a serial capture and print the protocol statistics')
+    parser.add_argument('path', help='Capture file')
+    parser.add_argument('-r', '--realtime', action='store_true',
+                        help='Reproduce the original timing, rather than replaying at full speed')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Print each received message')
+    args = parser.parse_args()
+
+    cb = (lambda m: print(m)) if args.verbose else None
+
+    p = replay(args.path, realtime=args.realtime, cb=cb)
+
+    print(json.dumps(p.stats(), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -33,6 +33,8 @@ and gave credit "From the PyPy project" and the link
 """
 import sys
 
+import numpy as np
+
 __author__ = "Nicco Kunzmann"
 __version__ = "0.1.0"
 
@@ -119,10 +121,62 @@ class Crc8(object):
         """
         return hex(self._sum)[2:].zfill(2)
 
-def crc8(d):
-    return Crc8().update(d)
+_table = tuple(Crc8._table)
+
+
+def crc8(d, start=0, _table=_table):
+    """CRC8 of a bytes-like object, including a memoryview of bytes, without
+    creating a Crc8 object or copying the data.
+
+    :param d: The data
+    :param start: Initial CRC value. Pass the CRC of earlier data to continue
+        a CRC over data in pieces: crc8(b, crc8(a)) == crc8(a + b)
+    :return: the CRC, an int
+    """
+
+    crc = start
+    for b in d:
+        crc = _table[crc ^ b]
+
+    return crc
+
+
+def crc8_many(frames):
+    """CRC8 of each frame in a sequence of bytes-like frames. All of the frames
+    of the same length are computed at once with NumPy. Returns a list of CRCs
+    in the same order as the frames. """
+
+    frames = list(frames)
+    crcs = [0] * len(frames)
+
+    by_len = {}
+    for i, f in enumerate(frames):
+        by_len.setdefault(len(f), []).append(i)
+
+    for n, idx in by_len.items():
+        if n == 0:
+            continue
+
+        a = np.frombuffer(b''.join(frames[i] for i in idx), dtype=np.uint8).reshape(len(idx), n)
+
+        for i, crc in zip(idx, crc8_rows(a).tolist()):
+            crcs[i] = crc
+
+    return crcs
+
+
+_np_table = np.array(_table, dtype=np.uint8)
+
+
+def crc8_rows(a):
+    """CRC8 of each row of a 2D uint8 NumPy array"""
+
+    crc = np.zeros(len(a), dtype=np.uint8)
 
+    for col in a.T:
+        crc = _np_table[crc ^ col]
 
+    return crc
 
 
-__all__ = ['Crc8','crc8']
\ No newline at end of file
+__all__ = ['Crc8', 'crc8', 'crc8_many', 'crc8_rows']
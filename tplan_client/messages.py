@@ -1,16 +1,22 @@
 from __future__ import print_function
 
 import struct
+import threading
 from dataclasses import dataclass
 from enum import IntEnum
 from typing import List, Union
 
+import numpy as np
 from cobs import cobs
 
-from tplan_client.crc8 import crc8
+from tplan_client.crc8 import crc8, crc8_rows
+from tplan_client.schema import (HEADER, MOVE, MOVE_BATCH_ITEM, SPARSE_MOVE_HEAD, AXIS_CONFIG, CONFIG,
+                                 CURRENT_STATE, ENCODER_REPORT)
 
 TIMEBASE = 1e6
 
+TERMINATOR = b'\0'
+
 
 class ProtoError(Exception):
     pass
@@ -28,6 +34,14 @@ class BadMoveCodeError(ProtoError):
     pass
 
 
+def _cobs_decode(d):
+    """cobs.decode, raising SerialPacketError for frames that are not valid COBS"""
+    try:
+        return cobs.decode(d)
+    except cobs.DecodeError as e:
+        raise SerialPacketError(f"Bad COBS frame: {e}") from None
+
+
 class OutMode(IntEnum):
     OUTPUT = 1
     OUTPUT_OPENDRAIN = 4
@@ -49,6 +63,8 @@ class CommandCode(IntEnum):
     JMOVE = 13  # a normal movement segment
     HMOVE = 14  # a normal movement segment
     VMOVE = 15
+    MOVE_BATCH = 16  # Several moves, each with its own code and time, in one frame
+    SPARSE_MOVE = 17  # A move with only the non-zero axes, in the smallest integer width
 
     RUN = 21
     STOP = 22
@@ -76,7 +92,104 @@ class CommandCode(IntEnum):
         return self.name
 
 
-class CommandHeader(object):
+MOVE_CODES = (CommandCode.RMOVE, CommandCode.AMOVE, CommandCode.JMOVE,
+              CommandCode.HMOVE, CommandCode.VMOVE)
+
+
+_ZERO_CRC = b'\0'
+
+_local = threading.local()
+
+
+def _frame_buffer(n):
+    """Return a reusable, per-thread bytearray of exactly n bytes"""
+    try:
+        bufs = _local.bufs
+    except AttributeError:
+        bufs = _local.bufs = {}
+
+    try:
+        return bufs[n]
+    except KeyError:
+        b = bytearray(n)
+        if n <= 256:  # Don't hold on to buffers for unusually long text payloads
+            bufs[n] = b
+        return b
+
+
+def _finish_frame(buf, seq, code, out=None):
+    """Pack the header into the first bytes of buf, which already holds the
+    payload, fill in the CRC, and COBS encode the frame. The frame is appended
+    to out, if it is given, otherwise it is returned as bytes. """
+
+    _header_struct.pack_into(buf, 0, seq, code, 0)
+    buf[3] = crc8(buf)  # The CRC is calculated with zero in its own place
+
+    if out is None:
+        return cobs.encode(buf) + TERMINATOR
+
+    out += cobs.encode(buf)
+    out.append(0)
+
+    return out
+
+
+def encode_frame(seq, code, payload=b'', out=None):
+    """Encode a header and a bytes payload into a terminated frame"""
+
+    buf = _frame_buffer(CommandHeader.size + len(payload))
+    buf[CommandHeader.size:] = payload
+
+    return _finish_frame(buf, seq, code, out)
+
+
+def encode_struct_frame(seq, code, st, values, out=None):
+    """Encode a header and a payload of values packed with the struct.Struct st,
+    packing straight into the frame buffer """
+
+    buf = _frame_buffer(CommandHeader.size + st.size)
+    st.pack_into(buf, CommandHeader.size, *values)
+
+    return _finish_frame(buf, seq, code, out)
+
+
+_command_codes = {c.value: c for c in CommandCode}
+
+
+def _command_code(code):
+    try:
+        return _command_codes[code]
+    except KeyError:
+        return CommandCode(code)  # Raises ValueError for codes that don't exist
+
+
+class Message(object):
+    """Sequence number, code and the ACK tracking state common to all of the
+    messages sent to and recieved from the step controller. The messages use
+    __slots__, since thousands of them a second can be in flight while
+    streaming moves. """
+
+    __slots__ = ('seq', 'code', 'acked', 'ack', 'nack', 'send_time', 'recieve_time')
+
+    def _init_message(self, seq, code):
+
+        self.seq = seq  # Gets set when sent
+        self.code = _command_code(code)
+
+        self.acked = None  # Set to true after ACK is recieved, or False if Nacked
+
+        self.ack = None  # ACK header
+        self.nack = None  # Nack header
+
+        self.send_time = None
+        self.recieve_time = None
+
+    @property
+    def name(self):
+        return self.code.name
+
+
+class CommandHeader(Message):
     # struct Header {
     #   uint16_t seq; // Packet sequence number
     #   enum Command code : 6; // Command number
@@ -87,39 +200,33 @@ class CommandHeader(object):
     #   uint32_t crc = 0; // Payload CRC // 4
     # }; // 8 bytes
 
-    msg_fmt = ('<H' +  # seq
-               'B' +  # Code
-               'B')  # CRC8
+    schema = HEADER
+    msg_fmt = schema.fmt
+    size = schema.size
+    _struct = schema.struct
 
-    size = struct.calcsize(msg_fmt)
+    __slots__ = ('crc', 'payload')
 
     def __init__(self, seq, code, crc=0, payload=None):
 
-        self.seq = seq  # Gets set when sent
-        self.code = CommandCode(code)
+        self._init_message(seq, code)
         self.crc = crc
-
-        self.acked = None  # Set to true after ACK is recieved, or False if Nacked
-
-        self.ack = None  # ACK header
-        self.nack = None  # Nack header
-
-        self.send_time = None
         self.payload = payload
 
     @property
     def is_ack(self):
         return self.code == CommandCode.ACK
 
-    @property
-    def name(self):
-        return self.code.name
-
     @staticmethod
-    def unpack(data):
-        seq, code, crc = struct.unpack(CommandHeader.msg_fmt, data)
+    def unpack(data, o=None):
+        """Unpack a header. If o is given, re-initialize it rather than making a new header"""
 
-        o = CommandHeader(seq, code, crc)
+        seq, code, crc = CommandHeader._struct.unpack(data)
+
+        if o is None:
+            return CommandHeader(seq, code, crc)
+
+        CommandHeader.__init__(o, seq, code, crc)
 
         return o
 
@@ -129,12 +236,14 @@ class CommandHeader(object):
 
         # Build the packet without the CRC as zero
         try:
-            return struct.pack(self.msg_fmt, *msg)
+            return self._struct.pack(*msg)
         except:
             print("Failed to build struct for :", msg)
             raise
 
-    def encode(self):
+    def encode(self, out=None):
+        """Encode the header and payload into a COBS frame, with its zero terminator.
+        If out is a bytearray, the frame is appended to it. """
 
         if self.payload:
             try:
@@ -145,29 +254,26 @@ class CommandHeader(object):
                 except AttributeError:
                     d = self.payload
         else:
-            d = bytearray()
-
-        p = self._pack(0) + d
-        crc = crc8(p)
+            d = b''
 
-        p = self._pack(crc) + d
-
-        return cobs.encode(p) + bytearray([0])
+        return encode_frame(self.seq, self.code, d, out)
 
     @classmethod
-    def decode(cls, d):
+    def decode(cls, d, h=None):
+        """Decode a frame, without its terminator. If h is given, it is re-used
+        for the result, as HeaderPool does. """
 
-        b = cobs.decode(d)
-        d = bytearray(b)
+        b = _cobs_decode(d)
 
-        h = cls.unpack(d[:cls.size])
+        h = cls.unpack(b[:cls.size], h)
+        payload = b[cls.size:]
 
-        d[3] = 0  # CRC is calculated with a zero here.
-        that_crc = crc8(d)
+        # The CRC is calculated with a zero in its own place
+        that_crc = crc8(payload, crc8(_ZERO_CRC, crc8(memoryview(b)[:3])))
         if h.crc != that_crc:
             raise CRCError(f"CRC Check failed: {h.crc} != {that_crc} ")
 
-        h.payload = d[cls.size:]
+        h.payload = payload
 
         return h
 
@@ -188,63 +294,283 @@ class CommandHeader(object):
         return f"<ST #{self.seq} {str(self.code)} > "
 
 
-class MoveCommand(object):
-    msg_fmt = ('<' +
-               'I' +  # segment_time
-               '6i')  # steps
+_header_struct = CommandHeader._struct
+
+# Status messages that the protocol clients don't keep references to, once
+# they are handled
+POOLED_CODES = frozenset((CommandCode.DONE, CommandCode.EMPTY, CommandCode.ZERO, CommandCode.ALIVE))
+
+
+class HeaderPool(object):
+    """Recycles the CommandHeaders of inbound status frames, to cut allocation
+    and garbage collection when the step controller sends many ALIVE, DONE
+    and EMPTY messages. Use decode() in place of CommandHeader.decode, and
+    release() each message once nothing refers to it any more. """
+
+    def __init__(self, size=64, codes=POOLED_CODES):
+        self.size = size
+        self.codes = codes
+        self.free = []
+
+        self.reused = 0
+        self.released = 0
+
+    def decode(self, d):
+
+        if self.free:
+            self.reused += 1
+            return CommandHeader.decode(d, self.free.pop())
+
+        return CommandHeader.decode(d)
+
+    def release(self, m):
+        """Return a message to the pool, if it is a header with a pooled code"""
+
+        if type(m) is CommandHeader and m.code in self.codes and len(self.free) < self.size:
+            m.payload = None
+            self.free.append(m)
+            self.released += 1
+
+
+# Struct format characters of the SPARSE_MOVE value widths, by width code
+SPARSE_WIDTHS = ('b', 'h', 'i')
+
+# SPARSE_MOVE payload structs, by width code and number of axes
+_sparse_structs = [[struct.Struct(SPARSE_MOVE_HEAD.fmt + f"{n}{c}") for n in range(7)]
+                   for c in SPARSE_WIDTHS]
+
+
+def _sparse_width(lo, hi):
+    """Width code of the smallest integer type that holds values from lo to hi"""
+    if -0x80 <= lo and hi < 0x80:
+        return 0
+    elif -0x8000 <= lo and hi < 0x8000:
+        return 1
+    return 2
 
-    size = struct.calcsize(msg_fmt)
+
+class MoveCommand(Message):
+    schema = MOVE
+    msg_fmt = schema.fmt
+    size = schema.size
+    _struct = schema.struct
+
+    __slots__ = ('x', 't', 'done', 'compact')
+
+    _pad = ((0,) * 6, (0,) * 5, (0,) * 4, (0,) * 3, (0,) * 2, (0,), ())
 
     def __init__(self, code: int, x: List[int], t: float = 0):
-        self.x = [int(e) for e in x] + [0] * (6 - len(x))
+        self.x = [*map(int, x), *self._pad[min(len(x), 6)]]
         self.t = int(round(t * TIMEBASE))  # Convert to integer microseconds
 
-        if code not in (CommandCode.AMOVE, CommandCode.RMOVE,
-                        CommandCode.JMOVE, CommandCode.HMOVE,
-                        CommandCode.VMOVE):
+        if code not in MOVE_CODES:
             raise BadMoveCodeError("Bad Code {}".format(code))
 
-        self.header = CommandHeader(seq=0, code=code)
+        self._init_message(0, code)
+        self.done = False
+        self.compact = False  # If true, encode() sends a SPARSE_MOVE frame when it is smaller
 
-    @property
-    def seq(self):
-        return self.header.seq
+    def sparse(self):
+        """Return the struct and values of the move as a SPARSE_MOVE payload, with an
+        axis bitmask and only the non-zero axes, in the smallest width that fits"""
 
-    @seq.setter
-    def seq(self, v):
-        self.header.seq = v
+        vals = [v for v in self.x if v]
+        mask = 0
+        for i, v in enumerate(self.x):
+            if v:
+                mask |= 1 << i
 
-    def encode(self):
+        w = _sparse_width(min(vals), max(vals)) if vals else 0
+
+        return _sparse_structs[w][len(vals)], (self.code, mask | w << 6, self.t, *vals)
+
+    @staticmethod
+    def unpack_sparse(payload):
+        """Unpack a SPARSE_MOVE payload into a dict of code, t and x, with x
+        expanded to all six axes"""
 
-        self.header.payload = self.pack()
+        if len(payload) < SPARSE_MOVE_HEAD.size:
+            raise SerialPacketError(f"Sparse move has only {len(payload)} bytes")
 
-        return self.header.encode()
+        code, mw, t = SPARSE_MOVE_HEAD.struct.unpack_from(payload)
+        mask, w = mw & 0x3f, mw >> 6
+
+        if w >= len(SPARSE_WIDTHS):
+            raise SerialPacketError(f"Bad sparse move width code {w}")
+
+        st = _sparse_structs[w][bin(mask).count('1')]
+        if len(payload) != st.size:
+            raise SerialPacketError(f"Sparse move with mask {mask:06b} has {len(payload)} bytes")
+
+        vals = iter(st.unpack(payload)[3:])
+
+        return {'code': code, 't': t, 'x': [next(vals) if mask & (1 << i) else 0 for i in range(6)]}
+
+    def encode(self, out=None):
+        if self.compact:
+            st, values = self.sparse()
+            if st.size < self.size:
+                return encode_struct_frame(self.seq, CommandCode.SPARSE_MOVE, st, values, out)
+
+        try:
+            return encode_struct_frame(self.seq, self.code, self._struct, self.schema.values(self), out)
+        except struct.error as e:
+            print(e, self)
+            raise
 
     def pack(self):
         try:
 
-            return struct.pack(self.msg_fmt, self.t, *self.x)
+            return self._struct.pack(self.t, *self.x)
         except Exception as e:
-            print(e, self.__dict__)
+            print(e, self)
             print(self.t, self.x )
             raise
 
     def __repr__(self):
-        return f"<Move {self.x} >"
+        return f"<Move {list(self.x)} >"
+
+
+# The header and payload of a MoveCommand frame, before CRC and COBS encoding
+move_frame_dtype = np.dtype([('seq', '<u2'), ('code', 'u1'), ('crc', 'u1'),
+                             ('t', '<u4'), ('x', '<i4', (6,))])
+
+
+def cobs_encode_rows(a):
+    """COBS encode each row of a 2D uint8 array and terminate it with a zero. The
+    rows must be shorter than 254 bytes, so each frame has exactly one overhead
+    byte, and the result has two more columns than a. """
+
+    n, l = a.shape
+    pos = np.arange(l + 1, dtype=np.uint8)
+
+    zero = np.empty((n, l + 1), dtype=bool)
+    np.equal(a, 0, out=zero[:, :l])
+    zero[:, l] = True  # Virtual zero at the end of the frame
+
+    # Index of the next zero at or after each position
+    next_zero = np.minimum.accumulate(np.where(zero, pos, np.uint8(l))[:, ::-1], axis=1)[:, ::-1]
+
+    out = np.empty((n, l + 2), dtype=np.uint8)
+    out[:, 0] = next_zero[:, 0] + 1  # Overhead byte points at the first zero
+    out[:, 1:-1] = a
+    # Each zero is replaced with the distance to the next one
+    np.copyto(out[:, 1:-1], next_zero[:, 1:] - pos[:-1], where=zero[:, :l])
+    out[:, -1] = 0
+
+    return out
+
 
+def encode_move_array(code, moves, seq=0):
+    """Encode an array of moves into one buffer of terminated MoveCommand frames,
+    without making a MoveCommand for each move.
 
-class AxisConfig(object):
-    msg_fmt = ('<' +
-               'B' +  # Axis
-               '3B' +  # step, dir, enable pins
-               '3B' +  # High or Low for step, direction and enable
-               '3B' +  # Output mode, OUTPUT or OUTPUT_OPENDRAIN
-               '2B' +  # Padding
-               'I' +  # v_max
-               'I'  # a_max
-               )
+    :param code: The move CommandCode for all of the moves
+    :param moves: (N, 7) array of [t, x0 .. x5], with t in integer microseconds. Arrays
+        with fewer axis columns are padded with zeros.
+    :param seq: Sequence number of the first move. The others follow consecutively
+    :return: bytes, ready to write to the port
+    """
 
-    size = struct.calcsize(msg_fmt)
+    if code not in MOVE_CODES:
+        raise BadMoveCodeError("Bad Code {}".format(code))
+
+    moves = np.asarray(moves)
+    if moves.ndim != 2 or not 1 < moves.shape[1] <= 7:
+        raise ProtoError(f"Moves must be an (N, 7) array, not {moves.shape}")
+
+    # Assigning into the frame fields would cast silently, wrapping large steps
+    # and truncating times in seconds to zero
+    if not np.issubdtype(moves.dtype, np.integer):
+        raise ProtoError(f"Moves must be an integer array, with t in microseconds, not {moves.dtype}")
+
+    if len(moves):
+        t, x = moves[:, 0], moves[:, 1:]
+        if t.min() < 0 or t.max() > 0xffffffff:
+            raise ProtoError("Move times must fit in a uint32")
+        if x.min() < -0x80000000 or x.max() > 0x7fffffff:
+            raise ProtoError("Move steps must fit in an int32")
+
+    n = len(moves)
+
+    f = np.zeros(n, dtype=move_frame_dtype)
+    f['seq'] = (seq + np.arange(n)) & 0xffff
+    f['code'] = code
+    f['t'] = moves[:, 0]
+    f['x'][:, :moves.shape[1] - 1] = moves[:, 1:]
+
+    raw = f.view(np.uint8).reshape(n, move_frame_dtype.itemsize)
+    raw[:, 3] = crc8_rows(raw)  # The CRC is calculated with zero in its own place
+
+    return cobs_encode_rows(raw).tobytes()
+
+
+# Moves per MOVE_BATCH frame. Eight keeps the frame under 254 bytes, so COBS
+# adds only one byte
+MAX_BATCH = 8
+
+
+class MoveBatch(Message):
+    """Up to MAX_BATCH moves in one frame, ACKed once. The moves take
+    consecutive sequence numbers, ending with the seq of the frame, and the
+    step controller sends a DONE for each of them. """
+
+    item_schema = MOVE_BATCH_ITEM
+    _item_struct = item_schema.struct
+
+    __slots__ = ('moves',)
+
+    def __init__(self, moves: List[MoveCommand], seq=0):
+
+        if not 0 < len(moves) <= MAX_BATCH:
+            raise ProtoError(f"A batch must have 1 to {MAX_BATCH} moves, not {len(moves)}")
+
+        self._init_message(seq, CommandCode.MOVE_BATCH)
+        self.moves = list(moves)
+
+    @property
+    def seqs(self):
+        """Sequence numbers of the moves"""
+        n = len(self.moves)
+        return [(self.seq - n + 1 + i) & 0xffff for i in range(n)]
+
+    def encode(self, out=None):
+
+        st = self._item_struct
+        buf = _frame_buffer(CommandHeader.size + 1 + len(self.moves) * st.size)
+
+        buf[CommandHeader.size] = len(self.moves)
+        o = CommandHeader.size + 1
+        for m in self.moves:
+            st.pack_into(buf, o, m.code, m.t, *m.x)
+            o += st.size
+
+        return _finish_frame(buf, self.seq, self.code, out)
+
+    @classmethod
+    def unpack_moves(cls, payload):
+        """Unpack a MOVE_BATCH payload into a list of dicts of code, t and x"""
+
+        n = payload[0]
+        size = cls.item_schema.size
+
+        if len(payload) != 1 + n * size:
+            raise SerialPacketError(f"Batch of {n} moves has {len(payload)} bytes")
+
+        return [cls.item_schema.unpack(payload[o:o + size]) for o in range(1, 1 + n * size, size)]
+
+    def __repr__(self):
+        return f"<MoveBatch #{self.seq} {self.moves} >"
+
+
+class AxisConfig(Message):
+    schema = AXIS_CONFIG
+    msg_fmt = schema.fmt
+    size = schema.size
+    _struct = schema.struct
+
+    __slots__ = ('axis_num', 'mode', 'step_pin', 'direction_pin', 'enable_pin',
+                 'high_value', 'output_mode', 'v_max', 'a_max')
 
     def __init__(self, axis_num: int, step_pin: int, direction_pin: int, enable_pin: int,
                  high_value: Union[tuple, int], output_mode: Union[tuple, int],
@@ -261,44 +587,24 @@ class AxisConfig(object):
         self.v_max = int(v_max)
         self.a_max = int(a_max)
 
-        self.header = CommandHeader(seq=0, code=CommandCode.AXES)
+        self._init_message(0, CommandCode.AXES)
+
+    def pack(self):
+        return self.schema.pack(self)
+
+    def encode(self, out=None):
+        return encode_struct_frame(self.seq, self.code, self._struct, self.schema.values(self), out)
 
-    @property
-    def seq(self):
-        return self.header.seq
-
-    @seq.setter
-    def seq(self, v):
-        self.header.seq = v
-
-    def encode(self):
-        self.header.payload = struct.pack(self.msg_fmt,
-                                          self.axis_num,
-                                          self.step_pin, self.direction_pin, self.enable_pin,
-                                          *self.high_value,
-                                          *self.output_mode,
-                                          0, 0,
-                                          self.v_max, self.a_max)
-
-        return self.header.encode()
-
-
-class ConfigCommand(object):
-    msg_fmt = ('<' +
-               'B' +  # n_axes
-               'B' +  # interrupt_delay
-               'B' +  # Segment Complete Pin
-               'B' +  # Limit hit pin
-               'B' +  # uint8_t yellow_led_pin=0;
-               'B' +  # uint8_t blue_led_pin=0;
-               'B' +  # uint8_t running_led_pin=0;
-               'B' +  # uint8_t empty_led_pin=0;
-               'B' +  # uint8_t builtin_led_pin=0;
-               'B' +  # debug_print
-               'B'  # debug_tick
-               )
-
-    size = struct.calcsize(msg_fmt)
+
+class ConfigCommand(Message):
+    schema = CONFIG
+    msg_fmt = schema.fmt
+    size = schema.size
+    _struct = schema.struct
+
+    __slots__ = ('n_axes', 'itr_delay', 'debug_print', 'debug_tick', 'segment_complete_pin',
+                 'limit_hit_pin', 'yellow_led_pin', 'blue_led_pin', 'running_led_pin',
+                 'empty_led_pin', 'builtin_led_pin')
 
     def __init__(self, n_axes: int, itr_delay: int,
                  segment_complete_pin: int = 12, limit_hit_pin: int = 0,
@@ -322,52 +628,95 @@ class ConfigCommand(object):
         self.empty_led_pin = 30
         self.builtin_led_pin = 13
 
-        self.header = CommandHeader(seq=0, code=CommandCode.CONFIG)
+        self._init_message(0, CommandCode.CONFIG)
 
-    @property
-    def seq(self):
-        return self.header.seq
-
-    @seq.setter
-    def seq(self, v):
-        self.header.seq = v
-
-    def encode(self):
-        self.header.payload = struct.pack(self.msg_fmt,
-                                          self.n_axes,
-                                          self.itr_delay,
-                                          self.segment_complete_pin,
-                                          self.limit_hit_pin,
-                                          self.yellow_led_pin,
-                                          self.blue_led_pin,
-                                          self.running_led_pin,
-                                          self.empty_led_pin,
-                                          self.builtin_led_pin,
-                                          self.debug_print,
-                                          self.debug_tick)
-
-        return self.header.encode()
+    def pack(self):
+        return self.schema.pack(self)
+
+    def encode(self, out=None):
+        return encode_struct_frame(self.seq, self.code, self._struct, self.schema.values(self), out)
+
+
+_UNSET = object()
+
+
+class _LazyField(object):
+    """A field of a message that is unpacked from the payload the first time it
+    is read, and can be set like a plain attribute. """
+
+    def __init__(self, field):
+        self.slot = '_' + field.name  # Name of the slot that holds the value
+        self.st = field.struct
+        self.offset = field.offset  # Byte offset of the field in the payload
+        self.as_list = field.is_array
+
+    def __get__(self, obj, cls):
+
+        if obj is None:
+            return self
+
+        v = getattr(obj, self.slot)
+
+        if v is _UNSET:
+            v = self.st.unpack_from(obj._buf, self.offset)
+            v = list(v) if self.as_list else v[0]
+            setattr(obj, self.slot, v)
+
+        return v
+
+    def __set__(self, obj, v):
+        setattr(obj, self.slot, v)
 
 
 class CurrentState(object):
-    msg_fmt = ('<' +
-               'i' +  # queue_length
-               'I' +  # queue_time
-               '6i' +  # stepper_postitions
-               '6i' + # planner_postitions
-               'I' # Flags
-               )
+    """The step controller state, sent as the payload of ACK, DONE, EMPTY, ZERO and
+    ALIVE messages. The payload is kept as a memoryview, and each field is only
+    unpacked when it is first read, so a state that nobody looks at costs
+    almost nothing. """
+
+    schema = CURRENT_STATE
+    msg_fmt = schema.fmt
+    size = schema.size
+    _struct = schema.struct
+
+    __slots__ = ('_buf', '_queue_length', '_queue_time', '_positions', '_planner_positions', '_flags')
+
+    queue_length = _LazyField(schema['queue_length'])
+    queue_time = _LazyField(schema['queue_time'])
+    positions = _LazyField(schema['positions'])
+    planner_positions = _LazyField(schema['planner_positions'])
+    flags = _LazyField(schema['flags'])
 
-    size = struct.calcsize(msg_fmt)
+    _positions_slice = slice(schema['positions'].offset, schema['planner_positions'].offset)
 
     def __init__(self, b=None):
 
         if b:
-            self.queue_length, self.queue_time, *positions, self.flags = struct.unpack(self.msg_fmt, b)
+            self._buf = memoryview(b)
+
+            if len(self._buf) != self.size:
+                raise struct.error(f"CurrentState requires a buffer of {self.size} bytes, not {len(self._buf)}")
+
+            self._queue_length = self._queue_time = self._flags = _UNSET
+            self._positions = self._planner_positions = _UNSET
         else:
-            self.queue_length, self.queue_time, *positions = 0, 0, []
+            self._buf = None
+            self._queue_length, self._queue_time, self._flags = 0, 0, 0
+            self._positions, self._planner_positions = [], []
 
-        self.positions, self.planner_positions = positions[:6], positions[6:]
+    def position_bytes(self):
+        """The raw stepper positions, for cheaply checking whether they have changed,
+        or None if the state was not decoded from a payload"""
+        return self._buf[self._positions_slice].tobytes() if self._buf is not None else None
+
+    def pack(self):
+        """Pack the state into a payload, as the step controller would send it"""
+
+        def pad(l):
+            return list(l) + [0] * (6 - len(l))
+
+        return self._struct.pack(self.queue_length, self.queue_time,
+                                 *pad(self.positions), *pad(self.planner_positions), self.flags)
 
     @property
     def running(self):
@@ -405,15 +754,31 @@ class CauseCode(IntEnum):
     POLL = 104
 
 
-@dataclass()
+# The encoder firmware sends the struct with C alignment, so the schema uses
+# native alignment, with two bytes of padding before the positions. Limit
+# states are unpacked as unsigned bytes rather than chars, to skip
+# int.from_bytes on each one.
+_encoder_struct = ENCODER_REPORT.struct
+
+encoder_dtype = np.dtype([('seq', 'u2'), ('code', 'u1'), ('axis', 'i1'),
+                          ('limit_states', 'u1', (6,)), ('positions', 'i4', (6,))], align=True)
+
+assert encoder_dtype.itemsize == _encoder_struct.size
+
+_cause_codes = {c.value: c for c in CauseCode}
+
+
+@dataclass(slots=True)
 class EncoderReport:
     axis_code: int
     code: CauseCode
     encoders: "EncoderState"
+    recieve_time: float = None
+    seq: int = 0
 
     def __str__(self):
         s = ' '.join(str(e) for e in self.encoders)
-        return f"<ER {self.cause.name}@{self.axis_code} {s}> "
+        return f"<ER {self.code.name}@{self.axis_code} {s}> "
 
     @property
     def is_ack(self):
@@ -421,44 +786,58 @@ class EncoderReport:
 
     @property
     def name(self):
-        return self.cause.name
+        return self.code.name
 
     @classmethod
     def decode(cls, data):
+        """Decode a COBS encoded encoder frame, without its terminator. The axis
+        index on the wire is one based, with zero for reports that are not about
+        one axis. """
 
-        encoders = []
+        b = _cobs_decode(data)
 
-        raise Exception("Check this code against the new message format")
         try:
-            try:
-                v = struct.unpack(encoder_msg_fmt, cobs.decode(data))
-            except struct.error as e:
-                print(e)
-                print('Got data len=', len(data));
-                raise
+            seq, code, axis, *v = _encoder_struct.unpack(b)
+        except struct.error as e:
+            raise SerialPacketError(f"Bad encoder frame, {len(b)} bytes: {e}") from None
 
-            cause = CauseCode(int.from_bytes(v[6], 'big'))
-            axis = int.from_bytes(v[7], 'big')
+        try:
+            cause = _cause_codes[code]
+        except KeyError:
+            raise SerialPacketError(f"Bad encoder cause code {code}") from None
 
-            if axis == 0:
-                axis = None
-            else:
-                axis -= 1
+        ls = _limit_states
+        encoders = [EncoderState(*ls[l], p) for l, p in zip(v[:6], v[6:])]
 
-            for limit_states, positions in zip(v[:6], v[-6:]):
-                ls = int.from_bytes(limit_states, "big")
-                direction = (ls & 4) >> 2
-                limit_code = LimitCode(ls & 3)
+        return cls(axis - 1 if axis > 0 else None, cause, encoders, seq=seq)
 
-                encoders.append(EncoderState(limit_code, direction, positions))
+    @staticmethod
+    def decode_many(frames):
+        """Decode a run of COBS encoded encoder frames into NumPy arrays, without
+        making an EncoderReport for each. Returns a dict of arrays, one row per
+        frame: seq, code (cause code), axis (-1 for no axis), and the per-axis
+        (N, 6) arrays limit_code, direction and position. """
 
-            return EncoderReport(axis, cause, encoders)
+        raw = b''.join(map(_cobs_decode, frames))
 
-        except Exception as e:
-            raise
+        if len(raw) % encoder_dtype.itemsize:
+            raise SerialPacketError("Encoder frames must all be "
+                                    f"{encoder_dtype.itemsize} bytes long when decoded")
 
+        a = np.frombuffer(raw, dtype=encoder_dtype)
+        axis = a['axis']
 
-@dataclass
+        return {
+            'seq': a['seq'],
+            'code': a['code'],
+            'axis': np.where(axis > 0, axis - 1, -1),
+            'limit_code': a['limit_states'] & 3,
+            'direction': (a['limit_states'] & 4) >> 2,
+            'position': a['positions']
+        }
+
+
+@dataclass(slots=True)
 class EncoderState:
     """Class for keeping track of an item in inventory."""
     limit_code: LimitCode
@@ -467,10 +846,99 @@ class EncoderState:
 
     def sid(self):
         """string ident"""
-        return f"< ## {self.cause.name} {self.limit_code.name}>"
+        return f"< ## {self.limit_code.name}>"
 
     def __repr__(self):
         return (f'E[{self.limit_code.name} {"<" if self.direction else ">"}{self.position}]')
 
     def __str__(self):
         return (f'{self.limit_code.name}{"<" if self.direction else ">"}{self.position}')
+
+
+# (limit code, direction) for each value of a limit state byte
+_limit_states = [(LimitCode(b & 3), (b & 4) >> 2) for b in range(256)]
+
+
+# Codes whose payload is a CurrentState
+STATE_CODES = (CommandCode.ACK, CommandCode.DONE, CommandCode.EMPTY,
+               CommandCode.ZERO, CommandCode.ALIVE)
+
+# Payload layout for each code
+PAYLOAD_SCHEMAS = {
+    **{code: MOVE for code in MOVE_CODES},
+    CommandCode.AXES: AXIS_CONFIG,
+    CommandCode.CONFIG: CONFIG,
+    **{code: CURRENT_STATE for code in STATE_CODES},
+    **{code: ENCODER_REPORT for code in CauseCode},  # Whole frames, with no header
+}
+
+# Functions that turn a recieved payload into an object. MOVE_BATCH and SPARSE_MOVE
+# payloads vary in length, so they have no schema, only a decoder
+PAYLOAD_DECODERS = {
+    **{code: CurrentState for code in STATE_CODES},
+    CommandCode.MOVE_BATCH: MoveBatch.unpack_moves,
+    CommandCode.SPARSE_MOVE: MoveCommand.unpack_sparse,
+}
+
+
+def decode_payload(code, payload):
+    """Decode a recieved payload with the decoder registered for its code. Payloads
+    of codes with no decoder, like text messages, are returned unchanged. """
+
+    f = PAYLOAD_DECODERS.get(code)
+
+    return f(payload) if f is not None else payload
+
+
+def _random_batch_payload(rng):
+    """A MOVE_BATCH payload of one to MAX_BATCH random moves"""
+    n = rng.randint(1, MAX_BATCH)
+    st = MOVE_BATCH_ITEM.struct
+    return bytes([n]) + b''.join(st.pack(rng.choice(MOVE_CODES), *MOVE.random_values(rng)) for _ in range(n))
+
+
+def _random_sparse_payload(rng):
+    """A SPARSE_MOVE payload with random axes set, with values of a random width"""
+    bits = 8 << rng.randrange(len(SPARSE_WIDTHS))
+    lo, hi = -(1 << bits - 1), (1 << bits - 1) - 1
+
+    m = MoveCommand(rng.choice(MOVE_CODES), [rng.randint(lo, hi) if rng.random() < .5 else 0 for _ in range(6)])
+    m.t = rng.randint(0, 0xffffffff)
+
+    st, v = m.sparse()
+    return st.pack(*v)
+
+
+# Random payload generators for the codes with no schema
+PAYLOAD_GENERATORS = {
+    CommandCode.MOVE_BATCH: _random_batch_payload,
+    CommandCode.SPARSE_MOVE: _random_sparse_payload,
+}
+
+
+def random_frames(n=1, rng=None, codes=None):
+    """Make frames with random sequence numbers and payloads for the codes in
+    PAYLOAD_SCHEMAS and PAYLOAD_GENERATORS, for fuzzing and test corpora. Returns
+    a list of (code, frame) with n frames per code; frames include their terminator.
+
+    :param rng: random.Random to use, for reproducible frames
+    :param codes: Codes to make frames for. Defaults to all codes with a schema or generator
+    """
+    import random
+
+    rng = rng or random.Random()
+    frames = []
+
+    for code in (codes or [*PAYLOAD_SCHEMAS, *PAYLOAD_GENERATORS]):
+        sch = PAYLOAD_SCHEMAS.get(code)
+        gen = PAYLOAD_GENERATORS[code] if code in PAYLOAD_GENERATORS else sch.random_payload
+
+        for _ in range(n):
+            if isinstance(code, CauseCode):
+                v = list(sch.random_values(rng))
+                v[1] = code
+                frames.append((code, cobs.encode(sch.struct.pack(*v)) + TERMINATOR))
+            else:
+                frames.append((code, encode_frame(rng.randint(0, 0xffff), code, gen(rng))))
+
+    return frames
@@ -0,0 +1,117 @@
+"""Bounded LRU cache for block and axis solutions.
+
+Jogs and repeated programs solve the same (x, v_0, v_1, joint) blocks over
+and over. The solvers look their results up here first, keyed on the inputs
+quantized to a configurable step, so inputs that differ by less than the
+step share a solution:
+
+    block_cache.configure(maxsize=8192, quantum=.5)
+    block_cache.stats()  # {'hits': ..., 'misses': ..., 'evictions': ..., ...}
+
+block_cache is the cache the planners use by default.
+"""
+
+from collections import OrderedDict
+
+
+class BlockCache(object):
+
+    def __init__(self, maxsize=4096, quantum=1e-3, t_quantum=1e-6):
+        """
+        :param maxsize: Most solutions to keep. 0 disables the cache
+        :param quantum: Step that distances and velocities are rounded to in keys
+        :param t_quantum: Step that times, in seconds, are rounded to in keys
+        """
+        self.maxsize = maxsize
+        self.quantum = quantum
+        self.t_quantum = t_quantum
+
+        self.entries = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def configure(self, maxsize=None, quantum=None, t_quantum=None):
+        """Change the settings. Changing the quantization clears the cache, since
+        the old keys no longer match"""
+
+        if quantum is not None or t_quantum is not None:
+            self.quantum = quantum if quantum is not None else self.quantum
+            self.t_quantum = t_quantum if t_quantum is not None else self.t_quantum
+            self.entries.clear()
+
+        if maxsize is not None:
+            self.maxsize = maxsize
+            self._trim()
+
+    def key(self, kind, values, times=()):
+        """Build a key from the name of the solver, and its distance and velocity
+        values and time values, rounded to the quantization steps"""
+
+        return (kind,
+                tuple(round(v / self.quantum) for v in values),
+                tuple(round(t / self.t_quantum) for t in times))
+
+    def get(self, key, default=None):
+        try:
+            v = self.entries[key]
+        except KeyError:
+            self.misses += 1
+            return default
+
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return v
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        self._trim()
+
+    def solve(self, key, f):
+        """Return the cached solution for key, or call f() to solve it and cache the
+        result. Solutions must not be modified after they are cached. """
+
+        v = self.get(key, self)  # The cache is never a solution, so it marks a miss
+        if v is self:
+            v = f()
+            self.put(key, v)
+        return v
+
+    def _trim(self):
+        while len(self.entries) > max(self.maxsize, 0):
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        """Drop the solutions and reset the counters"""
+        self.entries.clear()
+        self.hits = self.misses = self.evictions = 0
+
+    @property
+    def hit_rate(self):
+        n = self.hits + self.misses
+        return self.hits / n if n else 0
+
+    def stats(self):
+        return {
+            'size': len(self.entries),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hit_rate
+        }
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __repr__(self):
+        return f"<BlockCache {len(self.entries)}/{self.maxsize} hits={self.hits} misses={self.misses}>"
+
+
+block_cache = BlockCache()
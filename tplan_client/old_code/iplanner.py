@@ -36,32 +36,10 @@ from collections import deque
 from dataclasses import dataclass, asdict, replace
 from typing import List
 
-import pandas as pd
-
+from .cache import BlockCache, block_cache
 from .isolver import SplitInfo
 
 
-def binary_search(f, v_min, v_guess, v_max):
-    for i in range(20):
-
-        x = f(v_guess)
-
-        if round(x) > 0:
-            v_guess, v_min = (v_max + v_guess) / 2, v_guess
-
-        elif round(x) < 0:
-            v_guess, v_max = (v_min + v_guess) / 2, v_guess
-
-        else:
-            return v_guess
-
-        if abs(v_min - v_max) < .05:
-            return v_guess
-
-    else:
-        return None
-
-
 def accel_xt(v_i, v_f, a):
     """Distance and time required to accelerate from v0 to v1 at acceleration a"""
 
@@ -121,6 +99,11 @@ def consistantize(b, return_error=False):
         return b.x_c
 
 
+def bv_delta(a, b):
+    """Largest difference between two lists of boundary velocities"""
+    return max((abs(p - q) for p, q in zip(a, b)), default=0)
+
+
 def sign(x):
     if x == 0:
         return 0
@@ -244,7 +227,13 @@ class AxisSegment:
 
     def solve(self):
         from .isolver import ipsolve, triplets, with_limits
-        self.slices = ipsolve(self.split_info, self.x, self.v_0, self.v_1)
+
+        si = self.split_info
+        cache = self.segment.cache if self.segment is not None else block_cache
+        key = cache.key('axis', (self.x, self.v_0, self.v_1, si.v_max, si.a_max, si.n), (si.t,))
+
+        # Copy, so the blocks don't share the cached list
+        self.slices = list(cache.solve(key, lambda: tuple(ipsolve(si, self.x, self.v_0, self.v_1))))
 
         lwl = with_limits(self.slices, self.v_0, self.v_1, self.split_info.dt)
 
@@ -286,12 +275,17 @@ class Segment(object):
     boundary_velocities_0 = None
     boundary_velocities_1 = None
 
-    def __init__(self, n, move: List[int], joints: List["Joint"], prior=None):
+    cache: BlockCache = block_cache
+
+    def __init__(self, n, move: List[int], joints: List["Joint"], prior=None, cache: BlockCache = None):
 
         self.n = n
         self.move = move
         self.joints = joints
 
+        if cache is not None:
+            self.cache = cache
+
         assert len(self.joints) == len(self.move)
 
         if prior:
@@ -331,14 +325,18 @@ class Segment(object):
         lng_move = max(self.move)
         lng_joint = self.joints[lng_idx]
 
-        b = ACDBlock(lng_move, v_0=0, v_1=0, joint=lng_joint).init()
+        # Only the time of the longest axis's block is used, so that is what's cached
+        key = self.cache.key('acd', (lng_move, lng_joint.v_max, lng_joint.a_max))
+        t = self.cache.solve(key, lambda: ACDBlock(lng_move, v_0=0, v_1=0, joint=lng_joint).init().t)
 
         # Split the longest axis to get the number of  divisions
-        self.split_info = ipsplit(lng_move, t=b.t, j=lng_joint)
+        self.split_info = ipsplit(lng_move, t=t, j=lng_joint)
 
         self.axes = [AxisSegment(i, self, joint, self.split_info, x, v_0, v_1).solve()
                      for i, (x, joint, v_0, v_1) in enumerate(zip(self.move, self.joints, bv_0, bv_1))]
 
+        self.n_updates += 1
+
         self.boundary_velocities_0 = [a.blocks[0].v_0 for a in self.axes]
         self.boundary_velocities_1 = [a.blocks[-1].v_1 for a in self.axes]
 
@@ -427,7 +425,20 @@ class SegmentList(object):
     all_segments: List[Segment]  # All of the segments, unprocessed
     planr_calls = 0
 
-    def __init__(self, joints: List[Joint]):
+    def __init__(self, joints: List[Joint], tolerance: float = 1, max_iterations: int = 4,
+                 cache: BlockCache = None):
+        """
+        :param tolerance: Boundary velocity change, in steps per second, below which
+            re-solving adjacent segments stops
+        :param max_iterations: Most times to alternate solving a new segment and its prior
+        :param cache: BlockCache for block and axis solutions. Defaults to the shared
+            cache.block_cache
+        """
+
+        self.tolerance = tolerance
+        self.max_iterations = max_iterations
+        self.cache = cache if cache is not None else block_cache
+        self.solve_counts = []  # Number of segment solves for each move()
 
         self.joints = [Joint(j.v_max, j.a_max, i) for i, j in enumerate(joints)]
 
@@ -440,40 +451,78 @@ class SegmentList(object):
         self.positions = [0] * len(self.joints)
 
     def move(self, x: List[int]):
-        """Add a new segment, with joints expressing joint distance
+        """Add a new segment, with joints expressing joint distance. Only the
+        segments whose boundary velocities change by more than the tolerance
+        are solved again.
+
         :type x: object
+        :return: the number of segment solves the move took
         """
 
         sl = len(self.segments)
         prior = self.segments[-1] if sl > 0 else None
 
-        s = Segment(sl, x, self.joints, prior)
+        s = Segment(sl, x, self.joints, prior, cache=self.cache)
 
         bv_max = [j.v_max for j in self.joints]
         bv_zero = [0 for _ in self.joints]
 
+        n_solves = 0
+
         if prior:
             # solve the prior with v_mac for v_1, but small axes may end up with lower values
             # so, we solve the tail with the same values
             pbv0 = prior.boundary_velocities_0
-            sbv1 = bv_zero
 
             prior.solve(bv_0=pbv0, bv_1=bv_max)
+            n_solves += 1
+
+            for i in range(self.max_iterations):
+                last_bv1 = prior.boundary_velocities_1
 
-            for i in range(4):
-                s.solve(bv_0=prior.boundary_velocities_1, bv_1=bv_zero)
+                s.solve(bv_0=last_bv1, bv_1=bv_zero)
                 prior.solve(bv_0=pbv0, bv_1=s.boundary_velocities_0)
+                n_solves += 2
 
+                # Stop once the junction between the two stops moving
+                if bv_delta(last_bv1, prior.boundary_velocities_1) <= self.tolerance:
+                    break
+
+            n_solves += self._propagate_back(prior)
 
         else:
             s.solve(bv_0=bv_zero, bv_1=bv_zero)
+            n_solves += 1
 
         self.segments.append(s)
+        self.solve_counts.append(n_solves)
+
+        return n_solves
+
+    def _propagate_back(self, s: Segment):
+        """Re-solving s may have changed its starting velocities. Walk back through
+        the earlier segments, re-solving each one whose ending velocities no longer
+        match the start of the next, and stop at the first that still matches
+        within the tolerance. Returns the number of solves. """
+
+        n = 0
 
+        while s.prior is not None:
+            p = s.prior
+
+            if bv_delta(p.boundary_velocities_1, s.boundary_velocities_0) <= self.tolerance:
+                break
+
+            p.solve(bv_0=p.boundary_velocities_0, bv_1=s.boundary_velocities_0)
+            n += 1
+            s = p
+
+        return n
 
 
     @property
     def dataframe(self):
+        import pandas as pd
 
         df = pd.concat([s.dataframe for s in self.segments])
 
@@ -515,6 +564,8 @@ class SegmentList(object):
         :rtype:
         """
 
+        import pandas as pd
+
         frames = []
         for i, s in enumerate(self.segments):
             frames.append(s.params_df)
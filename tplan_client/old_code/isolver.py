@@ -374,7 +374,9 @@ def ipsplit(x, t=None, n=None, j=None):
         make_add_limits=make_add_limits)
 
 
-def ipsolve(jd, x, v_0=None, v_1=None, err_f=err_f):
+def ipsolve_lists(jd, x, v_0=None, v_1=None, err_f=err_f):
+    """The original, list based solver. ipsolve() gives the same results,
+    faster; this one remains for custom error functions and for checking it. """
     # from IPython.display import display
     # import matplotlib.pylab as plt
     import numpy as np
@@ -399,6 +401,90 @@ def ipsolve(jd, x, v_0=None, v_1=None, err_f=err_f):
 
 
 
+#
+# Array based solver. The slices stay in a float64 array, without the
+# limits, which are passed separately as the lo and hi boundary slices
+#
+
+def err_array(jd, l, lo, hi):
+    """Array version of err_f(): the largest of the mean error, the excess over
+    x_max, and the boundary value error, for each slice"""
+    import numpy as np
+
+    me = np.empty_like(l)
+    me[1:-1] = l[1:-1] - (l[:-2] + l[2:]) / 2
+    me[0] = l[0] - ((lo + l[1]) / 2 if len(l) > 1 else (lo + hi) / 2)
+    if len(l) > 1:
+        me[-1] = l[-1] - (l[-2] + hi) / 2
+
+    xe = np.where(l > jd.x_max, l - jd.x_max, 0)
+
+    bv = np.zeros_like(l)
+    bv[-1] = l[-1] - hi
+    bv[0] = l[0] - lo  # For a single slice, the lo error wins, as in bv_err()
+
+    return np.maximum(np.maximum(me, xe), bv)
+
+
+def dist_error_array(jd, l, lo, hi, d):
+    """Array version of dist_error(). Takes a portion of the error from the slices
+    with error in direction d, and spreads it evenly over the slices with the
+    opposite error, or none. Returns a new array. """
+
+    e = err_array(jd, l, lo, hi)
+
+    if d > 0:
+        ce, oe = e > 0, e <= 0
+    else:
+        ce, oe = e < 0, e >= 0
+
+    # One of the error buckets was empty, so split above and below the mean
+    if not ce.any() or not oe.any():
+        m = e.mean()
+        ce, oe = e > m, e < m
+
+    if d < 0:
+        ce, oe = oe, ce
+
+    x = e[ce] * .3  # Only take a portion each iteration
+
+    l = l.copy()
+    l[ce] -= x
+
+    n_oe = oe.sum()
+    if n_oe:
+        l[oe] += x.sum() / n_oe
+
+    return l
+
+
+def ipsolve(jd, x, v_0=None, v_1=None):
+    """Distribute x over the jd.n slices of a segment, so the velocity changes
+    smoothly between the boundary velocities v_0 and v_1 without exceeding the
+    joint limits. Gives the same result as ipsolve_lists(), with the default
+    error function. Returns a list of slice sizes. """
+    import numpy as np
+
+    lo = round(v_to_x(v_0 if v_0 else 0, jd.dt))
+    hi = round(v_to_x(v_1 if v_1 else 0, jd.dt))
+
+    l = np.array(split_by_number(x, jd.n), dtype=np.float64)
+
+    last_rmse = 0
+    for i in range(30):
+        l = dist_error_array(jd, l, lo, hi, 1)
+        l = dist_error_array(jd, l, lo, hi, -1)
+
+        e = err_array(jd, l, lo, hi)
+        rmse = np.sqrt(np.dot(e, e))
+        if rmse == 0 or abs((last_rmse - rmse) / rmse) < .001:
+            break
+
+        last_rmse = rmse
+
+    return l.tolist()
+
+
 #
 # Extra functions
 #
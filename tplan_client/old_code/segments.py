@@ -26,16 +26,18 @@ from https://www.embedded.com/generate-stepper-motor-speed-profiles-in-real-time
 
 """
 from copy import deepcopy
+from math import sqrt
 from typing import List
 from collections import deque
 
 ## Parameters for simulation/step generation
 
 # NUmber of ticks of the step function per second
-from trajectory.sim import SimSegment
 
 from .params import *
+from .cache import BlockCache, block_cache
 from .iplanner import Joint
+from .trapmath import v_c_for_times
 
 TIMEBASE = 1_000_000  # ticks per second
 
@@ -91,6 +93,7 @@ class SubSegment(object):
         assert v_i == 0 or v_f == 0 or sign(v_i) == sign(v_f), f"Inconsistent directions {v_i} {v_f}"
 
         # Step function parameters.
+        from trajectory.sim import SimSegment
         self.sim = SimSegment(self.v_i, self.v_f, self.t)
         self.n, self.ca, self.cn = self.sim.initial_params()
 
@@ -130,6 +133,8 @@ class JointSegment(object):
 
     shape: int = TRAPEZOID
 
+    cache: BlockCache = block_cache
+
     joint: Joint
     next_js: 'JointSegment'
     prior_js: 'JointSegment'
@@ -177,17 +182,33 @@ class JointSegment(object):
         return x_a + x_c + x_d
 
     def search_v_c(self):
-        """Binary search for v_c"""
-
-        f = lambda v_c: self.x - self.calc_x(v_c)
+        """Solve for v_c. With the segment times fixed, calc_x() is linear in v_c,
+        so this is exact, rather than a bisection. The result is clamped to
+        0 .. v_max, and update_v_c() puts any remainder in x_err. """
 
-        v_mean = self.x/self.segment.t
-
-        return binary_search(f,0,v_mean,self.joint.v_max )
+        return v_c_for_times(self.x, self.v_0, self.v_1,
+                             self.segment.t_a, self.segment.t_c, self.segment.t_d, self.joint.v_max)
 
     def update_t_min(self):
         '''minimum time to run the segment'''
 
+        key = self.cache.key('t_min', (self.x, self.v_0, self.v_c, self.v_1,
+                                       self.joint.a_max, self.joint.d_max))
+
+        t_a, t_c, t_d, shape = self.cache.solve(key, self._solve_t_min)
+
+        if shape is not None:
+            self.shape = shape
+
+        self.t_min = t_a + t_c + t_d
+        self.min_t_a = t_a
+        self.min_t_c = t_c
+        self.min_t_d = t_d
+
+    def _solve_t_min(self):
+        """Solve the minimum accel, cruise and decel times, and the shape, or None
+        if the shape is unchanged"""
+
         def accel_t_for_x(x, v_0, a_max):
             """Time to cover distance x, at max acceleration
             x = 1/2 at^2 + v_0 t
@@ -221,6 +242,8 @@ class JointSegment(object):
         x_a = int(round((self.v_0 + v_c) * t_a / 2., 0))
         x_d = int(round((self.v_1 + v_c) * t_d / 2., 0))
 
+        shape = None
+
         # Not enough distance to accel to max speed -> triangle profile
         if x_a + x_d > self.x:
             x_a = x_d = self.x / 2 # assumes a_max and d_max are equal!
@@ -228,7 +251,7 @@ class JointSegment(object):
             t_a = accel_t_for_x(x_a, self.v_0, self.joint.a_max)
             t_d = accel_t_for_x(x_d, self.v_1, self.joint.d_max)
 
-            self.shape = TRIANGLE
+            shape = TRIANGLE
 
         x_c = self.x - x_a - x_d
 
@@ -237,10 +260,7 @@ class JointSegment(object):
         except ZeroDivisionError:
             t_c = 0
 
-        self.t_min =   t_a + t_c + t_d
-        self.min_t_a = t_a
-        self.min_t_c = t_c
-        self.min_t_d = t_d
+        return t_a, t_c, t_d, shape
 
     def update_v_c(self):
         """Find a new v_c that satisfies the constraints on t_a, t_c, t_d from
@@ -1,5 +1,7 @@
+from dataclasses import dataclass
 from math import sqrt
 
+from ..exceptions import TrapMathError, LimitError, ShortTimeError
 
 
 @dataclass
@@ -318,6 +320,117 @@ X_LOWER_LIMIT = 10
 
 
 
+def profile_x(t, v_0, v_c, v_1, a):
+    """Distance covered in time t by changing velocity from v_0 to v_c at
+    acceleration a, cruising at v_c, then changing to v_1. Returns the
+    distance and the cruise time; a negative cruise time means t is too
+    short to reach v_c """
+
+    t_a = abs(v_c - v_0) / a
+    t_d = abs(v_c - v_1) / a
+    t_c = t - t_a - t_d
+
+    return (v_0 + v_c) / 2 * t_a + v_c * t_c + (v_c + v_1) / 2 * t_d, t_c
+
+
+def v_c_for_times(x, v_0, v_1, t_a, t_c, t_d, v_max):
+    """Cruise velocity for a block whose acceleration, cruise and deceleration
+    times are already fixed, as in segments.JointSegment. The distance is linear
+    in v_c, so this is exact, and the result is clamped to 0 .. v_max. """
+
+    k = (t_a + t_d) / 2 + t_c  # dx/dv_c
+
+    if k <= 0:
+        return 0  # No time, so v_c doesn't affect the distance
+
+    v_c = (x - v_0 * t_a / 2 - v_1 * t_d / 2) / k
+
+    return min(max(v_c, 0), v_max)
+
+
+# Shape codes for solve_blocks
+SHAPE_ZERO = 0  # No distance, and no velocity
+SHAPE_TRAPEZOID = 1  # Reaches v_max, and cruises
+SHAPE_TRIANGLE = 2  # Triangle or pentagon, turns around below v_max, no cruise
+SHAPE_LIMIT = 3  # Too short to change from v_0 to v_1 within a_max
+
+
+@dataclass
+class Blocks:
+    """Minimum time profiles for arrays of blocks, from solve_blocks.
+    Every field is an array of the broadcast shape of the inputs"""
+    t_a: object
+    t_c: object
+    t_d: object
+    v_c: object
+    x_a: object
+    x_c: object
+    x_d: object
+    shape: object
+
+    @property
+    def t(self):
+        return self.t_a + self.t_c + self.t_d
+
+    @property
+    def x(self):
+        return self.x_a + self.x_c + self.x_d
+
+
+def solve_blocks(x, v_0, v_1, v_max, a_max):
+    """Solve the minimum time profile for many blocks at once. The arguments are
+    arrays, or scalars, which broadcast together, so a sweep over the product
+    of distances and boundary velocities is
+
+        solve_blocks(x[:, None, None], v[None, :, None], v[None, None, :], v_max, a_max)
+
+    Each block accelerates from v_0 to v_c, cruises, and decelerates to v_1. If
+    the block is long enough to reach v_max, it is a trapezoid, otherwise it turns
+    around at the peak velocity, with no cruise. Blocks that are too short to get
+    from v_0 to v_1 at a_max have shape SHAPE_LIMIT and NaN for every value.
+
+    :param x: Distances, as magnitudes
+    :param v_0: Initial velocities
+    :param v_1: Final velocities
+    :param v_max: Velocity limits
+    :param a_max: Acceleration limits
+    :return: a Blocks
+    """
+    import numpy as np
+
+    x, v_0, v_1, v_max, a_max = np.broadcast_arrays(*(np.asarray(e, dtype=float)
+                                                     for e in (x, v_0, v_1, v_max, a_max)))
+    x = np.abs(x)
+
+    # Peak velocity of a profile with no cruise, where the accel and decel lines meet
+    v_peak = np.sqrt(a_max * x + (v_0 ** 2 + v_1 ** 2) / 2)
+    v_c = np.minimum(v_peak, v_max)
+
+    t_a = np.abs(v_c - v_0) / a_max
+    t_d = np.abs(v_c - v_1) / a_max
+    x_a = (v_0 + v_c) / 2 * t_a
+    x_d = (v_c + v_1) / 2 * t_d
+    x_c = x - x_a - x_d
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t_c = np.where(v_c > 0, x_c / v_c, 0)
+
+    trap = v_peak > v_max
+    limit = (v_peak < np.maximum(v_0, v_1)) | (x_c < -1e-9 * np.maximum(x, 1))
+    zero = (x == 0) & (v_0 == 0) & (v_1 == 0)
+
+    # Clear the rounding residue in the cruise of blocks that don't cruise
+    t_c = np.where(trap, t_c, 0)
+    x_c = np.where(trap, x_c, 0)
+
+    shape = np.select([zero, limit, trap], [SHAPE_ZERO, SHAPE_LIMIT, SHAPE_TRAPEZOID],
+                      SHAPE_TRIANGLE).astype(np.int8)
+
+    values = [np.where(limit & ~zero, np.nan, e) for e in (t_a, t_c, t_d, v_c, x_a, x_c, x_d)]
+
+    return Blocks(*values, shape)
+
+
 def triangular_area(v_0, v_1, v_c, a_max):
     """Area of a triangular profile, which accelerates to v_c and
     immediately decelerates"""
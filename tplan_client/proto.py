@@ -1,12 +1,16 @@
 import logging
 import selectors
+import threading
 import time
 from time import time
-from collections import deque
+from collections import deque, OrderedDict
+import numpy as np
 import serial
 from typing import Union, Tuple, List, Any, Dict
 
+from .capture import CaptureWriter, PORT_STEPPER, PORT_ENCODER, DIR_IN, DIR_OUT
 from .messages import *
+from .stats import ProtoStats
 
 logger = logging.getLogger('message')
 
@@ -15,6 +19,8 @@ logger = logging.getLogger('message')
 TIMEBASE = 1_000_000  # microseconds
 N_BIG = 2 ** 32 - 1  # ULONG_MAX
 N_AXES = 6
+BLOCKS_PER_MOVE = 3  # Planner blocks per move, the units of CurrentState.queue_length
+MAX_NACKED = 256  # NACKed seqs kept for wait_acked() and flush(); older ones are dropped
 fp_bits = 8  # Bits in the fraction portion of the floating point representation
 
 TERMINATOR = b'\0'
@@ -62,25 +68,149 @@ class AxisState():
         return f"<AS {d} {self.spos}/{self.epos} hl{self.hl_limit} lh{self.lh_limit}"
 
 
-class SyncProto(object):
+def _n_moves(m):
+    """Number of moves that a sent message adds to the step controller queue"""
+    if isinstance(m, MoveCommand):
+        return 1
+    elif isinstance(m, MoveBatch):
+        return len(m.moves)
+    elif m.code in MOVE_CODES or m.code == CommandCode.SPARSE_MOVE:
+        return 1  # A header standing in for a move, from _next_seq_block() or a replay
+    elif m.code == CommandCode.MOVE_BATCH:
+        return m.payload[0] if m.payload else 0
+    return 0
 
-    def __init__(self,
-                 stepper_port, encoder_port=None, stepper_baud=115200, encoder_baud=115200,
-                 message_callback=None, timeout=.1):
 
-        self.step_ser = serial.Serial(stepper_port, baudrate=stepper_baud, timeout=timeout)
+def _adapt_callback(cb):
+    """Wrap a callback that takes (m), (proto, m) or (proto, m, handled) so
+    it can always be called with all three. """
+    from inspect import signature
 
-        if encoder_port is not None:
-            self.enc_ser = serial.Serial(encoder_port, baudrate=encoder_baud, timeout=timeout)
-        else:
-            self.enc_ser = None
+    n = len(signature(cb).parameters)
+
+    if n == 3:
+        return cb
+    elif n == 2:
+        return lambda p, m, r: cb(p, m)
+    else:
+        return lambda p, m, r: cb(m)
+
+
+class Deframer(object):
+    """Split a serial byte stream into zero-terminated frames and decode them.
+
+    Each read takes every byte that is waiting on the port, so a burst of
+    messages costs one system call. Partial frames are kept until the rest
+    arrives.
+    """
+
+    def __init__(self, decode, stats=None, capture=None):
+        """
+        :param capture: Called with the bytes of each frame, before decoding
+        :type capture: callable
+        """
+        self.decode = decode
+        self.buf = bytearray()
+        self.stats = stats if stats is not None else ProtoStats()
+        self.capture = capture
+
+    def read(self, ser):
+        """Read all waiting bytes from ser and return the decoded messages"""
+        return self.feed(ser.read(ser.in_waiting or 1))
+
+    def frames(self, data):
+        """Add bytes to the buffer and return all complete frames, without decoding
+        them, for batch decoders like EncoderReport.decode_many()"""
+
+        buf = self.buf
+        buf += data
+
+        stats = self.stats
+        stats.bytes_in += len(data)
+
+        frames = []
+        start = 0
+
+        while True:
+            end = buf.find(0, start)
+            if end < 0:
+                break
+
+            if end > start:
+                frame = buf[start:end]
+                if self.capture:
+                    self.capture(frame)
+                frames.append(frame)
+
+            start = end + 1
+
+        if start:
+            del buf[:start]
+
+        stats.frames_in += len(frames)
+
+        return frames
+
+    def feed(self, data):
+        """Add bytes to the buffer and return the messages in all complete frames"""
+
+        stats = self.stats
+        decode = self.decode
+        msgs = []
+
+        for frame in self.frames(data):
+            try:
+                msgs.append(decode(frame))
+            except CRCError as e:
+                stats.crc_errors += 1
+                logger.warning(f"{e} {bytes(frame)}")
+            except Exception as e:
+                stats.decode_errors += 1
+                logger.warning(f"Failed to decode frame: {e} {bytes(frame)}")
+
+        return msgs
+
+
+class ProtoBase(object):
+    """State tracking shared by the synchronous and asyncio clients: applies
+    messages from the step controller and encoders to the current state,
+    and tracks which sent messages are still waiting for an ACK. """
+
+    def __init__(self, message_callback=None, window=1, queue_size=None, ack_timeout=2,
+                 sparse_moves=False):
+        """
+        :param window: Maximum number of sent frames that may be waiting for an ACK
+        :type window: int
+        :param queue_size: Capacity of the step controller's move queue, in the units of
+            CurrentState.queue_length. If set, moves are held back while the reported
+            queue is full.
+        :type queue_size: int
+        :param ack_timeout: Seconds to wait for a free window slot or an ACK
+        :type ack_timeout: number
+        :param sparse_moves: If true, send moves that touch few axes, or have small values,
+            as SPARSE_MOVE frames, with only the non-zero axes. Only for firmware
+            that supports them.
+        :type sparse_moves: bool
+        """
 
         if message_callback is None:
             message_callback = _message_callback
 
         self.message_callback = message_callback
 
-        self.timeout = timeout
+        self.window = window
+        self.queue_size = queue_size
+        self.ack_timeout = ack_timeout
+
+        self.in_flight = OrderedDict()  # seq -> sent message, waiting for ACK
+        self.nacked = OrderedDict()  # seq -> sent message that got a NACK, oldest first
+        self.pending_done = OrderedDict()  # seq -> (code, send_time) of moves waiting for DONE
+
+        self.transport_stats = ProtoStats()
+
+        self.clock = time  # Source of send and recieve times. Replays substitute the capture times
+
+        self.sparse_moves = sparse_moves  # Send moves as SPARSE_MOVE frames, when they are smaller
 
         self.encoder_multipliers = [1] * N_AXES
 
@@ -92,163 +222,679 @@ class SyncProto(object):
 
         self.running = False
 
+        self.axes = []
+
+        self.subscribers = {}  # code -> [(callback, adapted callback)], None for all codes
+        self._message_handlers = self._make_message_handlers()
+
         self._reset_states()
 
+    def _window_open(self, m):
+        """True if there is space in the send window for message m"""
+
+        if len(self.in_flight) >= self.window:
+            return False
+
+        if self.queue_size is not None and isinstance(m, (MoveCommand, MoveBatch)):
+            return self.queue_length + _n_moves(m) * BLOCKS_PER_MOVE <= self.queue_size
+
+        return True
+
+    def _track_ack(self, m):
+        """Remove ACKed or NACKed messages from the in-flight table. The
+        step controller answers in order, so an ACK also covers any earlier
+        messages whose ACK was lost"""
+
+        if m.code == CommandCode.NACK:
+            sent = self.in_flight.pop(m.seq, None)
+            if sent is not None:
+                sent.acked = False
+                sent.nack = m
+                self.nacked[m.seq] = sent
+                if isinstance(sent, MoveBatch):
+                    # The whole frame is rejected, so every move in it is
+                    for seq, mv in zip(sent.seqs, sent.moves):
+                        mv.acked = False
+                        self.nacked[seq] = sent
+                        self.pending_done.pop(seq, None)
+                else:
+                    self.pending_done.pop(m.seq, None)
+                while len(self.nacked) > MAX_NACKED:
+                    self.nacked.popitem(last=False)
+                self.transport_stats.nacks[sent.code] += 1
+                logger.warning(f"NACK for seq {m.seq}: {sent}")
+                self._on_nack(m.seq, sent, m)
+            return
+
+        if m.seq not in self.in_flight:
+            return
+
+        while self.in_flight:
+            seq, sent = self.in_flight.popitem(last=False)
+            sent.acked = True
+            if isinstance(sent, MoveBatch):
+                for mv in sent.moves:
+                    mv.acked = True
+            if seq == m.seq:
+                sent.ack = m
+                self.transport_stats.record_ack(sent.code, sent.send_time, m.recieve_time)
+            self._on_ack(seq, sent, m)
+            if seq == m.seq:
+                break
+
+    def _track_done(self, m):
+        """Record the latency of a DONE, and forget any earlier moves whose DONE was lost"""
+
+        if m.seq not in self.pending_done:
+            return
+
+        while self.pending_done:
+            seq, (code, send_time) = self.pending_done.popitem(last=False)
+            if seq == m.seq:
+                self.transport_stats.record_done(code, send_time, m.recieve_time)
+                break
+
+    def stats(self):
+        """Return transport statistics: bytes and frames in and out, CRC and decode
+        failures, NACKs by code, histograms of the send to ACK and send to DONE
+        latency by code, and of the gaps between ALIVE messages. Latencies are in
+        microseconds. """
+        return self.transport_stats.as_dict()
+
+    def reset_stats(self):
+        self.transport_stats.reset()
+
+    def is_done(self, seq):
+        """True if the step controller has reported DONE for move seq, or a later one"""
+        return self.last_done >= 0 and ((self.last_done - seq) & 0xffff) < 0x8000
+
+    def _on_ack(self, seq, sent, m):
+        """Called when sent message with sequence seq is ACKed by m"""
+        pass
+
+    def _on_nack(self, seq, sent, m):
+        """Called when sent message with sequence seq is NACKed by m"""
+        pass
+
+    def _next_seq(self, m):
+        """Stamp the next sequence number on m and record it as in flight """
+        m.send_time = self.clock()
+
+        if isinstance(m, MoveBatch):
+            # Each move takes a seq, and the frame has the seq of the last one
+            self.seq = (self.seq + len(m.moves)) & 0xffff
+            m.seq = self.seq
+            for seq, mv in zip(m.seqs, m.moves):
+                mv.seq = seq
+                mv.send_time = m.send_time
+                self.pending_done[seq] = (mv.code, m.send_time)
+        else:
+            self.seq = (self.seq + 1) & 0xffff  # seq is a uint16 on the wire
+            m.seq = self.seq
+
+        self.in_flight[m.seq] = m
+
+        if isinstance(m, MoveCommand):
+            self.pending_done[m.seq] = (m.code, m.send_time)
+
+        return m.seq
+
+    def _next_seq_block(self, code, n):
+        """Reserve n consecutive sequence numbers for moves that are sent without
+        a MoveCommand object each, and record them as in flight. One header stands
+        in for all of them in the in-flight table. Returns the first sequence number. """
+
+        first = (self.seq + 1) & 0xffff
+        self.seq = (self.seq + n) & 0xffff
+
+        h = CommandHeader(self.seq, code)
+        h.send_time = self.clock()
+        done = (h.code, h.send_time)
+
+        for i in range(n):
+            seq = (first + i) & 0xffff
+            self.in_flight[seq] = h
+            self.pending_done[seq] = done
+
+        return first
+
+    def _record_write(self, n_frames, n_bytes):
+        self.transport_stats.frames_out += n_frames
+        self.transport_stats.bytes_out += n_bytes
+
+    def _move_command(self, code: int, x: Union[List[Any], Tuple[Any], Dict], t=0):
+        """Build a MoveCommand, converting a dict-based move into an array move."""
+
+        if isinstance(x, dict):
+            x_ = [0] * len(self.axes)
+            for k,v in x.items():
+                assert isinstance(k, int)
+                x_[k] = v
+            x = x_
+
+        m = MoveCommand(code, x, t=t)
+
+        m.done = False
+        m.compact = self.sparse_moves
+
+        return m
+
+    def _make_message_handlers(self):
+        """Build the table of internal handlers for each message code"""
+
+        h = {code: self._handle_state for code in STATE_CODES}
+
+        h[CommandCode.ACK] = self._handle_ack
+        h[CommandCode.ALIVE] = self._handle_alive
+        h[CommandCode.NACK] = self._handle_nack
+        h[CommandCode.ECHO] = self._handle_echo
+        h[CommandCode.ERROR] = self._handle_text
+        h[CommandCode.MESSAGE] = self._handle_text
+
+        for code in CauseCode:
+            if code > CauseCode.START:
+                h[code] = self._handle_encoder
+
+        return h
+
+    def handle_message(self, m):
+
+        m.recieve_time = self.clock()
+
+        d = PAYLOAD_DECODERS.get(m.code)
+        if d is not None:
+            m.payload = d(m.payload)
+
+        f = self._message_handlers.get(m.code)
+
+        return f(m) if f is not None else False
+
+    def _update_last_ack(self, m):
+        # Handle the case where the seq ids wrap around
+        self.last_ack = max( self.last_ack, m.seq) if abs(self.last_ack - m.seq) < 2**15 else m.seq
+
+    def _handle_ack(self, m):
+        self._update_last_ack(m)
+        self._track_ack(m)
+        return self._handle_state(m)
+
+    def _handle_alive(self, m):
+        self._update_last_ack(m)
+        self.transport_stats.record_alive(m.recieve_time)
+        return self._handle_state(m)
+
+    def _handle_nack(self, m):
+        self._update_last_ack(m)
+        self._track_ack(m)
+        return True
+
+    def _handle_echo(self, m):
+        self._update_last_ack(m)
+        self._track_ack(m)
+        return self._handle_text(m)
+
+    def _handle_text(self, m):
+
+        if self.message_callback:
+            m.payload = self.message_callback(self, m)
+
+        return True
+
+    def _handle_state(self, m):
+
+        cs = self.current_state = m.payload
+        self.state_time = m.recieve_time
+        flags = cs.flags
+        self.empty = bool(flags & 2)
+        self.running = bool(flags & 1)
+
+        # Most reports, like ALIVEs while stopped, don't move anything
+        pb = cs.position_bytes()
+        if pb != self._last_position_bytes:
+            self._last_position_bytes = pb
+            for p, ax in zip(cs.positions, self.axis_state):
+                ax.spos = p
+
+        if m.code == CommandCode.EMPTY:
+            self.empty = True;
+        elif m.code == CommandCode.DONE:
+            self.last_done = m.seq
+            self._track_done(m)
+
+        return True
+
+    def _handle_encoder(self, m):
+
+        self.encoder_state = m.encoders
+
+        for i, (es, mult, ax) in enumerate(zip(self.encoder_state, self.encoder_multipliers, self.axis_state)):
+
+            ax.epos = int(round(es.position * mult))
+
+            if i == m.axis_code:
+
+                if es.limit_code == LimitCode.LH:
+                    ax.lh_limit = ax.last_limit = ax.epos
+
+                elif es.limit_code == LimitCode.HL:
+                    ax.hl_limit = ax.last_limit = ax.epos
+
+        return True
+
+    def subscribe(self, cb, *codes):
+        """Register a callback for messages with the given CommandCode or CauseCode
+        values, or for all messages if no codes are given. The callback is called as
+        cb(proto, m, handled), cb(proto, m) or cb(m), depending on how many
+        arguments it takes. SyncProto calls subscribers from update(), and
+        AsyncProto calls them as messages arrive. """
+
+        f = _adapt_callback(cb)
+
+        for code in (codes or (None,)):
+            self.subscribers.setdefault(code, []).append((cb, f))
+
+        return cb
+
+    def unsubscribe(self, cb):
+        """Remove a callback from all of the codes it was registered for"""
+
+        for code, l in list(self.subscribers.items()):
+            l[:] = [e for e in l if e[0] is not cb]
+            if not l:
+                del self.subscribers[code]
+
+    def _dispatch(self, m, r):
+        """Call the subscribers for a message"""
+
+        subscribers = self.subscribers
+
+        if not subscribers:
+            return
+
+        for cb, f in subscribers.get(m.code, ()):
+            f(self, m, r)
+
+        for cb, f in subscribers.get(None, ()):
+            f(self, m, r)
+
+    def _reset_states(self):
+
+        self.axis_state = [AxisState() for _ in range(N_AXES)]
+        self._last_position_bytes = None
+
+        self.current_state = CurrentState()
+        self.state_time = None  # Recieve time of the last state report, None before the first
+        self.encoder_state = [None] * N_AXES
+
+    @property
+    def queue_length(self):
+        """Length of the step controller queue, as last reported, plus the moves
+        sent since that haven't been ACKed, which the report doesn't include yet"""
+        n_moves = sum(_n_moves(e) for e in self.in_flight.values())
+        return self.current_state.queue_length + n_moves * BLOCKS_PER_MOVE
+
+    @property
+    def queue_time(self):
+        return self.current_state.queue_time
+
+class SyncProto(ProtoBase):
+
+    def __init__(self,
+                 stepper_port, encoder_port=None, stepper_baud=115200, encoder_baud=115200,
+                 message_callback=None, timeout=.1, window=1, queue_size=None, ack_timeout=2,
+                 threaded=False, ring_size=1024, capture=None, pool_size=0, sparse_moves=False):
+        """
+        :param threaded: If true, start a reader thread that reads and handles messages
+            continuously. See start_reader()
+        :type threaded: bool
+        :param ring_size: Number of handled messages held for update() and iteration
+            in threaded mode. When full, the oldest messages are dropped.
+        :type ring_size: int
+        :param capture: Path of a file to record all frames to. See start_capture()
+        :type capture: str
+        :param pool_size: If non-zero, recycle up to this many headers of ALIVE, DONE,
+            EMPTY and ZERO messages once update() has passed them to the callbacks and
+            subscribers, which must not keep references to them.
+        :type pool_size: int
+        """
+
+        super().__init__(message_callback, window, queue_size, ack_timeout, sparse_moves)
+
+        self.step_ser = serial.Serial(stepper_port, baudrate=stepper_baud, timeout=timeout)
+
+        if encoder_port is not None:
+            self.enc_ser = serial.Serial(encoder_port, baudrate=encoder_baud, timeout=timeout)
+        else:
+            self.enc_ser = None
+
+        self.timeout = timeout
+
+        self.pool = HeaderPool(pool_size) if pool_size else None
+
+        self.step_deframer = Deframer(self.pool.decode if self.pool else CommandHeader.decode,
+                                      self.transport_stats)
+        self.enc_deframer = Deframer(EncoderReport.decode, self.transport_stats)
+
         self.sel = selectors.DefaultSelector()
 
-        self.sel.register(self.step_ser, selectors.EVENT_READ, self.read_stepper_message)
+        self.sel.register(self.step_ser, selectors.EVENT_READ, self.read_stepper_messages)
 
         if self.enc_ser:
-            self.sel.register(self.enc_ser, selectors.EVENT_READ, self.read_encoder_message)
+            self.sel.register(self.enc_ser, selectors.EVENT_READ, self.read_encoder_messages)
 
-        self.raw_queue = deque()
         self.raw_queue = deque() # handled queue
 
-    def read_stepper_message(self, ser):
-        data = ser.read_until(TERMINATOR)
-        try:
-            m = CommandHeader.decode(data[:-1])
-            return m
-        except Exception as e:
-            print(e, data)
-            return None
+        # Threaded mode. The lock guards the protocol state shared with the reader thread
+        self.lock = threading.RLock()
+        self.rx_cond = threading.Condition(self.lock)
+        self.ring_size = ring_size
+        self.reader_thread = None
+        self.reader_alive = False
+        self.reader_error = None  # Exception that stopped the reader thread
+        self.rx_count = 0  # Messages handled by the reader thread
+        self.rx_seen = 0  # rx_count at the last update_ser()
+        self.rx_dropped = 0  # Messages dropped because the ring was full
 
-    def read_encoder_message(self, ser):
-        data = ser.read_until(TERMINATOR)
-        try:
-            m = EncoderReport.decode(data[:-1])
-            return m
-        except Exception as e:
-            print(e, data)
-            return None
+        self.capture = None
+
+        if capture is not None:
+            self.start_capture(capture)
+
+        if threaded:
+            self.start_reader()
+
+    @property
+    def queue_length(self):
+        # The reader thread pops from in_flight while this iterates it
+        with self.lock:
+            return super().queue_length
+
+    def start_capture(self, path):
+        """Record every frame sent or recieved, with timestamps and port, to a
+        capture file that tplan_client.capture.replay() can play back. """
+
+        self.stop_capture()
+
+        c = self.capture = CaptureWriter(path)
+        self.step_deframer.capture = lambda frame: c.write(PORT_STEPPER, DIR_IN, frame)
+        self.enc_deframer.capture = lambda frame: c.write(PORT_ENCODER, DIR_IN, frame)
+
+        return c
+
+    def stop_capture(self):
+
+        if self.capture is None:
+            return
+
+        self.step_deframer.capture = self.enc_deframer.capture = None
+        self.capture.close()
+        self.capture = None
+
+    def _write(self, b, n_frames=1):
+        """Write encoded frames to the step controller"""
+
+        self.step_ser.write(b)
+        self._record_write(n_frames, len(b))
+
+        if self.capture is not None:
+            self.capture.write_frames(PORT_STEPPER, DIR_OUT, b)
+
+    def start_reader(self):
+        """Start a thread that reads, decodes and handles messages as soon as they
+        arrive, so current_state and axis_state stay fresh while the application
+        is busy. Handled messages go into a ring buffer of ring_size messages; the
+        application consumes them through update(), iteration or the wait methods
+        without touching the ports. """
+
+        if self.reader_thread is not None:
+            return
+
+        with self.lock:
+            self.raw_queue = deque(self.raw_queue, maxlen=self.ring_size)
+            self.reader_error = None
+
+        self.reader_alive = True
+        self.reader_thread = threading.Thread(target=self._reader, name='SyncProto reader', daemon=True)
+        self.reader_thread.start()
+
+    def stop_reader(self):
+        """Stop the reader thread, returning to reading the ports in update_ser()"""
+
+        if self.reader_thread is None:
+            return
+
+        self.reader_alive = False
+        self.reader_thread.join()
+        self.reader_thread = None
+
+    def _reader(self):
+
+        while self.reader_alive:
+            try:
+                for key, mask in self.sel.select(.1):
+                    msgs = key.data(key.fileobj)
+
+                    if not msgs:
+                        continue
+
+                    with self.rx_cond:
+                        self.last_message_time = time()
+
+                        for m in msgs:
+                            r = self.handle_message(m)
+                            if len(self.raw_queue) == self.raw_queue.maxlen:
+                                self.rx_dropped += 1
+                            self.raw_queue.append((m, r))
+
+                        self.rx_count += len(msgs)
+                        self.rx_cond.notify_all()
+
+            except Exception as e:
+                # Stop, and wake the waiters, which raise the error
+                logger.error(f"Reader thread stopped: {e!r}")
+                with self.rx_cond:
+                    self.reader_error = e
+                    self.reader_alive = False
+                    self.rx_cond.notify_all()
+                return
+
+    def read_stepper_messages(self, ser):
+        return self.step_deframer.read(ser)
+
+    def read_encoder_messages(self, ser):
+        return self.enc_deframer.read(ser)
 
     def update_ser(self, timeout=False):
         '''Read all outstanding messages, handle them, and add them to the queue,'''
 
+        if self.reader_thread is not None:
+            return self._wait_reader(timeout)
+
         events = self.sel.select(timeout)
 
         for key, mask in events:
             f, ser = key.data, key.fileobj
-            m = f(ser)
-            if m:
+            msgs = f(ser)
+            if msgs:
                 self.last_message_time = time()
-                if m.code in (CommandCode.ACK, CommandCode.ECHO):
-                    self.last_ack = m.seq
-
-                self.raw_queue.append(m)
+            for m in msgs:
+                r = self.handle_message(m)
+                self.raw_queue.append((m, r))
 
         return len(events)
 
-    def update_ser_until_ack(self, ack_seq):
+    def _wait_reader(self, timeout=False):
+        """In threaded mode, wait for the reader thread to handle new messages.
+        Returns the number of messages handled since the last call. If the reader
+        thread stopped on an error, raises the error. """
 
-        t0 = time()
-        while(time()-t0 < 2):
-            self.update_ser(.2)
-            if self.last_ack == ack_seq:
-                return True
+        with self.rx_cond:
+            if self.rx_count == self.rx_seen and timeout is not False and self.reader_error is None:
+                self.rx_cond.wait(timeout)
 
-        raise TimeoutException(f"Did not get ACK for seq_id {ack_seq}" )
+            if self.reader_error is not None:
+                raise self.reader_error
 
-    def update_ser_until_empty(self):
+            n, self.rx_seen = self.rx_count - self.rx_seen, self.rx_count
 
-        while self.update_ser(.05):
-            pass
+        return n
 
-    def update(self, cb= None, timeout=.5):
-        """ For at least the duration of the timeout, read messages from the
-        serial port andprocess them.
+    def _update_ser_until(self, f, timeout, msg):
+        """Read and handle messages until f() is true, or raise TimeoutException.
+        f() is checked after every read, so this returns as soon as the message
+        that makes it true is handled. A timeout of None waits forever. msg may
+        be a callable, so the message is only built if the timeout expires. """
 
-        :param cb: Callback function for messages
-        :type cb: callable
-        :param timeout: Minimum time, in seconds, to update and process messages
-        :type timeout: number
-        :return: None
-        :rtype:
-        """
-        from inspect import signature
+        def check():
+            with self.lock:
+                return f()
 
-        if timeout is False:
-            timeout == 0
+        deadline = time() + timeout if timeout is not None else None
 
-        t0 = time()
-        while True:
-            self.update_ser_until_empty()
+        while not check():
+            if deadline is None:
+                self.update_ser(None)
+            else:
+                remaining = deadline - time()
+                if remaining < 0:
+                    raise TimeoutException(msg() if callable(msg) else msg)
+                self.update_ser(remaining)
 
-            while (len(self.raw_queue) > 0):
-                m = self.raw_queue.popleft();
+        return True
 
-                r = self.handle_message(m)
+    def wait_until(self, f, timeout=None):
+        """Handle messages until f(current_state) is true, for instance
 
-                if cb:
-                    sig = signature(cb)
-                    if len(sig.parameters) == 3:
-                        cb(self, m, r)
-                    elif len(sig.parameters) == 2:
-                        cb(self, m)
-                    else:
-                        cb(m)
+            p.wait_until(lambda s: s.queue_length <= 6, timeout=5)
 
-            if time()-self.last_message_time>timeout:
-                break;
+        Raises TimeoutException if the timeout expires first. A timeout of None
+        waits forever. """
 
+        return self._update_ser_until(lambda: f(self.current_state), timeout,
+                                      f"Condition not met in {timeout}s")
 
-    def handle_message(self, m):
+    def wait_done(self, seq, timeout=None):
+        """Handle messages until the step controller reports DONE for the move
+        with sequence seq. Raises ProtocolException if the move was NACKed """
 
-        m.recieve_time = time()
-        handled = False
+        self._update_ser_until(lambda: self.is_done(seq) or seq in self.nacked, timeout,
+                               f"Did not get DONE for seq_id {seq}")
 
-        if m.code in (CommandCode.ACK, CommandCode.NACK, CommandCode.ECHO, CommandCode.ALIVE):
-            # Handle the case where the seq ids wrap around
-            self.last_ack = max( self.last_ack, m.seq) if abs(self.last_ack - m.seq) < 2**15 else m.seq
+        if seq in self.nacked:
+            raise ProtocolException(f"Got NACK for {self.nacked.pop(seq)}")
 
-        if m.code in (CommandCode.ERROR, CommandCode.MESSAGE, CommandCode.ECHO):
+        return True
 
-            if self.message_callback:
-                m.payload = self.message_callback(self, m)
-            else:
-                pass
+    def wait_empty(self, timeout=None):
+        """Handle messages until the step controller reports an empty queue"""
 
-            return True
+        return self._update_ser_until(lambda: self.empty, timeout,
+                                      f"Queue not empty after {timeout}s")
 
-        elif m.code in (CommandCode.ACK, CommandCode.DONE, CommandCode.EMPTY,
-                        CommandCode.ZERO, CommandCode.ALIVE):
+    def update_ser_until_ack(self, ack_seq):
+        return self.wait_acked(ack_seq)
 
-            m.payload = self.current_state = CurrentState(m.payload)
-            self.empty = self.current_state.empty
-            self.running = self.current_state.running
+    def wait_acked(self, seq, timeout=None):
+        """Block until the message with sequence seq is ACKed. Raises
+        ProtocolException if it was NACKed"""
 
-            for p, ax in zip(self.current_state.positions, self.axis_state):
-                ax.spos = p
+        self._update_ser_until(lambda: seq not in self.in_flight,
+                               timeout if timeout is not None else self.ack_timeout,
+                               f"Did not get ACK for seq_id {seq}")
+
+        if seq in self.nacked:
+            raise ProtocolException(f"Got NACK for {self.nacked.pop(seq)}")
+
+        return True
+
+    def flush(self, timeout=None):
+        """Block until all sent messages are ACKed. Raises
+        ProtocolException if any were NACKed"""
+
+        self._update_ser_until(lambda: not self.in_flight,
+                               timeout if timeout is not None else self.ack_timeout,
+                               lambda: f"Did not get ACK for seq_ids {list(self.in_flight)}")
+
+        if self.nacked:
+            # A batch is entered once for each of its moves
+            nacked, self.nacked = list({id(e): e for e in self.nacked.values()}.values()), OrderedDict()
+            raise ProtocolException(f"Got NACK for {nacked}")
+
+        return True
+
+    def update_ser_until_empty(self):
+        """Read and handle all messages that are waiting, without blocking"""
+
+        while self.update_ser(0):
+            pass
+
+    def _drain(self, f=None):
+        """Pass the handled messages in the queue to the subscribers and to f"""
 
-            if m.code == CommandCode.EMPTY:
-                self.empty = True;
-            elif m.code == CommandCode.DONE:
-                self.last_done = m.seq
+        pool = self.pool
 
-            return True
+        while (len(self.raw_queue) > 0):
+            m, r = self.raw_queue.popleft();
 
-        elif m.code > CauseCode.START:
+            self._dispatch(m, r)
 
-            self.encoder_state = m.encoders
+            if f:
+                f(self, m, r)
+
+            if pool:
+                pool.release(m)
+
+    def update(self, cb= None, timeout=.5):
+        """ For at least the duration of the timeout, read messages from the
+        serial port andprocess them.
+
+        :param cb: Callback function for messages
+        :type cb: callable
+        :param timeout: Minimum time, in seconds, to update and process messages
+        :type timeout: number
+        :return: None
+        :rtype:
+        """
+        if timeout is False:
+            timeout = 0
+
+        f = _adapt_callback(cb) if cb else None
+
+        while True:
+            self.update_ser_until_empty()
+            self._drain(f)
+
+            remaining = self.last_message_time + timeout - time()
+            if remaining <= 0:
+                break;
 
-            for i, (es, mult, ax) in enumerate(zip(self.encoder_state, self.encoder_multipliers, self.axis_state)):
+            # Block until the next message arrives, or the quiet period ends
+            self.update_ser(remaining)
 
-                ax.epos = int(round(es.position * mult))
+    def _run_until(self, f, cb=None, timeout=False):
+        """Handle messages, passing them to cb, until f() is true or no message
+        has arrived for timeout seconds. A timeout of False or None never expires.
+        Returns True if f() became true. """
 
-                if i == m.axis_code:
+        cb = _adapt_callback(cb) if cb else None
 
-                    if es.limit_code == LimitCode.LH:
-                        ax.lh_limit = ax.last_limit = ax.epos
+        while True:
+            self.update_ser_until_empty()
+            self._drain(cb)
 
-                    elif es.limit_code == LimitCode.HL:
-                        ax.hl_limit = ax.last_limit = ax.epos
+            with self.lock:
+                if f():
+                    return True
 
-            return True
+            if timeout is False or timeout is None:
+                remaining = None
+            else:
+                remaining = self.last_message_time + timeout - time()
+                if remaining <= 0:
+                    return False
 
-        elif m.code in ( CommandCode.NACK, ):
-            return True
+            self.update_ser(remaining)
 
-        return False
 
     def runout(self, cb=None, timeout=False):
 
@@ -268,11 +914,7 @@ class SyncProto(object):
         if not self.running:
             self.run()
 
-        while not self.empty:
-            self.update(cb, .1)
-
-            if time()-self.last_message_time > timeout:
-                break
+        return self._run_until(lambda: self.empty, cb, timeout)
 
     def runlen(self, l, cb=None, timeout=False):
         """ Run until the quelength is less than l, or the timeout expires
@@ -280,7 +922,8 @@ class SyncProto(object):
         :type l:
         :param cb:
         :type cb:
-        :param timeout:
+        :param timeout: Expiration time, measured from the time the last message was recieved.
+            False never expires.
         :type timeout:
         :return:
         :rtype:
@@ -289,22 +932,13 @@ class SyncProto(object):
         if not self.running:
             self.run()
 
-        while self.queue_length > l:
-            self.update(cb, .1)
+        return self._run_until(lambda: self.queue_length <= l, cb, timeout)
 
-            if time() - self.last_message_time > timeout:
-                break
-
-
-    def _reset_states(self):
-
-        self.axis_state = [AxisState() for _ in range(N_AXES)]
-
-        self.current_state = CurrentState()
-        self.encoder_state = [None] * N_AXES
 
     def close(self):
 
+        self.stop_reader()
+        self.stop_capture()
         self.sel.close()
         self.step_ser.close()
         if self.enc_ser:
@@ -315,48 +949,47 @@ class SyncProto(object):
     def iupdate(self, timeout=False):
         t = time()
         while True:
-            self.update_ser()
-            yield from self
+            if timeout is False:
+                self.update_ser(None)
+            else:
+                remaining = t + timeout - time()
+                if remaining < 0:
+                    break
+                self.update_ser(remaining)
 
-            if timeout is not False and time() > t + timeout:
-                break
+            yield from self
 
     def __iter__(self):
 
         while True:
             try:
-                yield self.raw_queue.popleft()
+                yield self.raw_queue.popleft()[0]
             except IndexError:
                 return
 
 
-    @property
-    def queue_length(self):
-        return self.current_state.queue_length
-
-    @property
-    def queue_time(self):
-        return self.current_state.queue_time
-
     # Sending messages to the stepper controller
     #
 
     def send(self, m, timeout=False):
+        """Send a message without waiting for its ACK. If the send window is full,
+        first wait for enough ACKs to open a slot. Use wait_acked() or flush()
+        to wait for the ACK. """
 
-        m.send_time = time()
-        self.seq += 1
-        m.seq = self.seq
+        self._update_ser_until(lambda: self._window_open(m),
+                               timeout if timeout else self.ack_timeout,
+                               lambda: f"Send window did not open for {m}; in flight: {list(self.in_flight)}")
 
-        b = m.encode()
-        self.step_ser.write(b)
+        with self.lock:
+            self._next_seq(m)
 
-        self.update_ser_until_ack(m.seq)
+        self._write(m.encode())
 
         return m
 
 
     def send_command(self, c, payload=None, timeout=False):
-        self.send(CommandHeader(seq=self.seq, code=c, payload=payload), timeout=timeout)
+        return self.send(CommandHeader(seq=self.seq, code=c, payload=payload), timeout=timeout)
 
     def config(self, itr_delay: int = 4, segment_complete_pin=0, limit_hit_pin=0,
                debug_print: bool = False, debug_tick: bool = False,
@@ -375,43 +1008,193 @@ class SyncProto(object):
 
     def _move(self, code: int, x: Union[List[Any], Tuple[Any], Dict], t=0):
 
-        # Convert a dict-based move into an array move.
-        if isinstance(x, dict):
-            x_ = [0] * len(self.axes)
-            for k,v in x.items():
-                assert isinstance(k, int)
-                x_[k] = v
-            x = x_
+        m = self._move_command(code, x, t)
 
-        m = MoveCommand(code, x, t=t)
+        self.send(m)
+        self.empty = False;
 
-        m.done = False
+        return m
 
-        self.current_state.queue_length += 3;
+    def _free_moves(self):
+        """Number of moves that will fit in the step controller queue, or None
+        if the queue size is not known"""
+        if self.queue_size is None:
+            return None
 
-        self.send(m)
-        self.empty = False;
+        return max(self.queue_size - self.queue_length, 0) // BLOCKS_PER_MOVE
+
+    def _wait_for_space(self, remaining, timeout=None):
+        """Wait until there is space in the step controller queue, and return how many
+        of the remaining moves to send next. The ACKs and state reports of earlier
+        chunks keep the queue length current, so chunks pipeline without waiting
+        for a round trip each. """
+
+        if self.queue_size is None:
+            return remaining
+
+        if self.state_time is None:
+            self.flush()  # Nothing reported yet; an ACK brings the queue length
+
+        self._update_ser_until(lambda: self._free_moves() != 0, timeout,
+                               f"No space in queue for {remaining} moves")
+
+        with self.lock:
+            return self._free_moves() or remaining
+
+    def _move_many(self, code: int, moves, t=0, timeout=None):
+        """Send many moves, encoded into one buffer and written at once. If queue_size is
+        set, the moves are written in chunks that fit in the free space in the
+        step controller's queue, waiting for space between chunks.
+
+        :param moves: Sequence of moves, or a 2D array with one move per row
+        :param t: Move time, either one value for all moves or one per move
+        :param timeout: Time to wait for space in the queue, or None to wait forever
+        :return: List of the sent MoveCommands
+        """
+
+        try:
+            ts = list(t)
+        except TypeError:
+            ts = [t] * len(moves)
+
+        ms = [self._move_command(code, x, t_) for x, t_ in zip(moves, ts)]
+
+        i = 0
+        while i < len(ms):
+            n = self._wait_for_space(len(ms) - i, timeout)
+            chunk = ms[i:i + n]
+
+            b = bytearray()
+            with self.lock:
+                for m in chunk:
+                    self._next_seq(m)
+                    m.encode(b)
+
+            self._write(b, len(chunk))
+            self.empty = False
+            i += n
+
+        self._wait_bulk_acked([m.seq for m in ms])
+
+        return ms
+
+    def move_array(self, code: int, moves, timeout=None):
+        """Send an array of moves that all have the same code, encoded in bulk
+        with encode_move_array() and written with one write per chunk, as
+        in _move_many().
+
+        :param code: Move CommandCode
+        :param moves: (N, 7) array of [t, x0 .. x5], with t in integer microseconds
+        :param timeout: Time to wait for space in the queue, or None to wait forever
+        :return: Array of the sequence numbers of the moves
+        """
+
+        moves = np.asarray(moves)
+        seqs = np.empty(len(moves), dtype=np.uint16)
+
+        i = 0
+        while i < len(moves):
+            n = self._wait_for_space(len(moves) - i, timeout)
+            chunk = moves[i:i + n]
+
+            with self.lock:
+                seq = self._next_seq_block(code, len(chunk))
+                b = encode_move_array(code, chunk, seq)
+
+            seqs[i:i + len(chunk)] = (seq + np.arange(len(chunk))) & 0xffff
+
+            self._write(b, len(chunk))
+            self.empty = False
+            i += len(chunk)
+
+        self._wait_bulk_acked(seqs.tolist())
+
+        return seqs
+
+    def move_batch(self, moves, timeout=None):
+        """Send moves in MOVE_BATCH frames of up to MAX_BATCH moves each, so
+        each frame carries several moves and gets one ACK. The moves can mix
+        codes and times. As in _move_many(), the frames are written together, in
+        chunks that fit the step controller's queue.
+
+        :param moves: Sequence of MoveCommands, or of (code, x, t) tuples
+        :param timeout: Time to wait for space in the queue, or None to wait forever
+        :return: List of the sent MoveCommands, with their sequence numbers set
+        """
+
+        ms = [m if isinstance(m, MoveCommand) else self._move_command(*m) for m in moves]
+
+        i = 0
+        while i < len(ms):
+            n = self._wait_for_space(len(ms) - i, timeout)
+            chunk = ms[i:i + n]
+
+            b = bytearray()
+            with self.lock:
+                batches = [MoveBatch(chunk[j:j + MAX_BATCH]) for j in range(0, len(chunk), MAX_BATCH)]
+                for mb in batches:
+                    self._next_seq(mb)
+                    mb.encode(b)
+
+            self._write(b, len(batches))
+            self.empty = False
+            i += n
+
+        self._wait_bulk_acked([m.seq for m in ms])
+
+        return ms
+
+    def _wait_bulk_acked(self, seqs):
+        """Wait for the ACK of the last of seqs, which the step controller sends after
+        answering all of the others, then raise ProtocolException if any of them
+        were NACKed"""
+
+        if not seqs:
+            return
+
+        last = seqs[-1]
+        self._update_ser_until(lambda: last not in self.in_flight, self.ack_timeout,
+                               f"Did not get ACK for seq_id {last}")
+
+        with self.lock:
+            rejected = [seq for seq in seqs if self.nacked.pop(seq, None) is not None]
+
+        if rejected:
+            raise ProtocolException(f"Got NACK for {len(rejected)} of {len(seqs)} moves, seqs {rejected}")
+
+    def amove_many(self, moves, timeout=None):
+        """Absolute position moves, for a sequence or 2D array of moves"""
+        return self._move_many(CommandCode.AMOVE, moves, t=0, timeout=timeout)
+
+    def rmove_many(self, moves, timeout=None):
+        """Relative position moves, for a sequence or 2D array of moves"""
+        return self._move_many(CommandCode.RMOVE, moves, t=0, timeout=timeout)
+
+    def vmove_many(self, t, moves, timeout=None):
+        """Velocity moves, for a sequence or 2D array of moves. t is either a single
+        move time or a sequence of times, one per move. """
+        return self._move_many(CommandCode.VMOVE, moves, t=t, timeout=timeout)
 
     def amove(self, x: Union[List[Any], Tuple[Any], Dict]):
         """Absolute position move"""
-        self._move(CommandCode.AMOVE, x, t=0)
+        return self._move(CommandCode.AMOVE, x, t=0)
 
     def rmove(self, x: Union[List[Any], Tuple[Any], Dict]):
         "Relative position move"
-        self._move(CommandCode.RMOVE, x, t=0)
+        return self._move(CommandCode.RMOVE, x, t=0)
 
     def hmove(self, x: Union[List[Any], Tuple[Any], Dict]):
         "A homing move, which will stop when it gets to a limit. "
-        self._move(CommandCode.HMOVE, x, t=0)
+        return self._move(CommandCode.HMOVE, x, t=0)
 
     def vmove(self, t: float, x: Union[List[Any], Tuple[Any], Dict]):
         "A velocity move "
-        self._move(CommandCode.VMOVE, x, t=t)
+        return self._move(CommandCode.VMOVE, x, t=t)
 
     def jog(self, t: float, x: Union[List[Any], Tuple[Any], Dict]):
         """Jog move. A jog move replaces the last move on the (step generator side)
         planner, then becomes a regular relative move. """
-        self._move(CommandCode.JMOVE, x, t=t)
+        return self._move(CommandCode.JMOVE, x, t=t)
 
     def echo(self, payload='Echo'):
         self.running = True
@@ -436,6 +1219,7 @@ class SyncProto(object):
     def reset(self):
         self.runout()
         self._reset_states()
+        self.pending_done.clear()
         self.send_command(CommandCode.RESET)
         self.runout()
 
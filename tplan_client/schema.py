@@ -0,0 +1,212 @@
+"""Declarative layouts for the message payloads.
+
+Each Schema lists the fields of a payload in wire order. From the field
+list, it builds a precompiled struct.Struct and generates, at import
+time, specialized functions to get the values to pack from a message
+object, and to unpack a payload into a dict of fields:
+
+    MOVE.values(m)      # (m.t, *m.x)
+    MOVE.unpack(b)      # {'t': ..., 'x': [...]}
+    MOVE.random_values(rng)  # Random, valid values, for fuzzing
+
+messages.py maps each CommandCode and CauseCode to its schema.
+
+A field is (name, format), where format is a struct format character,
+optionally with a count, like 'I' or '6i'. Fields with a count are
+sequences, and fields whose names start with '_' are padding, packed
+as zeros.
+"""
+
+import random
+import struct
+
+
+class Field(object):
+
+    def __init__(self, name, fmt):
+        self.name = name
+        self.fmt = fmt
+        self.type = fmt[-1]
+        self.count = int(fmt[:-1]) if len(fmt) > 1 else 1
+        self.is_array = len(fmt) > 1
+
+        self.offset = None  # Byte offset in the payload, set by the Schema
+        self.struct = None  # struct.Struct for just this field
+
+    @property
+    def is_padding(self):
+        return self.name.startswith('_')
+
+    def limits(self):
+        """Smallest and largest values of the field's type"""
+        if self.type == '?':
+            return 0, 1
+
+        bits = struct.calcsize(self.type) * 8
+
+        if self.type.islower():
+            return -(1 << (bits - 1)), (1 << (bits - 1)) - 1
+        else:
+            return 0, (1 << bits) - 1
+
+    def __repr__(self):
+        return f"Field({self.name!r}, {self.fmt!r})"
+
+
+class Schema(object):
+
+    def __init__(self, name, fields, byte_order='<'):
+        """
+        :param name: Name of the layout
+        :param fields: Sequence of (name, format) pairs, in wire order
+        :param byte_order: struct byte order character. '<' for the step controller,
+            '@' for structs sent with C alignment
+        """
+        self.name = name
+        self.fields = [Field(n, f) for n, f in fields]
+        self.fmt = byte_order + ''.join(f.fmt for f in self.fields)
+        self.struct = struct.Struct(self.fmt)
+        self.size = self.struct.size
+
+        prefix = byte_order
+        for f in self.fields:
+            f.struct = struct.Struct(byte_order + f.fmt)
+            # The size of the preceding fields plus this one, less this one, includes any alignment
+            f.offset = struct.calcsize(prefix + f.fmt) - f.struct.size
+            prefix += f.fmt
+
+        self.by_name = {f.name: f for f in self.fields}
+
+        self.values = self._make_values()
+        self.unpack = self._make_unpack()
+
+    def _compile(self, name, src):
+        ns = {'_unpack': self.struct.unpack}
+        exec(compile(src, f"<schema {self.name}.{name}>", 'exec'), ns)
+        return ns[name]
+
+    def _make_values(self):
+        """Generate values(o), which returns the tuple to pack for the object o"""
+
+        parts = []
+        for f in self.fields:
+            if f.is_padding:
+                parts.extend(['0'] * f.count)
+            elif f.is_array:
+                parts.append(f"*o.{f.name}")
+            else:
+                parts.append(f"o.{f.name}")
+
+        return self._compile('values', f"def values(o):\n    return ({', '.join(parts)},)\n")
+
+    def _make_unpack(self):
+        """Generate unpack(b), which returns a dict of the fields in the payload b"""
+
+        items = []
+        i = 0
+        for f in self.fields:
+            if not f.is_padding:
+                if f.is_array:
+                    items.append(f"{f.name!r}: list(v[{i}:{i + f.count}])")
+                else:
+                    items.append(f"{f.name!r}: v[{i}]")
+            i += f.count
+
+        return self._compile('unpack', f"def unpack(b):\n    v = _unpack(b)\n"
+                                        f"    return {{{', '.join(items)}}}\n")
+
+    def __getitem__(self, name):
+        return self.by_name[name]
+
+    def pack(self, o):
+        """Pack the fields of the object o into a payload"""
+        return self.struct.pack(*self.values(o))
+
+    def random_values(self, rng=random):
+        """Random values, in the range of each field's type, ready to pack"""
+
+        v = []
+        for f in self.fields:
+            if f.is_padding:
+                v.extend([0] * f.count)
+            else:
+                lo, hi = f.limits()
+                v.extend(rng.randint(lo, hi) for _ in range(f.count))
+
+        return tuple(v)
+
+    def random_payload(self, rng=random):
+        return self.struct.pack(*self.random_values(rng))
+
+    def __repr__(self):
+        return f"<Schema {self.name} {self.fmt} {self.size} bytes>"
+
+
+HEADER = Schema('Header', [
+    ('seq', 'H'),
+    ('code', 'B'),
+    ('crc', 'B')  # CRC8 of the header and payload, calculated with zero here
+])
+
+MOVE = Schema('Move', [
+    ('t', 'I'),  # segment_time, microseconds
+    ('x', '6i')  # steps
+])
+
+# One move in a MOVE_BATCH payload, which is a uint8 count followed by the moves
+MOVE_BATCH_ITEM = Schema('BatchMove', [
+    ('code', 'B'),  # move CommandCode
+    ('t', 'I'),
+    ('x', '6i')
+])
+
+# The fixed part of a SPARSE_MOVE payload. It is followed by the values of the
+# axes in the mask, as int8, int16 or int32
+SPARSE_MOVE_HEAD = Schema('SparseMove', [
+    ('code', 'B'),  # move CommandCode
+    ('mask', 'B'),  # axis bitmask in the low six bits, value width code in the top two
+    ('t', 'I')
+])
+
+AXIS_CONFIG = Schema('AxisConfig', [
+    ('axis_num', 'B'),
+    ('step_pin', 'B'),
+    ('direction_pin', 'B'),
+    ('enable_pin', 'B'),
+    ('high_value', '3B'),  # High or Low for step, direction and enable
+    ('output_mode', '3B'),  # Output mode, OUTPUT or OUTPUT_OPENDRAIN
+    ('_padding', '2B'),
+    ('v_max', 'I'),
+    ('a_max', 'I')
+])
+
+CONFIG = Schema('Config', [
+    ('n_axes', 'B'),
+    ('itr_delay', 'B'),  # interrupt_delay
+    ('segment_complete_pin', 'B'),
+    ('limit_hit_pin', 'B'),
+    ('yellow_led_pin', 'B'),
+    ('blue_led_pin', 'B'),
+    ('running_led_pin', 'B'),
+    ('empty_led_pin', 'B'),
+    ('builtin_led_pin', 'B'),
+    ('debug_print', 'B'),
+    ('debug_tick', 'B')
+])
+
+CURRENT_STATE = Schema('CurrentState', [
+    ('queue_length', 'i'),
+    ('queue_time', 'I'),
+    ('positions', '6i'),  # stepper positions
+    ('planner_positions', '6i'),
+    ('flags', 'I')
+])
+
+# Encoder reports are whole frames, with no CommandHeader, sent with C alignment
+ENCODER_REPORT = Schema('EncoderReport', [
+    ('seq', 'H'),
+    ('code', 'B'),
+    ('axis', 'b'),  # axis index, one based, 0 for none
+    ('limit_states', '6B'),
+    ('positions', '6i')
+], byte_order='@')
@@ -0,0 +1,346 @@
+"""A step controller simulator, for exercising the protocol without hardware.
+
+The simulator opens a pseudo-terminal pair and speaks the same COBS/CRC8
+framed protocol as the firmware, so a SyncProto or AsyncProto can connect
+to it by port name:
+
+    with StepperSimulator() as sim:
+        p = SyncProto(sim.port)
+        p.config(axes=axes)
+        p.rmove((1000,))
+        p.runempty()
+
+Moves are not stepped; each one takes the time of a trapezoidal profile
+on its longest axis, and the positions jump to the end of the move when
+it is DONE. Run `python -m tplan_client.simulator` to serve a simulator
+for other processes.
+"""
+
+import os
+import pty
+import select
+import threading
+import tty
+from collections import deque
+from math import sqrt
+from time import time, sleep
+
+from .messages import *
+from .proto import N_AXES, BLOCKS_PER_MOVE
+
+DEFAULT_V_MAX = 5_000  # steps per second, for axes that have not been configured
+DEFAULT_A_MAX = 50_000  # steps per second^2
+
+
+def move_time(x, v_max, a_max):
+    """Time, in seconds, for a trapezoidal profile that starts and ends at rest"""
+
+    x = abs(x)
+
+    if x == 0:
+        return 0
+
+    x_ad = v_max ** 2 / a_max  # Distance to accelerate to v_max and back down
+
+    if x < x_ad:
+        return 2 * sqrt(x / a_max)
+    else:
+        return 2 * v_max / a_max + (x - x_ad) / v_max
+
+
+class SimMove(object):
+
+    def __init__(self, seq, dx, t):
+        self.seq = seq
+        self.dx = dx  # Relative steps, per axis
+        self.t = t  # Run time, seconds
+        self.remaining = t
+
+
+class StepperSimulator(object):
+
+    def __init__(self, time_scale=1.0, alive_interval=1.0, queue_size=None):
+        """
+        :param time_scale: Simulated seconds per wall clock second. Larger values
+            make moves finish faster.
+        :type time_scale: float
+        :param alive_interval: Seconds between ALIVE messages, or None for none
+        :type alive_interval: float
+        :param queue_size: Capacity of the move queue, in planner blocks. Moves that
+            would overfill the queue are NACKed.
+        :type queue_size: int
+        """
+
+        self.time_scale = time_scale
+        self.alive_interval = alive_interval
+        self.queue_size = queue_size
+
+        self.master_fd, self.slave_fd = pty.openpty()
+        tty.setraw(self.slave_fd)
+        self.port = os.ttyname(self.slave_fd)
+
+        self.lock = threading.RLock()
+        self.thread = None
+        self.alive = False
+
+        self.frames_in = 0
+        self.frames_out = 0
+        self.crc_errors = 0
+
+        self.reset()
+
+    def reset(self):
+
+        with self.lock:
+            self.n_axes = N_AXES
+            self.axes = {}  # axis number -> (v_max, a_max)
+            self.queue = deque()
+            self.running = False
+            self.positions = [0] * N_AXES
+            self.planner_positions = [0] * N_AXES
+            self.last_seq = 0
+
+    # Running the simulator
+    #
+
+    def start(self):
+        self.alive = True
+        self.thread = threading.Thread(target=self._run, name='StepperSimulator', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.alive = False
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    def close(self):
+        self.stop()
+        os.close(self.master_fd)
+        os.close(self.slave_fd)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _run(self):
+
+        buf = bytearray()
+        last_t = last_alive = time()
+
+        while self.alive:
+
+            r, _, _ = select.select([self.master_fd], [], [], self._next_wakeup())
+
+            now = time()
+            self._advance((now - last_t) * self.time_scale)
+            last_t = now
+
+            if r:
+                buf += os.read(self.master_fd, 4096)
+
+                while True:
+                    i = buf.find(0)
+                    if i < 0:
+                        break
+                    frame, buf = bytes(buf[:i]), buf[i + 1:]
+                    if frame:
+                        self._handle_frame(frame)
+
+            if self.alive_interval is not None and now - last_alive >= self.alive_interval:
+                last_alive = now
+                self.send(CommandCode.ALIVE, self.last_seq)
+
+    def _next_wakeup(self):
+        """Seconds until the simulator next needs to act on its own"""
+
+        t = self.alive_interval if self.alive_interval is not None else .1
+
+        with self.lock:
+            if self.running and self.queue:
+                t = min(t, self.queue[0].remaining / self.time_scale)
+
+        return max(t, 0)
+
+    def _advance(self, dt):
+        """Run the queue forward by dt simulated seconds"""
+
+        with self.lock:
+            while self.running and self.queue and dt > 0:
+                m = self.queue[0]
+
+                if m.remaining > dt:
+                    m.remaining -= dt
+                    break
+
+                dt -= m.remaining
+                self.queue.popleft()
+                self.positions = [p + x for p, x in zip(self.positions, m.dx)]
+
+                self.send(CommandCode.DONE, m.seq)
+
+                if not self.queue:
+                    self.send(CommandCode.EMPTY, m.seq)
+
+    # Messages
+    #
+
+    def current_state(self):
+
+        with self.lock:
+            cs = CurrentState()
+            cs.queue_length = len(self.queue) * BLOCKS_PER_MOVE
+            cs.queue_time = int(round(sum(m.remaining for m in self.queue) * TIMEBASE))
+            cs.positions = self.positions
+            cs.planner_positions = self.planner_positions
+            cs.flags = int(self.running) | (int(not self.queue) << 1)
+
+            return cs
+
+    def send(self, code, seq, payload=None):
+
+        if payload is None:
+            payload = self.current_state().pack()
+
+        os.write(self.master_fd, CommandHeader(seq, code, payload=payload).encode())
+        self.frames_out += 1
+
+    def _handle_frame(self, frame):
+
+        self.frames_in += 1
+
+        try:
+            h = CommandHeader.decode(frame)
+        except CRCError:
+            self.crc_errors += 1
+            return
+        except Exception:
+            return
+
+        self.last_seq = h.seq
+
+        try:
+            self.handle_command(h)
+        except Exception as e:
+            self.send(CommandCode.ERROR, h.seq, str(e).encode('ascii', 'replace'))
+            self.send(CommandCode.NACK, h.seq)
+
+    def handle_command(self, h):
+
+        code = h.code
+
+        if code in MOVE_CODES or code in (CommandCode.MOVE_BATCH, CommandCode.SPARSE_MOVE):
+            if not self.queue_move(h):
+                self.send(CommandCode.NACK, h.seq)
+                return
+
+        elif code == CommandCode.ECHO:
+            self.send(CommandCode.ECHO, h.seq, bytes(h.payload))
+            return
+
+        elif code == CommandCode.RUN:
+            self.running = True
+        elif code == CommandCode.STOP:
+            self.running = False
+        elif code == CommandCode.RESET:
+            self.reset()
+        elif code == CommandCode.ZERO:
+            with self.lock:
+                self.positions = [0] * N_AXES
+                self.planner_positions = [0] * N_AXES
+            self.send(CommandCode.ACK, h.seq)
+            self.send(CommandCode.ZERO, h.seq)
+            return
+
+        elif code == CommandCode.CONFIG:
+            self.n_axes = h.payload[0]
+
+        elif code == CommandCode.AXES:
+            ac = PAYLOAD_SCHEMAS[code].unpack(h.payload)
+            self.axes[ac['axis_num']] = (ac['v_max'], ac['a_max'])
+
+        elif code == CommandCode.INFO:
+            cs = self.current_state()
+            self.send(CommandCode.MESSAGE, h.seq,
+                      f"n_axes={self.n_axes} running={self.running} {cs}".encode('ascii'))
+
+        elif code not in (CommandCode.NOOP, CommandCode.QUEUE):
+            self.send(CommandCode.NACK, h.seq)
+            return
+
+        self.send(CommandCode.ACK, h.seq)
+
+    def queue_move(self, h):
+        """Add a move, or all of the moves in a batch, to the queue. Returns False,
+        and queues nothing, if they don't all fit"""
+
+        if h.code == CommandCode.MOVE_BATCH:
+            moves = MoveBatch.unpack_moves(h.payload)
+            first = h.seq - len(moves) + 1
+            for i, mv in enumerate(moves):
+                mv['seq'] = (first + i) & 0xffff
+                if mv['code'] not in MOVE_CODES:
+                    raise BadMoveCodeError(f"Bad code {mv['code']} in batch")
+        elif h.code == CommandCode.SPARSE_MOVE:
+            mv = MoveCommand.unpack_sparse(h.payload)
+            mv['seq'] = h.seq
+            if mv['code'] not in MOVE_CODES:
+                raise BadMoveCodeError(f"Bad code {mv['code']} in sparse move")
+            moves = [mv]
+        else:
+            mv = PAYLOAD_SCHEMAS[h.code].unpack(h.payload)
+            mv['seq'], mv['code'] = h.seq, h.code
+            moves = [mv]
+
+        with self.lock:
+
+            if self.queue_size is not None and \
+                    (len(self.queue) + len(moves)) * BLOCKS_PER_MOVE > self.queue_size:
+                return False
+
+            for mv in moves:
+                t, x = mv['t'], mv['x']
+
+                if mv['code'] == CommandCode.AMOVE:
+                    dx = [a - p for a, p in zip(x, self.planner_positions)]
+                else:
+                    dx = x
+
+                if t > 0:
+                    t = t / TIMEBASE
+                else:
+                    t = max(move_time(e, *self.axes.get(i, (DEFAULT_V_MAX, DEFAULT_A_MAX)))
+                            for i, e in enumerate(dx))
+
+                self.planner_positions = [p + e for p, e in zip(self.planner_positions, dx)]
+                self.queue.append(SimMove(mv['seq'], dx, t))
+
+        return True
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Run a simulated step controller on a pseudo-terminal')
+    parser.add_argument('-s', '--time-scale', type=float, default=1.0,
+                        help='Simulated seconds per wall clock second')
+    parser.add_argument('-a', '--alive', type=float, default=1.0,
+                        help='Seconds between ALIVE messages')
+    parser.add_argument('-q', '--queue-size', type=int, default=None,
+                        help='Capacity of the move queue, in planner blocks')
+    args = parser.parse_args()
+
+    with StepperSimulator(args.time_scale, args.alive, args.queue_size) as sim:
+        print(sim.port, flush=True)
+        try:
+            while True:
+                sleep(1)
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+"""Latency histograms and transport counters for the protocol clients.
+
+Recording is a few integer operations per message, so the statistics can
+stay on in production.
+"""
+
+from collections import defaultdict
+
+
+class Histogram(object):
+    """A log-linear histogram of integer values, in the style of HdrHistogram.
+
+    Values below 2**sub_bits are counted exactly; above that, each power of
+    two is split into 2**sub_bits buckets, so every bucket is within
+    1/2**sub_bits of the values it holds. With the default of 4 sub-bucket
+    bits, values are recorded to within about 6%. """
+
+    def __init__(self, sub_bits=4, max_bits=32):
+        self.sub_bits = sub_bits
+        self.sub_count = 1 << sub_bits
+        self.counts = [0] * ((max_bits - sub_bits + 1) * self.sub_count)
+
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def index(self, v):
+        """Bucket index for value v"""
+
+        if v < self.sub_count:
+            return v
+
+        shift = v.bit_length() - self.sub_bits - 1
+
+        return (shift + 1) * self.sub_count + (v >> shift) - self.sub_count
+
+    def bucket_range(self, i):
+        """Lowest and highest values that go into bucket i"""
+
+        if i < self.sub_count:
+            return i, i
+
+        shift = i // self.sub_count - 1
+        low = (self.sub_count + i % self.sub_count) << shift
+
+        return low, low + (1 << shift) - 1
+
+    def record(self, v):
+
+        v = int(v)
+        if v < 0:
+            v = 0
+
+        i = self.index(v)
+        if i >= len(self.counts):
+            i = len(self.counts) - 1
+
+        self.counts[i] += 1
+        self.count += 1
+        self.total += v
+
+        if self.min is None or v < self.min:
+            self.min = v
+        if self.max is None or v > self.max:
+            self.max = v
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    def percentile(self, p):
+        """Value at percentile p, 0-100, as the top of the bucket that holds it"""
+
+        if not self.count:
+            return None
+
+        target = max(1, round(self.count * p / 100))
+        seen = 0
+
+        for i, c in enumerate(self.counts):
+            seen += c
+            if seen >= target:
+                return min(self.bucket_range(i)[1], self.max)
+
+        return self.max
+
+    def buckets(self):
+        """Yield (low, high, count) for the non-empty buckets"""
+        for i, c in enumerate(self.counts):
+            if c:
+                yield (*self.bucket_range(i), c)
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'min': self.min,
+            'max': self.max,
+            'mean': self.mean,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'buckets': list(self.buckets())
+        }
+
+    def __str__(self):
+        return f"<Histogram n={self.count} p50={self.percentile(50)} p99={self.percentile(99)} max={self.max}>"
+
+
+class ProtoStats(object):
+    """Transport counters and latency histograms for a protocol client.
+    Latencies and ALIVE gaps are in microseconds. """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+
+        self.bytes_in = 0
+        self.frames_in = 0
+        self.bytes_out = 0
+        self.frames_out = 0
+
+        self.crc_errors = 0
+        self.decode_errors = 0
+
+        self.nacks = defaultdict(int)  # CommandCode -> count
+
+        self.ack_latency = defaultdict(Histogram)  # CommandCode -> send to ACK
+        self.done_latency = defaultdict(Histogram)  # CommandCode -> send to DONE
+        self.alive_gap = Histogram()
+
+        self.last_alive = None
+
+    def record_ack(self, code, send_time, recieve_time):
+        self.ack_latency[code].record((recieve_time - send_time) * 1e6)
+
+    def record_done(self, code, send_time, recieve_time):
+        self.done_latency[code].record((recieve_time - send_time) * 1e6)
+
+    def record_alive(self, recieve_time):
+        if self.last_alive is not None:
+            self.alive_gap.record((recieve_time - self.last_alive) * 1e6)
+        self.last_alive = recieve_time
+
+    def as_dict(self):
+        return {
+            'bytes_in': self.bytes_in,
+            'frames_in': self.frames_in,
+            'bytes_out': self.bytes_out,
+            'frames_out': self.frames_out,
+            'crc_errors': self.crc_errors,
+            'decode_errors': self.decode_errors,
+            'nacks': {str(k): v for k, v in self.nacks.items()},
+            'ack_latency': {str(k): v.as_dict() for k, v in self.ack_latency.items()},
+            'done_latency': {str(k): v.as_dict() for k, v in self.done_latency.items()},
+            'alive_gap': self.alive_gap.as_dict()
+        }
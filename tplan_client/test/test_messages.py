@@ -0,0 +1,332 @@
+import struct
+import unittest
+
+from tplan_client.messages import *
+from tplan_client.proto import Deframer
+from tplan_client.test import make_axes
+
+
+class TestMessages(unittest.TestCase):
+    """Encoding and decoding tests that don't need a serial port"""
+
+    def test_deframer(self):
+
+        frames = [CommandHeader(i, CommandCode.ALIVE, payload=CurrentState().pack()).encode()
+                  for i in range(10)]
+        data = b''.join(frames)
+
+        d = Deframer(CommandHeader.decode)
+
+        # Split the stream at an awkward place, in the middle of a frame
+        cut = len(frames[0]) + 5
+        msgs = d.feed(data[:cut])
+        self.assertEqual([0], [m.seq for m in msgs])
+        self.assertEqual(5, len(d.buf))
+
+        msgs = d.feed(data[cut:])
+        self.assertEqual(list(range(1, 10)), [m.seq for m in msgs])
+        self.assertEqual(0, len(d.buf))
+
+    def test_deframer_bad_frame(self):
+
+        good = CommandHeader(1, CommandCode.ACK, payload=CurrentState().pack()).encode()
+        bad = bytearray(good)
+        bad[4] ^= 0xff
+
+        d = Deframer(CommandHeader.decode)
+        msgs = d.feed(bytes(bad) + b'\0\0' + good)
+
+        self.assertEqual([1], [m.seq for m in msgs])
+
+    def test_encode(self):
+
+        ms = [MoveCommand(CommandCode.VMOVE, [100, -200, 0, 5], t=.25),
+              CommandHeader(7, CommandCode.ECHO, payload='Some text'),
+              CommandHeader(8, CommandCode.RUN),
+              ConfigCommand(3, 4)] + make_axes(800, .1, usteps=16)['axes3']
+
+        for i, m in enumerate(ms):
+            m.seq = 1000 + i
+
+        frames = [m.encode() for m in ms]
+
+        for m, f in zip(ms, frames):
+            self.assertEqual(0, f[-1])
+            self.assertNotIn(0, f[:-1])
+
+            h = CommandHeader.decode(f[:-1])
+            self.assertEqual((m.seq, m.code), (h.seq, h.code))
+
+        h = CommandHeader.decode(frames[0][:-1])
+        self.assertEqual(MoveCommand.size, len(h.payload))
+        self.assertEqual(ms[0].pack(), h.payload)
+        self.assertEqual(b'Some text', CommandHeader.decode(frames[1][:-1]).payload)
+        self.assertEqual(ms[3].pack(), CommandHeader.decode(frames[3][:-1]).payload)
+        self.assertEqual(ms[4].pack(), CommandHeader.decode(frames[4][:-1]).payload)
+
+        # Appending to a buffer gives the same bytes as separate frames
+        b = bytearray()
+        for m in ms:
+            self.assertIs(b, m.encode(b))
+
+        self.assertEqual(b''.join(frames), bytes(b))
+
+    def test_sparse_move(self):
+
+        cases = [([100], 1), ([0, -300, 0, 0, 2], 2), ([0, 0, 0, 0, 0, 70_000], 4), ([], 1)]
+
+        for x, width in cases:
+            m = MoveCommand(CommandCode.JMOVE, x, t=.01)
+            m.seq = 7
+            dense = m.encode()
+
+            m.compact = True
+            f = m.encode()
+            n = sum(1 for v in x if v)
+            self.assertEqual(len(dense) - MoveCommand.size + 6 + n * width, len(f), x)
+
+            h = CommandHeader.decode(f[:-1])
+            self.assertEqual((7, CommandCode.SPARSE_MOVE), (h.seq, h.code))
+            self.assertEqual({'code': CommandCode.JMOVE, 't': 10_000, 'x': list(m.x)},
+                             MoveCommand.unpack_sparse(h.payload))
+
+        # All six axes at full width is smaller as a plain move
+        m = MoveCommand(CommandCode.RMOVE, [100_000] * 6)
+        m.compact = True
+        self.assertEqual(CommandCode.RMOVE, CommandHeader.decode(m.encode()[:-1]).code)
+
+        with self.assertRaises(SerialPacketError):
+            MoveCommand.unpack_sparse(h.payload[:-1])
+
+    def test_move_batch(self):
+
+        ms = [MoveCommand(CommandCode.RMOVE, [1, 2, 3]),
+              MoveCommand(CommandCode.VMOVE, [-4, 5], t=.25),
+              MoveCommand(CommandCode.AMOVE, [0, 0, 0, 0, 0, 7])]
+
+        mb = MoveBatch(ms, seq=1)  # Wraps around; the moves take seqs 0xffff, 0 and 1
+        self.assertEqual([0xffff, 0, 1], mb.seqs)
+
+        f = mb.encode()
+        self.assertEqual(1, f.count(0))
+
+        h = CommandHeader.decode(f[:-1])
+        self.assertEqual((1, CommandCode.MOVE_BATCH), (h.seq, h.code))
+        self.assertEqual([(m.code, m.t, list(m.x)) for m in ms],
+                         [(d['code'], d['t'], d['x']) for d in MoveBatch.unpack_moves(h.payload)])
+
+        full = MoveBatch([ms[0]] * MAX_BATCH).encode()
+        self.assertLess(len(full), 256)
+        self.assertLess(len(full), sum(len(m.encode()) for m in [ms[0]] * MAX_BATCH))
+
+        with self.assertRaises(ProtoError):
+            MoveBatch([ms[0]] * (MAX_BATCH + 1))
+
+        with self.assertRaises(SerialPacketError):
+            MoveBatch.unpack_moves(h.payload[:-1])
+
+    def test_encode_move_array(self):
+        import numpy as np
+
+        rng = np.random.default_rng(10)
+        moves = np.column_stack([rng.integers(0, 2 ** 32, 200),
+                                 rng.integers(-2 ** 31, 2 ** 31, (200, 6))])
+        moves[::3, 1:] = 0  # Lots of zeros, for COBS
+        moves[7] = 0
+
+        b = encode_move_array(CommandCode.VMOVE, moves, seq=0xfff0)
+
+        expected = bytearray()
+        for i, row in enumerate(moves):
+            m = MoveCommand(CommandCode.VMOVE, row[1:])
+            m.t = int(row[0])
+            m.seq = (0xfff0 + i) & 0xffff
+            m.encode(expected)
+
+        self.assertEqual(bytes(expected), b)
+
+        # Fewer axes are padded
+        b = encode_move_array(CommandCode.RMOVE, [[0, 5], [0, 6]], seq=1)
+        self.assertEqual(MoveCommand(CommandCode.RMOVE, [6]).pack(),
+                         CommandHeader.decode(b.split(b'\0')[1]).payload)
+
+        with self.assertRaises(BadMoveCodeError):
+            encode_move_array(CommandCode.RUN, moves)
+
+        # Values the frame fields can't hold are errors, not silently cast
+        with self.assertRaises(ProtoError):
+            encode_move_array(CommandCode.RMOVE, [[0, 3_000_000_000]])
+        with self.assertRaises(ProtoError):
+            encode_move_array(CommandCode.RMOVE, [[0, -2 ** 31 - 1]])
+        with self.assertRaises(ProtoError):
+            encode_move_array(CommandCode.RMOVE, [[2 ** 32, 1]])
+        with self.assertRaises(ProtoError):
+            encode_move_array(CommandCode.VMOVE, [[.25, 1000]])  # t in seconds, not microseconds
+
+    def test_crc8(self):
+        import os
+        from tplan_client.crc8 import Crc8, crc8, crc8_many
+
+        frames = [os.urandom(n) for n in (0, 1, 2, 31, 32, 32, 33, 32, 200)]
+        expected = [Crc8().update(f) for f in frames]
+
+        self.assertEqual(expected, [crc8(f) for f in frames])
+        self.assertEqual(expected, [crc8(memoryview(bytearray(f))) for f in frames])
+        self.assertEqual(expected, [crc8(f[10:], crc8(f[:10])) for f in frames])
+        self.assertEqual(expected, crc8_many(frames))
+
+    def test_current_state(self):
+
+        cs = CurrentState()
+        cs.queue_length, cs.queue_time, cs.flags = 6, 1500, 3
+        cs.positions = [1, -2, 3]
+        cs.planner_positions = [4, 5, -6, 7, 8, 9]
+
+        b = cs.pack()
+        cs2 = CurrentState(b)
+
+        self.assertEqual((6, 1500, 3), (cs2.queue_length, cs2.queue_time, cs2.flags))
+        self.assertEqual([1, -2, 3, 0, 0, 0], cs2.positions)
+        self.assertEqual([4, 5, -6, 7, 8, 9], cs2.planner_positions)
+        self.assertTrue(cs2.running and cs2.empty)
+        self.assertEqual(b, cs2.pack())
+        self.assertFalse(hasattr(cs2, '__dict__'))
+
+        # Fields can be set before or after they are decoded
+        cs2.queue_length += 3
+        cs3 = CurrentState(b)
+        cs3.positions = [7]
+        self.assertEqual(9, cs2.queue_length)
+        self.assertEqual([7], cs3.positions)
+
+        self.assertEqual(CurrentState(b).position_bytes(), cs2.position_bytes())
+        self.assertNotEqual(CurrentState(cs3.pack()).position_bytes(), cs2.position_bytes())
+
+        with self.assertRaises(struct.error):
+            CurrentState(b[:-1])
+
+    def test_slots_and_pool(self):
+
+        m = MoveCommand(CommandCode.RMOVE, [1, 2])
+        self.assertFalse(hasattr(m, '__dict__'))
+        self.assertEqual([1, 2, 0, 0, 0, 0], m.x)
+
+        m.x[2] = 3  # x stays a list, so callers can change it in place
+        self.assertEqual([1, 2, 3, 0, 0, 0], MOVE.unpack(CommandHeader.decode(m.encode()[:-1]).payload)['x'])
+
+        pool = HeaderPool(size=1)
+        alive = CommandHeader(1, CommandCode.ALIVE, payload=CurrentState().pack()).encode()[:-1]
+        ack = CommandHeader(2, CommandCode.ACK).encode()[:-1]
+
+        h1 = pool.decode(alive)
+        pool.release(h1)
+        self.assertEqual([h1], pool.free)
+
+        h2 = pool.decode(ack)
+        self.assertIs(h1, h2)
+        self.assertEqual((2, CommandCode.ACK, b''), (h2.seq, h2.code, h2.payload))
+        self.assertIsNone(h2.acked)
+
+        pool.release(h2)  # ACKs are not pooled
+        self.assertEqual([], pool.free)
+
+    def test_encoder_report(self):
+        import numpy as np
+        from cobs import cobs
+
+        fmt = struct.Struct(encoder_msg_fmt)
+
+        def frame(seq, cause, axis, limits, positions):
+            return cobs.encode(fmt.pack(seq, cause, axis, *[bytes([l]) for l in limits], *positions))
+
+        frames = [frame(1, CauseCode.LIMIT, 2, [0b101, 0b010, 0, 3, 7, 0], [10, -20, 30, 0, 0, 5]),
+                  frame(2, CauseCode.POLL, 0, [0] * 6, [1, 2, 3, 4, 5, -6])]
+
+        r = EncoderReport.decode(frames[0])
+        self.assertEqual((1, CauseCode.LIMIT, 1, 'LIMIT'), (r.seq, r.code, r.axis_code, r.name))
+        self.assertEqual([LimitCode.LH, LimitCode.HL, LimitCode.LL, LimitCode.HH, LimitCode.HH, LimitCode.LL],
+                         [e.limit_code for e in r.encoders])
+        self.assertEqual([1, 0, 0, 0, 1, 0], [e.direction for e in r.encoders])
+        self.assertEqual([10, -20, 30, 0, 0, 5], [e.position for e in r.encoders])
+        self.assertIsNone(EncoderReport.decode(frames[1]).axis_code)
+
+        d = Deframer(EncoderReport.decode)
+        self.assertEqual([1, 2], [m.seq for m in d.feed(b'\0'.join(frames) + b'\0')])
+
+        a = EncoderReport.decode_many(frames)
+        self.assertEqual([1, 2], list(a['seq']))
+        self.assertEqual([CauseCode.LIMIT, CauseCode.POLL], list(a['code']))
+        self.assertEqual([1, -1], list(a['axis']))
+        self.assertEqual([e.limit_code for e in r.encoders], list(a['limit_code'][0]))
+        self.assertEqual([e.direction for e in r.encoders], list(a['direction'][0]))
+        np.testing.assert_array_equal([[10, -20, 30, 0, 0, 5], [1, 2, 3, 4, 5, -6]], a['position'])
+
+        with self.assertRaises(SerialPacketError):
+            EncoderReport.decode(frames[0][:-3])
+
+        # Not COBS at all; the length code runs past the end
+        with self.assertRaises(SerialPacketError):
+            EncoderReport.decode(b'\x05\x01')
+        with self.assertRaises(SerialPacketError):
+            EncoderReport.decode_many([frames[0], b'\x05\x01'])
+        with self.assertRaises(SerialPacketError):
+            CommandHeader.decode(b'\x05\x01')
+
+    def test_golden_frames(self):
+        from tplan_client.bench import read_corpus, corpus_messages, encode_corpus
+
+        golden = read_corpus()
+
+        # If this fails after a deliberate change to the wire format, regenerate
+        # the corpus with python -m tplan_client.bench --write-corpus
+        self.assertEqual(golden, encode_corpus(corpus_messages()))
+
+        for kind, frames in golden.items():
+            d = Deframer(EncoderReport.decode if kind == 'encoder' else CommandHeader.decode)
+            msgs = d.feed(b''.join(frames))
+            self.assertEqual(len(frames), len(msgs), kind)
+            self.assertEqual(0, d.stats.crc_errors + d.stats.decode_errors, kind)
+
+    def test_schema(self):
+        import random
+        from tplan_client.schema import MOVE, AXIS_CONFIG, CURRENT_STATE
+
+        m = MoveCommand(CommandCode.RMOVE, [1, -2, 3], t=.5)
+        self.assertEqual(MoveCommand.msg_fmt, MOVE.fmt)
+        self.assertEqual((500_000, 1, -2, 3, 0, 0, 0), MOVE.values(m))
+        self.assertEqual({'t': 500_000, 'x': [1, -2, 3, 0, 0, 0]}, MOVE.unpack(m.pack()))
+
+        ac = make_axes(800, .1)['axes1'][0]
+        d = AXIS_CONFIG.unpack(ac.pack())
+        self.assertEqual((ac.axis_num, ac.v_max, ac.a_max), (d['axis_num'], d['v_max'], d['a_max']))
+        self.assertNotIn('_padding', d)
+        self.assertEqual(32, CURRENT_STATE['planner_positions'].offset)
+
+        rng = random.Random(17)
+        frames = random_frames(3, rng)
+        self.assertEqual(3 * (len(PAYLOAD_SCHEMAS) + len(PAYLOAD_GENERATORS)), len(frames))
+
+        for code, f in frames:
+            if isinstance(code, CauseCode):
+                self.assertEqual(code, EncoderReport.decode(f[:-1]).code)
+                continue
+
+            h = CommandHeader.decode(f[:-1])
+            self.assertEqual(code, h.code)
+            p = decode_payload(h.code, h.payload)
+            if code in STATE_CODES:
+                self.assertEqual(CURRENT_STATE.unpack(h.payload)['positions'], list(p.positions))
+            elif code == CommandCode.MOVE_BATCH:
+                self.assertTrue(1 <= len(p) <= MAX_BATCH)
+                self.assertTrue(all(d['code'] in MOVE_CODES for d in p))
+            elif code == CommandCode.SPARSE_MOVE:
+                self.assertIn(p['code'], MOVE_CODES)
+                self.assertEqual(6, len(p['x']))
+            else:
+                self.assertEqual(PAYLOAD_SCHEMAS[code].size, len(p))
+
+        self.assertEqual(frames, random_frames(3, random.Random(17)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,246 @@
+import random
+import unittest
+from types import SimpleNamespace
+
+
+class TestPlanner(unittest.TestCase):
+    """Tests for the planner math in old_code"""
+
+    def test_ipsolve(self):
+        from tplan_client.old_code.isolver import ipsplit, ipsolve, ipsolve_lists
+
+        rng = random.Random(21)
+
+        for i in range(100):
+            j = SimpleNamespace(v_max=rng.choice([3_000, 5_000, 10_000]),
+                                a_max=rng.choice([20_000, 50_000, 100_000]))
+            x = rng.randint(0, 20_000)
+            v_0 = rng.choice([None, 0, rng.uniform(0, j.v_max)])
+            v_1 = rng.choice([None, 0, rng.uniform(0, j.v_max)])
+
+            jd = ipsplit(x, j=j)
+
+            expected = ipsolve_lists(jd, x, v_0, v_1)
+            l = ipsolve(jd, x, v_0, v_1)
+
+            self.assertIsInstance(l, list)
+            self.assertEqual(len(expected), len(l))
+            for a, b in zip(expected, l):
+                self.assertAlmostEqual(a, b, delta=1e-3, msg=(x, v_0, v_1))
+
+            self.assertAlmostEqual(x, sum(l), delta=1e-6)
+
+    def test_segment_list_convergence(self):
+        from unittest.mock import patch
+        from tplan_client.old_code.iplanner import Segment, SegmentList
+
+        def solve(self, bv_0=None, bv_1=None):
+            # Stands in for the segment solver: a segment ends no faster than its
+            # length allows, and starts no more than a tenth of its length faster
+            x = self.move[0]
+            self.n_updates += 1
+            end = min(bv_1[0], x)
+            self.boundary_velocities_1 = [end]
+            self.boundary_velocities_0 = [min(bv_0[0], end + x / 10)]
+
+        joints = [SimpleNamespace(v_max=5_000, a_max=50_000)]
+        moves = [[1000], [1000], [1000], [100]]
+
+        with patch.object(Segment, 'solve', solve):
+            sl = SegmentList(joints)
+
+            # One solve for the first segment. Later ones solve the prior against v_max,
+            # then alternate twice: once to move the junction, once to see it stay put
+            self.assertEqual([1, 5, 5, 5], [sl.move(m) for m in moves])
+            self.assertEqual([1, 5, 5, 5], sl.solve_counts)
+            self.assertEqual([4, 5, 5, 2], [s.n_updates for s in sl.segments])
+
+            segs = list(sl.segments)
+            for p, n in zip(segs, segs[1:]):
+                self.assertEqual(p.boundary_velocities_1, n.boundary_velocities_0)
+
+            # Propagating back re-solves segments until one still matches
+            segs[-1].boundary_velocities_0 = [5]
+            self.assertEqual(1, sl._propagate_back(segs[-1]))
+            self.assertEqual([5], segs[-2].boundary_velocities_1)
+            self.assertEqual(6, segs[-2].n_updates)
+
+            # A change within the tolerance solves nothing
+            segs[-1].boundary_velocities_0 = [5.5]
+            self.assertEqual(0, sl._propagate_back(segs[-1]))
+
+            # A loose tolerance stops after the first pass, as does max_iterations
+            sl = SegmentList(joints, tolerance=1e9)
+            self.assertEqual([1, 3, 3, 3], [sl.move(m) for m in moves])
+
+            sl = SegmentList(joints, max_iterations=1)
+            self.assertEqual([1, 3, 3, 3], [sl.move(m) for m in moves])
+
+    def test_v_c_for_times(self):
+        from tplan_client.old_code.trapmath import v_c_for_times
+
+        rng = random.Random(23)
+        v_max = 5_000
+
+        def calc_x(v_c, v_0, v_1, t_a, t_c, t_d):
+            return (v_0 + v_c) * t_a / 2 + v_c * t_c + (v_1 + v_c) * t_d / 2
+
+        for i in range(2000):
+            v_0, v_1, v_c = rng.uniform(0, v_max), rng.choice([0, rng.uniform(0, v_max)]), rng.uniform(0, v_max)
+            times = rng.uniform(0, .1), rng.choice([0, rng.uniform(0, .5)]), rng.uniform(0, .1)
+            x = calc_x(v_c, v_0, v_1, *times)
+
+            self.assertAlmostEqual(v_c, v_c_for_times(x, v_0, v_1, *times, v_max), delta=1e-6)
+
+        self.assertAlmostEqual(1000, v_c_for_times(1000, 0, 0, .1, .2, .1, v_max) * .3, places=6)
+
+        # Out of range results are clamped, and with no time v_c doesn't matter
+        self.assertEqual(v_max, v_c_for_times(10_000, 0, 0, .1, .2, .1, v_max))
+        self.assertEqual(0, v_c_for_times(10, v_max, v_max, .1, 0, .1, v_max))
+        self.assertEqual(0, v_c_for_times(10, 0, 0, 0, 0, 0, v_max))
+
+    def test_solve_blocks(self):
+        import numpy as np
+        from tplan_client.old_code.trapmath import (solve_blocks, profile_x, SHAPE_ZERO,
+                                                    SHAPE_TRAPEZOID, SHAPE_TRIANGLE, SHAPE_LIMIT)
+
+        v_max, a_max = 5_000, 50_000
+        d = np.linspace(0, 2_000, 41)
+        v = np.linspace(0, v_max, 11)
+
+        b = solve_blocks(d[:, None, None], v[None, :, None], v[None, None, :], v_max, a_max)
+
+        self.assertEqual((41, 11, 11), b.shape.shape)
+        self.assertEqual(SHAPE_ZERO, b.shape[0, 0, 0])
+        self.assertEqual({SHAPE_ZERO, SHAPE_TRAPEZOID, SHAPE_TRIANGLE, SHAPE_LIMIT}, set(np.unique(b.shape)))
+
+        for i, j, k in np.ndindex(b.shape.shape):
+            x, v_0, v_1, shape = d[i], v[j], v[k], b.shape[i, j, k]
+
+            if shape == SHAPE_LIMIT:
+                # Can't change velocity in the distance
+                self.assertGreater(abs(v_1 ** 2 - v_0 ** 2) / (2 * a_max), x)
+                self.assertTrue(np.isnan(b.t[i, j, k]))
+                continue
+
+            t, v_c = b.t[i, j, k], b.v_c[i, j, k]
+            self.assertAlmostEqual(x, profile_x(t, v_0, v_c, v_1, a_max)[0], delta=1e-6)
+
+            if shape == SHAPE_TRAPEZOID:
+                self.assertEqual(v_max, v_c)
+                self.assertGreaterEqual(b.t_c[i, j, k], 0)
+            else:
+                self.assertEqual(0, b.t_c[i, j, k])
+                self.assertLessEqual(v_c, v_max)
+
+        # Scalars broadcast too
+        b = solve_blocks(200, 0, 0, v_max, a_max)
+        self.assertEqual(SHAPE_TRIANGLE, b.shape)
+        self.assertAlmostEqual(2 * np.sqrt(200 / a_max), b.t)
+
+    def test_block_cache(self):
+        from tplan_client.old_code.cache import BlockCache
+
+        c = BlockCache(maxsize=2, quantum=.5)
+        calls = []
+
+        def solve(x):
+            calls.append(x)
+            return x * 2
+
+        k1 = c.key('axis', (1000, 10.1, 0), (.1,))
+        self.assertEqual(2000, c.solve(k1, lambda: solve(1000)))
+        self.assertEqual(2000, c.solve(c.key('axis', (1000, 10.2, 0), (.1,)), lambda: solve(1000)))
+        self.assertEqual([1000], calls)  # 10.1 and 10.2 round to the same step
+        self.assertEqual((1, 1, 0), (c.hits, c.misses, c.evictions))
+
+        # Other kinds and times are different keys
+        self.assertNotEqual(k1, c.key('acd', (1000, 10.1, 0), (.1,)))
+        self.assertNotEqual(k1, c.key('axis', (1000, 10.1, 0), (.1001,)))
+
+        k2, k3 = c.key('axis', (2000,)), c.key('axis', (3000,))
+        c.solve(k2, lambda: solve(2000))
+        c.get(k1)  # k1 is now the most recent, so k2 goes first
+        c.solve(k3, lambda: solve(3000))
+
+        self.assertEqual(1, c.evictions)
+        self.assertIsNone(c.get(k2))
+        self.assertEqual(2000, c.get(k1))
+        self.assertEqual(2, len(c))
+
+        s = c.stats()
+        self.assertEqual((3, 4, 1), (s['hits'], s['misses'], s['evictions']))
+
+        c.configure(maxsize=1)
+        self.assertEqual((1, 2), (len(c), c.evictions))
+
+        c.configure(maxsize=0)
+        c.solve(k1, lambda: solve(1000))
+        self.assertEqual(0, len(c))
+
+        c.clear()
+        self.assertEqual({'size': 0, 'maxsize': 0, 'hits': 0, 'misses': 0, 'evictions': 0, 'hit_rate': 0},
+                         c.stats())
+
+    def test_block_cache_planner(self):
+        import sys
+        from unittest.mock import patch
+        from tplan_client.old_code.cache import BlockCache
+        from tplan_client.old_code.iplanner import AxisSegment, Joint, Segment
+        from tplan_client.old_code.isolver import ipsplit
+        from tplan_client.old_code.segments import JointSegment, TRIANGLE
+        from tplan_client.old_code.trapmath import solve_blocks
+
+        j = Joint(5_000, 50_000)
+
+        # The same axis block twice solves once, and never hands out the cached list
+        c = BlockCache()
+        segment = SimpleNamespace(cache=c)
+        si = ipsplit(4000, j=j)
+
+        a = AxisSegment(0, segment, j, si, 4000, 0, 0).solve()
+        self.assertEqual((0, 1), (c.hits, c.misses))
+
+        a.slices[0] += 1000
+        b = AxisSegment(0, segment, j, si, 4000, 0, 0).solve()
+        self.assertEqual((1, 1), (c.hits, c.misses))
+        self.assertIsNot(a.slices, b.slices)
+        self.assertAlmostEqual(4000, sum(b.slices), delta=1e-6)
+        self.assertEqual(len(b.slices), len(b.blocks))
+
+        # Segment.solve caches the longest axis's ACDBlock time. The module that holds
+        # ACDBlock is not in this tree, so a minimum time block stands in for it
+        class ACDBlock:
+            inits = 0
+
+            def __init__(self, x, v_0, v_1, joint):
+                self.x, self.v_0, self.v_1, self.joint = x, v_0, v_1, joint
+
+            def init(self):
+                ACDBlock.inits += 1
+                self.t = float(solve_blocks(self.x, self.v_0, self.v_1, self.joint.v_max, self.joint.a_max).t)
+                return self
+
+        c = BlockCache()
+        with patch.dict(sys.modules, {'tplan_client.old_code.gsolver': SimpleNamespace(ACDBlock=ACDBlock)}):
+            for i in range(2):
+                Segment(i, [4000, 1000], [j, j], cache=c).solve()
+
+        self.assertEqual(1, ACDBlock.inits)
+        self.assertEqual((3, 3), (c.hits, c.misses))  # One ACD and two axes, each solved once
+
+        # JointSegment.update_t_min
+        c = BlockCache()
+        jsj = SimpleNamespace(v_max=5_000, a_max=50_000, d_max=50_000)
+        for i in range(2):
+            js = JointSegment(jsj, 100)
+            js.cache = c
+            js.update_t_min()
+            self.assertEqual(TRIANGLE, js.shape)
+            self.assertAlmostEqual(2 * (100 / 50_000) ** .5, js.t_min)
+
+        self.assertEqual((1, 1), (c.hits, c.misses))
+
+
+if __name__ == '__main__':
+    unittest.main()
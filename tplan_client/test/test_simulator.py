@@ -0,0 +1,581 @@
+import asyncio
+import unittest
+
+import serial
+from time import time, sleep
+
+from tplan_client.aproto import AsyncProto
+from tplan_client.messages import *
+from tplan_client.proto import SyncProto, ProtocolException, TimeoutException
+from tplan_client.simulator import StepperSimulator, BLOCKS_PER_MOVE
+from tplan_client.test import make_axes
+
+
+class TestSimulator(unittest.TestCase):
+    """Protocol tests that run against the step controller simulator,
+    so they don't need any hardware"""
+
+    def setUp(self) -> None:
+        self.sim = StepperSimulator(time_scale=20, alive_interval=.2).start()
+
+    def tearDown(self) -> None:
+        self.sim.close()
+
+    def init(self, **kwargs):
+        d = make_axes(800, .1, usteps=16)
+        p = SyncProto(self.sim.port, None, **kwargs)
+        p.config(4, 27, 29, False, False, axes=d['axes3'])
+        p.flush()
+        return p
+
+    def test_echo(self):
+
+        p = SyncProto(self.sim.port, None)
+
+        msgs = []
+        p.send_command(CommandCode.ECHO, 'This is the payload')
+        p.flush()
+        p.runout(lambda p, m: msgs.append(m), timeout=.1)
+
+        echo = [m for m in msgs if m.code == CommandCode.ECHO]
+        self.assertEqual(1, len(echo))
+        self.assertEqual('This is the payload', echo[0].payload)
+        p.close()
+
+    def test_subscribe(self):
+
+        p = self.init()
+
+        done, every = [], []
+        p.subscribe(lambda m: done.append(m.seq), CommandCode.DONE)
+        f = p.subscribe(lambda p, m, r: every.append(r))
+
+        ms = [p.rmove((10,)) for i in range(3)]
+        p.run()
+        p.runempty(timeout=2)
+
+        self.assertEqual([m.seq for m in ms], done)
+        self.assertTrue(all(every))
+
+        p.unsubscribe(f)
+        self.assertEqual([CommandCode.DONE], list(p.subscribers))
+        p.close()
+
+    def test_config(self):
+
+        p = self.init()
+
+        self.assertEqual(3, self.sim.n_axes)
+        self.assertEqual(3, len(self.sim.axes))
+        self.assertFalse(p.in_flight)
+        p.close()
+
+    def test_moves(self):
+
+        p = self.init()
+
+        for i in range(5):
+            p.rmove((100, 200, -300))
+
+        p.flush()
+        self.assertEqual(5 * BLOCKS_PER_MOVE, p.queue_length)
+        self.assertEqual([500, 1000, -1500], p.current_state.planner_positions[:3])
+
+        p.runempty(timeout=2)
+
+        self.assertTrue(p.empty)
+        self.assertEqual(0, p.queue_length)
+        self.assertEqual([500, 1000, -1500], [a.spos for a in p.axis_state[:3]])
+        p.close()
+
+    def test_waits(self):
+
+        p = self.init(window=8)
+
+        ms = [p.rmove((1000,)) for i in range(4)]
+        p.flush()
+        p.run()
+
+        p.wait_until(lambda s: s.queue_length <= 2 * BLOCKS_PER_MOVE, timeout=2)
+        self.assertLessEqual(p.queue_length, 2 * BLOCKS_PER_MOVE)
+
+        p.wait_done(ms[2].seq, timeout=2)
+        self.assertTrue(p.is_done(ms[2].seq))
+
+        p.wait_empty(timeout=2)
+        self.assertEqual(4000, p.axis_state[0].spos)
+
+        p.stop()
+        p.flush()  # So the ACK for the stop, with an empty queue, is not handled after the move
+        p.rmove((10,))
+        with self.assertRaises(TimeoutException):
+            p.wait_empty(timeout=.1)
+
+        p.close()
+
+    def test_stats(self):
+
+        p = self.init(window=4)
+
+        ms = [p.rmove((100,)) for i in range(5)]
+        p.noop()
+        p.run()
+        p.runempty(timeout=2)
+        sleep(.5)  # Collect a few ALIVEs
+        p.runout(timeout=.1)
+
+        st = p.stats()
+
+        self.assertEqual(5, st['ack_latency']['RMOVE']['count'])
+        self.assertEqual(5, st['done_latency']['RMOVE']['count'])
+        self.assertGreater(st['done_latency']['RMOVE']['p50'], st['ack_latency']['RMOVE']['p50'])
+        self.assertGreater(st['alive_gap']['count'], 0)
+        self.assertEqual(st['frames_out'], self.sim.frames_in)
+        self.assertGreater(st['bytes_in'], st['frames_in'])
+        self.assertEqual(0, st['crc_errors'])
+        self.assertFalse(p.pending_done)
+        p.close()
+
+    def test_capture_replay(self):
+        import tempfile, os
+        from tplan_client.capture import replay, read_capture, DIR_IN, DIR_OUT
+
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'session.tpcap')
+
+            p = self.init(window=4, capture=path)
+            p.rmove_many([(100, 50)] * 4)
+            p.run()
+            p.runempty(timeout=2)
+            p.close()
+
+            records = list(read_capture(path))
+            self.assertEqual(p.transport_stats.frames_out, sum(r[2] == DIR_OUT for r in records))
+            self.assertEqual(p.transport_stats.frames_in, sum(r[2] == DIR_IN for r in records))
+            self.assertEqual(sorted(r[0] for r in records), [r[0] for r in records])
+
+            r = replay(path)
+
+        self.assertEqual([400, 200], [a.spos for a in r.axis_state[:2]])
+        self.assertTrue(r.empty)
+        self.assertFalse(r.in_flight)
+        self.assertFalse(r.pending_done)
+
+        st, rst = p.stats(), r.stats()
+        for k in ('frames_in', 'frames_out', 'bytes_in', 'bytes_out'):
+            self.assertEqual(st[k], rst[k], k)
+        self.assertEqual(4, rst['done_latency']['RMOVE']['count'])
+
+    def test_header_pool(self):
+
+        p = self.init(window=4, pool_size=8)
+
+        done = []
+        p.subscribe(lambda m: done.append(m.seq), CommandCode.DONE)
+
+        for i in range(10):
+            p.rmove((100,))
+
+        p.runempty(timeout=2)
+        sleep(.3)
+        p.runout(timeout=.1)
+
+        self.assertEqual(10, len(done))
+        self.assertGreater(p.pool.released, 10)
+        self.assertGreater(p.pool.reused, 0)
+        self.assertLessEqual(len(p.pool.free), 8)
+        self.assertEqual(1000, p.axis_state[0].spos)
+        p.close()
+
+    def test_pipelined_send(self):
+
+        p = self.init(window=8)
+
+        ms = [p.rmove((10,)) for i in range(20)]
+        self.assertLessEqual(len(p.in_flight), 8)
+
+        p.wait_acked(ms[-1].seq)
+        self.assertFalse(p.in_flight)
+        self.assertTrue(all(m.acked for m in ms))
+        p.close()
+
+    def test_queue_size_nack(self):
+
+        self.sim.queue_size = 2 * BLOCKS_PER_MOVE
+
+        p = self.init(window=4)
+
+        for i in range(3):
+            p.rmove((10,))
+
+        with self.assertRaises(ProtocolException):
+            p.flush()
+
+        p.close()
+
+    def test_queue_size_window(self):
+
+        self.sim.queue_size = 2 * BLOCKS_PER_MOVE
+
+        p = self.init(window=4, queue_size=2 * BLOCKS_PER_MOVE)
+        p.run()
+
+        for i in range(6):
+            p.rmove((1000,))
+
+        p.flush()
+        p.runempty(timeout=2)
+        self.assertEqual(6000, p.axis_state[0].spos)
+        p.close()
+
+    def test_queue_size_full(self):
+        from tplan_client.proto import ProtoBase
+
+        # Moves in flight count once, whether or not a report has covered them yet
+        p = ProtoBase(window=8, queue_size=4 * BLOCKS_PER_MOVE)
+        p.current_state.queue_length = BLOCKS_PER_MOVE
+
+        ms = []
+        for i in range(3):
+            m = p._move_command(CommandCode.RMOVE, [10])
+            self.assertTrue(p._window_open(m))
+            p._next_seq(m)
+            ms.append(m)
+
+        self.assertEqual(4 * BLOCKS_PER_MOVE, p.queue_length)
+        self.assertFalse(p._window_open(p._move_command(CommandCode.RMOVE, [10])))
+
+        # The ACK of the first reports it in the queue, and it leaves the in flight moves
+        cs = CurrentState()
+        cs.queue_length = 2 * BLOCKS_PER_MOVE
+        p.handle_message(CommandHeader(ms[0].seq, CommandCode.ACK, payload=cs.pack()))
+        self.assertEqual(4 * BLOCKS_PER_MOVE, p.queue_length)
+
+        # Against the simulator, paused so there are no ACKs, the window fills the queue exactly
+        self.sim.queue_size = 4 * BLOCKS_PER_MOVE
+
+        p = self.init(window=8, queue_size=4 * BLOCKS_PER_MOVE)
+        self.sim.stop()
+
+        for i in range(4):
+            p.rmove((10,))
+
+        self.assertEqual(4, len(p.in_flight))
+        self.assertEqual(4 * BLOCKS_PER_MOVE, p.queue_length)
+
+        with self.assertRaises(TimeoutException):
+            p.send(p._move_command(CommandCode.RMOVE, [10]), timeout=.2)
+
+        self.sim.start()
+        p.flush()
+        self.assertEqual(4, len(self.sim.queue))
+        self.assertEqual(4 * BLOCKS_PER_MOVE, p.queue_length)
+
+        p.close()
+
+    def test_nacked_limit(self):
+        from unittest.mock import patch, Mock
+        from tplan_client.proto import ProtoBase
+
+        # NACKs that nothing waits for are logged, and only the newest are kept
+        p = ProtoBase(window=16)
+
+        ms = []
+        for i in range(5):
+            m = p._move_command(CommandCode.RMOVE, [10])
+            p._next_seq(m)
+            ms.append(m)
+
+        with patch('tplan_client.proto.MAX_NACKED', 3), self.assertLogs('message', 'WARNING') as logs:
+            for m in ms:
+                p.handle_message(CommandHeader(m.seq, CommandCode.NACK))
+
+        self.assertEqual(5, len(logs.records))
+        self.assertEqual([m.seq for m in ms[2:]], list(p.nacked))
+
+        # Timeout messages are only built when they are raised
+        msg = Mock(return_value='late')
+        p = self.init()
+        p._update_ser_until(lambda: True, 1, msg)
+        msg.assert_not_called()
+
+        with self.assertRaisesRegex(TimeoutException, 'late'):
+            p._update_ser_until(lambda: False, .1, msg)
+
+        p.close()
+
+    def test_move_many(self):
+        import numpy as np
+
+        p = self.init(window=4)
+
+        moves = np.array([[10, 20, 30]] * 50)
+        ms = p.rmove_many(moves)
+
+        self.assertEqual(50, len(ms))
+        self.assertEqual(list(range(ms[0].seq, ms[0].seq + 50)), [m.seq for m in ms])
+        self.assertFalse(p.in_flight)
+        self.assertEqual([500, 1000, 1500], p.current_state.planner_positions[:3])
+
+        ms = p.vmove_many([.01, .02], [(1, 1, 1), (2, 2, 2)])
+        self.assertEqual([10_000, 20_000], [m.t for m in ms])
+
+        p.run()
+        p.runempty(timeout=2)
+        self.assertEqual([503, 1003, 1503], [a.spos for a in p.axis_state[:3]])
+        p.close()
+
+    def test_move_array(self):
+        import numpy as np
+
+        self.sim.queue_size = 10 * BLOCKS_PER_MOVE
+
+        p = self.init(window=4, queue_size=10 * BLOCKS_PER_MOVE)
+        p.run()
+
+        moves = np.zeros((25, 7), dtype=int)
+        moves[:, 0] = 1000  # microseconds
+        moves[:, 1:4] = [10, -20, 30]
+
+        seqs = p.move_array(CommandCode.VMOVE, moves, timeout=5)
+
+        self.assertEqual(25, len(seqs))
+        self.assertEqual(list(range(seqs[0], seqs[0] + 25)), list(seqs))
+        self.assertFalse(p.in_flight)
+
+        p.wait_done(int(seqs[-1]), timeout=2)
+        p.runempty(timeout=2)
+
+        self.assertEqual([250, -500, 750], [a.spos for a in p.axis_state[:3]])
+        self.assertFalse(p.nacked)
+        self.assertFalse(p.pending_done)
+        self.assertEqual(25, p.stats()['done_latency']['VMOVE']['count'])
+        p.close()
+
+    def test_move_batch(self):
+
+        self.sim.queue_size = 12 * BLOCKS_PER_MOVE
+
+        p = self.init(window=4, queue_size=12 * BLOCKS_PER_MOVE)
+        p.run()
+
+        moves = [(CommandCode.RMOVE, (10, 20), 0), (CommandCode.VMOVE, (5, -5), .001)] * 10
+        ms = p.move_batch(moves, timeout=5)
+
+        self.assertEqual(20, len(ms))
+        self.assertEqual(list(range(ms[0].seq, ms[0].seq + 20)), [m.seq for m in ms])
+        self.assertTrue(all(m.acked for m in ms))
+        self.assertFalse(p.in_flight)
+
+        p.wait_done(ms[-1].seq, timeout=2)
+        p.runempty(timeout=2)
+
+        self.assertEqual([150, 150], [a.spos for a in p.axis_state[:2]])
+        self.assertFalse(p.pending_done)
+        self.assertFalse(p.nacked)
+
+        st = p.stats()
+        self.assertEqual(10, st['done_latency']['RMOVE']['count'])
+        self.assertEqual(10, st['done_latency']['VMOVE']['count'])
+        self.assertLess(st['frames_out'], 20)
+
+        # A batch that doesn't fit in the simulator's queue is NACKed whole
+        p.stop()
+        p.flush()
+        p.queue_size = None
+        p.send(MoveBatch([MoveCommand(CommandCode.RMOVE, [1])] * 8))
+        second = p.send(MoveBatch([MoveCommand(CommandCode.RMOVE, [1]) for i in range(8)]))
+
+        # Every move in the frame is rejected, not just the one with the frame's seq
+        with self.assertRaises(ProtocolException):
+            p.wait_done(second.moves[0].seq, timeout=2)
+        self.assertEqual([False] * 8, [mv.acked for mv in second.moves])
+
+        with self.assertRaises(ProtocolException):
+            p.flush()
+        self.assertFalse(second.acked)
+        self.assertEqual(8, len(self.sim.queue))
+        self.assertEqual(8, len(p.pending_done))
+        p.close()
+
+    def test_sparse_moves(self):
+
+        sent = {}
+
+        for sparse in (False, True):
+            p = self.init(window=4, sparse_moves=sparse)
+            p.zero()
+            p.flush()
+            p.reset_stats()
+
+            ms = [p.rmove((10,)), p.rmove((0, -2000)), p.jog(.001, {2: 100_000}), p.amove((0, 0, 0))]
+            p.run()
+            p.wait_done(ms[-1].seq, timeout=2)
+            p.runempty(timeout=2)
+
+            self.assertEqual([0, 0, 0], [a.spos for a in p.axis_state[:3]])
+            self.assertFalse(p.pending_done)
+            sent[sparse] = p.stats()['bytes_out']
+            p.close()
+
+        self.assertLess(sent[True], sent[False] * .6)
+
+    def test_move_many_nack(self):
+
+        p = self.init(window=4)
+
+        # The simulator rejects the second move, or batch frame, of each call
+        queue_move, calls = self.sim.queue_move, []
+
+        def reject_second(h):
+            calls.append(h.seq)
+            return len(calls) != 2 and queue_move(h)
+
+        self.sim.queue_move = reject_second
+
+        with self.assertRaises(ProtocolException) as e:
+            p.rmove_many([(10,)] * 4)
+        self.assertIn(str(calls[1]), str(e.exception))
+        self.assertFalse(p.nacked)
+
+        calls.clear()
+        with self.assertRaises(ProtocolException):
+            p.move_array(CommandCode.RMOVE, [[0, 10, 0, 0, 0, 0, 0]] * 4)
+        self.assertFalse(p.nacked)
+
+        calls.clear()
+        with self.assertRaises(ProtocolException):
+            p.move_batch([(CommandCode.RMOVE, (10,), 0)] * 12)
+        self.assertFalse(p.nacked)
+
+        self.assertEqual(3 + 3 + MAX_BATCH, len(self.sim.queue))  # Less the rejected frames
+        p.close()
+
+    def test_move_many_chunked(self):
+
+        self.sim.queue_size = 4 * BLOCKS_PER_MOVE
+
+        p = self.init(queue_size=4 * BLOCKS_PER_MOVE)
+        p.run()
+
+        # Chunks go out as the queue drains, with no ACK round trip between them
+        flushes = []
+        flush = p.flush
+        p.flush = lambda *args, **kwargs: flushes.append(1) or flush(*args, **kwargs)
+
+        p.amove_many([(i * 100,) for i in range(1, 21)], timeout=5)
+        p.runempty(timeout=2)
+
+        self.assertEqual([], flushes)
+        self.assertEqual(2000, p.axis_state[0].spos)
+        self.assertFalse(p.nacked)
+        p.close()
+
+    def test_threaded(self):
+
+        p = self.init(window=4, threaded=True, ring_size=8)
+
+        p.run()
+        ms = [p.rmove((100,)) for i in range(5)]
+        p.wait_acked(ms[-1].seq)
+
+        # The reader thread keeps the state fresh without any update() calls
+        deadline = time() + 2
+        while p.axis_state[0].spos != 500 and time() < deadline:
+            sleep(.05)
+
+        self.assertEqual(500, p.axis_state[0].spos)
+        self.assertTrue(p.empty)
+
+        sleep(.5)  # Enough ALIVE messages to overfill the ring
+        self.assertLessEqual(len(p.raw_queue), 8)
+        self.assertGreater(p.rx_dropped, 0)
+
+        # queue_length reads in_flight under the lock the reader holds while it handles messages
+        import threading
+        lengths = []
+        with p.lock:
+            t = threading.Thread(target=lambda: lengths.append(p.queue_length))
+            t.start()
+            t.join(.1)
+            self.assertFalse(lengths)
+        t.join(1)
+        self.assertEqual([0], lengths)
+
+        p.runout(timeout=.1)
+        p.close()
+        self.assertIsNone(p.reader_thread)
+
+    def test_threaded_port_error(self):
+
+        p = self.init(threaded=True)
+
+        def fail(n):
+            raise serial.SerialException('Port disconnected')
+
+        p.step_ser.read = fail
+        m = p.rmove((10,))
+
+        # The reader thread stops, and the waits raise its error rather than hang
+        with self.assertRaises(serial.SerialException):
+            p.wait_done(m.seq, timeout=None)
+
+        self.assertFalse(p.reader_alive)
+        with self.assertRaises(serial.SerialException):
+            p.update_ser(None)
+
+        p.close()
+
+    def test_async(self):
+
+        async def run():
+            async with await AsyncProto.open(self.sim.port, window=4, sparse_moves=True) as p:
+                await p.config(axes=make_axes(800, .1)['axes1'])
+                ms = [await p.rmove((100,)) for i in range(4)]
+                self.assertTrue(all(m.compact for m in ms))
+                await p.wait_acked(ms[-1].seq)
+                await p.run()
+                await p.wait_done(ms[-1].seq, timeout=2)
+                await p.wait_empty(timeout=2)
+
+                self.assertEqual(400, p.axis_state[0].spos)
+
+                n = 0
+                async for m in p:
+                    n += 1
+                    if p.messages.empty():
+                        break
+
+                self.assertGreater(n, 0)
+
+        asyncio.run(run())
+
+    def test_async_reader_error(self):
+
+        async def run():
+            async with await AsyncProto.open(self.sim.port, window=4) as p:
+                await p.config(axes=make_axes(800, .1)['axes1'])
+
+                def fail(m):
+                    raise ValueError('Subscriber failed')
+
+                p.subscribe(fail, CommandCode.DONE)
+
+                ms = [await p.rmove((100,)) for i in range(2)]
+                await p.run()
+
+                # The first DONE stops the reader, which fails the waits, rather than hang them
+                with self.assertRaises(ValueError):
+                    await p.wait_done(ms[-1].seq)
+
+                with self.assertRaises(ValueError):
+                    await p.wait_empty()
+
+                with self.assertRaises(ValueError):
+                    await p.rmove((100,))
+
+        asyncio.run(run())
+
+
+if __name__ == '__main__':
+    unittest.main()
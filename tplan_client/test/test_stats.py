@@ -0,0 +1,43 @@
+import unittest
+
+from tplan_client.stats import Histogram
+
+
+class TestStats(unittest.TestCase):
+
+    def test_histogram_buckets(self):
+
+        h = Histogram()
+
+        # Buckets are contiguous and each value lands in its own bucket's range
+        last_high = -1
+        for i in range(200):
+            low, high = h.bucket_range(i)
+            self.assertEqual(last_high + 1, low)
+            last_high = high
+
+        for v in [0, 1, 15, 16, 17, 31, 32, 100, 1000, 123_456, 2 ** 31]:
+            low, high = h.bucket_range(h.index(v))
+            self.assertTrue(low <= v <= high, (v, low, high))
+            self.assertLessEqual(high - low, max(v / 16, 0))
+
+    def test_histogram_percentiles(self):
+
+        h = Histogram()
+
+        for v in range(1, 1001):
+            h.record(v)
+
+        self.assertEqual(1000, h.count)
+        self.assertEqual(1, h.min)
+        self.assertEqual(1000, h.max)
+        self.assertEqual(500.5, h.mean)
+
+        for p in (50, 90, 99):
+            self.assertAlmostEqual(p * 10, h.percentile(p), delta=p * 10 / 16)
+
+        self.assertEqual(1000, h.percentile(100))
+
+
+if __name__ == '__main__':
+    unittest.main()